@@ -0,0 +1,57 @@
+'''Flow.connect でフローを大きくするベンチマーク
+
+ノードを1つずつ connect で追加し（ときどき分岐させる）、指定した数に達するまでの時間と、
+保存した内容から Flow を作り直す時間（一括読み込み）を計測する。
+'''
+import sys, time, random
+from datetime import datetime
+from vizprompt.core.flow import Flow
+
+def make_flow(nodes=(), connections=()):
+    timestamp = datetime.now().astimezone()
+    return Flow(
+        id="bench",
+        name="bench",
+        created=timestamp,
+        updated=timestamp,
+        description="",
+        nodes=list(nodes),
+        connections=list(connections),
+        data_dir=".",
+        relpath="bench.yaml",
+    )
+
+def grow(n, seed=0):
+    """
+    チャットと同様に直前のノードへ接続し、1割は過去のノードから分岐させる
+    """
+    rng = random.Random(seed)
+    flow = make_flow()
+    flow.connect(None, "0")
+    for i in range(1, n):
+        prev = str(i - 1) if rng.random() >= 0.1 else str(rng.randrange(i))
+        flow.connect(prev, str(i))
+    return flow
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+    print(f"{'nodes':>8} {'connect(s)':>11} {'load(s)':>8} {'disconnect(s)':>14}")
+    for n in sizes:
+        start = time.perf_counter()
+        flow = grow(n)
+        connect = time.perf_counter() - start
+
+        start = time.perf_counter()
+        flow = make_flow(flow.nodes, flow.connections)
+        load = time.perf_counter() - start
+
+        # 末尾側の接続から順に1000本切断
+        edges = list(flow.connections)[-1000:]
+        start = time.perf_counter()
+        for from_id, to_id in reversed(edges):
+            flow.disconnect(from_id, to_id)
+        disconnect = time.perf_counter() - start
+        print(f"{n:8} {connect:11.3f} {load:8.3f} {disconnect:14.3f}")
+
+if __name__ == "__main__":
+    main()
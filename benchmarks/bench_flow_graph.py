@@ -0,0 +1,68 @@
+'''Flow のグラフの大きさと走査のベンチマーク
+
+チャットと同様に枝分かれするフローを保存された内容（ノードと接続）から作成する時間と
+グラフが使うメモリ（tracemalloc、時間とは別に計測）、最後のノードまでの get_history・
+get_histories・convert_map の時間を計測する。
+'''
+import sys, time, random, tracemalloc
+from datetime import datetime
+from vizprompt.core.flow import Flow
+
+def make_flow(nodes, connections):
+    timestamp = datetime.now().astimezone()
+    return Flow(
+        id="bench",
+        name="bench",
+        created=timestamp,
+        updated=timestamp,
+        description="",
+        nodes=nodes,
+        connections=connections,
+        data_dir=".",
+        relpath="bench.yaml",
+    )
+
+def make_data(n, seed=0):
+    """
+    直前のノードへ接続し、1割は少し前のノードから分岐させる（ノードIDはUUIDと同じ36文字）
+    """
+    rng = random.Random(seed)
+    nodes = [f"{i:08x}-0000-4000-8000-000000000000" for i in range(n)]
+    connections = []
+    for i in range(1, n):
+        prev = i - 1 if rng.random() >= 0.1 else max(0, i - rng.randrange(2, 10))
+        connections.append((nodes[prev], nodes[i]))
+    return nodes, connections
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000]
+    print(f"{'nodes':>8} {'MB':>7} {'load(s)':>8} {'history(s)':>11} {'histories(s)':>13} {'map(s)':>7}")
+    for n in sizes:
+        nodes, connections = make_data(n)
+
+        # ノードIDの文字列は呼び出し側と共有するため含まない
+        tracemalloc.start()
+        flow = make_flow(list(nodes), connections)
+        memory = tracemalloc.get_traced_memory()[0] / 1024 / 1024
+        tracemalloc.stop()
+        del flow
+
+        start = time.perf_counter()
+        flow = make_flow(list(nodes), connections)
+        load = time.perf_counter() - start
+
+        start = time.perf_counter()
+        history = flow.get_history(nodes[-1])
+        get_history = time.perf_counter() - start
+
+        start = time.perf_counter()
+        flow.get_histories()
+        histories = time.perf_counter() - start
+
+        start = time.perf_counter()
+        flow.convert_map(history)
+        convert = time.perf_counter() - start
+        print(f"{n:8} {memory:7.1f} {load:8.3f} {get_history:11.3f} {histories:13.3f} {convert:7.3f}")
+
+if __name__ == "__main__":
+    main()
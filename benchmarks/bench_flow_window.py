@@ -0,0 +1,60 @@
+'''Flow の部分読み込みのベンチマーク
+
+直前のノードへの接続を続け、ときどき過去の任意のノードから分岐させたフローを保存し、
+全体・最後のノードの祖先・最後のノードから100世代の読み込みについて、
+読み込みの時間と読み込んだフローが使うメモリ（tracemalloc、時間とは別に計測）を計測する。
+'''
+import sys, time, random, tracemalloc, tempfile
+from datetime import datetime
+from vizprompt.core.flow import Flow
+
+def make_flow(data_dir, n, seed=0):
+    """
+    9割は直前のノードへ接続し、1割は過去の任意のノードから分岐させる（ノードIDはUUIDと同じ36文字）
+    """
+    rng = random.Random(seed)
+    nodes = [f"{i:08x}-0000-4000-8000-000000000000" for i in range(n)]
+    connections = []
+    for i in range(1, n):
+        prev = i - 1 if rng.random() >= 0.1 else rng.randrange(i)
+        connections.append((nodes[prev], nodes[i]))
+    timestamp = datetime.now().astimezone()
+    flow = Flow(
+        id="bench",
+        name="bench",
+        created=timestamp,
+        updated=timestamp,
+        description="",
+        nodes=nodes,
+        connections=connections,
+        data_dir=data_dir,
+        relpath="bench.yaml",
+    )
+    flow.save(compact=True)
+    return nodes[-1]
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000]
+    print(f"{'nodes':>8} {'mode':>12} {'loaded':>8} {'MB':>7} {'load(s)':>8}")
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as data_dir:
+            head = make_flow(data_dir, n)
+            modes = {
+                "full": {},
+                "ancestors": {"heads": [head]},
+                "generations": {"heads": [head], "generations": 100},
+            }
+            for mode, kwargs in modes.items():
+                tracemalloc.start()
+                flow = Flow.load(data_dir, "bench.yaml", **kwargs)
+                memory = tracemalloc.get_traced_memory()[0] / 1024 / 1024
+                tracemalloc.stop()
+                del flow
+
+                start = time.perf_counter()
+                flow = Flow.load(data_dir, "bench.yaml", **kwargs)
+                load = time.perf_counter() - start
+                print(f"{n:8} {mode:>12} {len(flow.nodes):8} {memory:7.1f} {load:8.3f}")
+
+if __name__ == "__main__":
+    main()
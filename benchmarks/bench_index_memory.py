@@ -0,0 +1,37 @@
+'''インデックスのメモリ使用量のベンチマーク
+
+指定した件数のエントリを持つ index.tsv を作成し、TsvIndex に読み込んだときの
+メモリ使用量（tracemalloc のピーク・保持量）と読み込み時間を計測する。
+'''
+import os, sys, time, tempfile, tracemalloc, uuid
+from datetime import datetime, timedelta
+from vizprompt.core.index import TsvIndex
+from vizprompt.core.journal import Journal
+from vizprompt.core.slots import SlotAllocator
+
+def make_tsv(path, n):
+    timestamp = datetime.now().astimezone()
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("relpath\tuuid\ttimestamp\n")
+        for i in range(n):
+            ts = (timestamp + timedelta(seconds=i)).isoformat()
+            print(f"{i // 900:03}/{i % 900:03}.xml", uuid.uuid4(), ts, sep="\t", file=f)
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100000, 500000]
+    print(f"{'entries':>8} {'load(s)':>8} {'held(MB)':>9} {'peak(MB)':>9} {'B/entry':>8}")
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as data_dir:
+            make_tsv(os.path.join(data_dir, "index.tsv"), n)
+            index = TsvIndex(data_dir, SlotAllocator("xml"), Journal(os.path.join(data_dir, "index.tsv")))
+            tracemalloc.start()
+            start = time.perf_counter()
+            index.load()
+            elapsed = time.perf_counter() - start
+            held, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"{n:8} {elapsed:8.3f} {held / 2**20:9.1f} {peak / 2**20:9.1f} {held / n:8.0f}")
+            index.close()
+
+if __name__ == "__main__":
+    main()
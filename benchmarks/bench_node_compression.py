@@ -0,0 +1,93 @@
+'''ノードのテキスト圧縮のベンチマーク
+
+圧縮なし・zlib・lzma でノードを保存し、ディスク使用量と読み込み時間を比較する。
+引数にプロジェクトのディレクトリを指定すると、そのノードのテキストを使う
+（指定しなければ、大きさが対数正規分布に従う合成テキストを使う）。
+
+uv run python benchmarks/bench_node_compression.py [project_dir] [--threshold N]
+'''
+import os, time, random, tempfile, argparse
+from datetime import datetime
+from vizprompt.core.node import Node, LazyNode, NodeManager, COMPRESS_THRESHOLD, ENCODINGS
+
+WORDS = "def class return import self value result print for in if else the of and to a".split()
+
+def synthetic_texts(n, seed=0):
+    """
+    中央値 2KB 程度で、まれに数百KBになるテキスト
+    """
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(n):
+        size = min(int(rng.lognormvariate(7.6, 1.5)), 1024 * 1024)
+        lines = []
+        length = 0
+        while length < size:
+            line = " " * rng.choice([0, 4, 8]) + " ".join(rng.choices(WORDS, k=rng.randint(3, 12)))
+            lines.append(line)
+            length += len(line) + 1
+        texts.append("\n".join(lines))
+    return texts
+
+def project_texts(base_dir):
+    manager = NodeManager(base_dir=base_dir)
+    texts = []
+    for relpath in manager.tsv_entries:
+        node = Node.load(manager.data_dir, relpath)
+        texts.extend(content["text"] for content in node.contents)
+    return texts
+
+def make_node(data_dir, i, text, encoding):
+    timestamp = datetime.now().astimezone()
+    node = Node(
+        id=f"00000000-0000-0000-0000-{i:012}",
+        timestamp=timestamp,
+        contents=[{"role": "assistant", "count": 0, "duration": 0, "text": text}],
+        model="dummy",
+        summary="",
+        summary_updated=False,
+        summary_last_built=timestamp,
+        tags=[],
+        data_dir=data_dir,
+        relpath=f"{i:06}.xml",
+    )
+    if encoding:
+        node.contents[0]["encoding"] = encoding
+    return node
+
+def measure(texts, encoding, threshold):
+    with tempfile.TemporaryDirectory() as data_dir:
+        start = time.perf_counter()
+        for i, text in enumerate(texts):
+            make_node(data_dir, i, text, encoding if len(text) >= threshold else None).save()
+        save = time.perf_counter() - start
+        size = sum(entry.stat().st_size for entry in os.scandir(data_dir))
+        relpaths = [f"{i:06}.xml" for i in range(len(texts))]
+        start = time.perf_counter()
+        for relpath in relpaths:
+            Node.load(data_dir, relpath)
+        load = time.perf_counter() - start
+        start = time.perf_counter()
+        for relpath in relpaths:
+            LazyNode.load(data_dir, relpath)
+        header = time.perf_counter() - start
+    return size, save, load, header
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("project_dir", nargs="?")
+    parser.add_argument("--count", type=int, default=500, help="合成するテキストの数")
+    parser.add_argument("--threshold", type=int, default=COMPRESS_THRESHOLD)
+    args = parser.parse_args()
+    texts = project_texts(args.project_dir) if args.project_dir else synthetic_texts(args.count)
+    large = sum(len(text) >= args.threshold for text in texts)
+    print(f"texts: {len(texts)} (>= {args.threshold} chars: {large}), chars: {sum(map(len, texts))}")
+    print(f"{'encoding':>8} {'disk(MB)':>9} {'save(ms)':>9} {'load(ms)':>9} {'header(ms)':>11}")
+    n = len(texts)
+    for encoding in [None, *ENCODINGS]:
+        size, save, load, header = measure(texts, encoding, args.threshold)
+        print(f"{encoding or 'none':>8} {size / 1024 / 1024:9.2f} {save / n * 1000:9.3f} "
+              f"{load / n * 1000:9.3f} {header / n * 1000:11.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+'''ノードのXML出力のベンチマーク
+
+Node.to_xml（逐次書き出し）と、従来の minidom による出力
+（json_to_xml + toprettyxml）の時間を比較する。両者の出力が一致することも確認する。
+'''
+import sys, time
+from datetime import datetime
+from vizprompt.core.node import Node, json_to_xml
+
+def make_node(size):
+    timestamp = datetime.now().astimezone()
+    text = ("Lorem ipsum <dolor> sit & amet.\n" * (size // 32 + 1))[:size]
+    return Node(
+        id="12345678-1234-1234-1234-123456789abc",
+        timestamp=timestamp,
+        contents=[
+            {"role": "user", "count": 10, "duration": 0.5, "text": text},
+            {"role": "assistant", "count": 100, "duration": 2.5, "text": text * 4},
+        ],
+        model="dummy",
+        summary="summary",
+        summary_updated=True,
+        summary_last_built=timestamp,
+        tags=[],
+        data_dir="",
+        relpath="000/000.xml",
+    )
+
+def minidom_xml(node):
+    doc = json_to_xml(node.to_dict())
+    return doc.toprettyxml(encoding='utf-8', indent='').decode('utf-8')
+
+def measure(func, node, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(node)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000]
+    print(f"{'chars':>8} {'minidom(us)':>12} {'stream(us)':>11} {'speedup':>8}")
+    for size in sizes:
+        node = make_node(size)
+        assert node.to_xml() == minidom_xml(node)
+        repeat = max(100, 200000 // size)
+        old = measure(minidom_xml, node, repeat)
+        new = measure(Node.to_xml, node, repeat)
+        print(f"{size:8} {old:12.1f} {new:11.1f} {old / new:7.1f}x")
+
+if __name__ == "__main__":
+    main()
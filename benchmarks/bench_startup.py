@@ -0,0 +1,57 @@
+'''起動時のインデックス整合性チェックのベンチマーク
+
+ノード数を増やしながら NodeManager の初期化時間を計測する。
+- cold: index.tsv なし（全ファイルからUUIDを取得）
+- full: --full-rescan 相当（全フォルダを列挙）
+- incremental: 前回走査結果を利用（変更のあったフォルダのみ走査）
+- append: incremental のあとにノードを1件追加してから起動（index.tsv の追記分だけを反映）
+- sqlite: SQLite のバックエンドに移行してから incremental と同じ条件で起動
+'''
+import os, sys, time, tempfile, uuid
+from types import SimpleNamespace
+from datetime import datetime
+from vizprompt.core.node import NodeManager
+from vizprompt.core.slots import SlotAllocator
+
+G = SimpleNamespace(model="bench", prompt_count=1, prompt_duration=0.1, eval_count=1, eval_duration=0.1)
+
+TEMPLATE = '<?xml version="1.0" encoding="utf-8"?>\n<node id="{id}" timestamp="{timestamp}">\n</node>\n'
+
+def make_project(base_dir, n):
+    """
+    NodeManager と同じ順序（SlotAllocator）でファイルを配置する
+    """
+    data_dir = os.path.join(base_dir, "nodes")
+    timestamp = datetime.now().astimezone().isoformat()
+    slots = SlotAllocator("xml")
+    for _ in range(n):
+        relpath = slots.peek()
+        slots.mark_used(relpath)
+        path = os.path.join(data_dir, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(TEMPLATE.format(id=uuid.uuid4(), timestamp=timestamp))
+
+def measure(base_dir, **kwargs):
+    start = time.perf_counter()
+    NodeManager(base_dir=base_dir, **kwargs)
+    return time.perf_counter() - start
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 50000]
+    print(f"{'nodes':>8} {'cold':>8} {'full':>8} {'incr':>8} {'append':>8} {'sqlite':>8}")
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as base_dir:
+            make_project(base_dir, n)
+            cold = measure(base_dir)
+            full = measure(base_dir, full_rescan=True)
+            incr = measure(base_dir)
+            NodeManager(base_dir=base_dir).create_node("prompt", "response", G)
+            append = measure(base_dir)
+            NodeManager(base_dir=base_dir).migrate_index("sqlite")
+            measure(base_dir)
+            sqlite = measure(base_dir)
+            print(f"{n:8} {cold:8.3f} {full:8.3f} {incr:8.3f} {append:8.3f} {sqlite:8.3f}")
+
+if __name__ == "__main__":
+    main()
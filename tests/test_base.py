@@ -0,0 +1,206 @@
+import os, time
+from types import SimpleNamespace
+from vizprompt.core.node import NodeManager
+from vizprompt.core.slots import SlotAllocator
+from vizprompt.core.index import TsvIndex
+
+g = SimpleNamespace(
+    model="dummy",
+    prompt_count=1,
+    prompt_duration=0.1,
+    eval_count=2,
+    eval_duration=0.2,
+)
+
+def make_nodes(base_dir, n):
+    manager = NodeManager(base_dir=base_dir)
+    return manager, [manager.create_node(f"prompt {i}", f"response {i}", g) for i in range(n)]
+
+def test_rescan_detects_added_and_removed_files(tmp_path):
+    manager, nodes = make_nodes(str(tmp_path), 3)
+    # 手動でファイルを追加・削除
+    nodes[2].relpath = "001/000.xml"
+    os.makedirs(os.path.join(manager.data_dir, "001"))
+    nodes[2].save()
+    os.remove(os.path.join(manager.data_dir, nodes[0].relpath))
+
+    manager = NodeManager(base_dir=str(tmp_path))
+    assert nodes[0].id not in manager.uuid_map
+    assert manager.uuid_map[nodes[2].id] == ["001/000.xml", "000/002.xml"]
+    assert "000/000.xml" not in manager.tsv_entries
+
+def test_rescan_skips_unchanged_folders(tmp_path, monkeypatch):
+    make_nodes(str(tmp_path), 3)
+    NodeManager(base_dir=str(tmp_path))
+
+    scanned = []
+    scan_folders = NodeManager.scan_folders
+    def spy(self, folders, relpaths):
+        scanned.extend(folders)
+        return scan_folders(self, folders, relpaths)
+    monkeypatch.setattr(NodeManager, "scan_folders", spy)
+
+    manager = NodeManager(base_dir=str(tmp_path))
+    assert scanned == []
+    assert len(manager.tsv_entries) == 3
+
+    NodeManager(base_dir=str(tmp_path), full_rescan=True)
+    assert scanned == ["000"]
+
+def test_startup_reads_only_appended_entries(tmp_path, monkeypatch):
+    manager, nodes = make_nodes(str(tmp_path), 3)
+    NodeManager(base_dir=str(tmp_path))
+    manager = NodeManager(base_dir=str(tmp_path))
+    manager.create_node("prompt", "response", g)
+
+    calls = []
+    for name in ("sync_slots", "folder_counts", "count_slots_below"):
+        method = getattr(TsvIndex, name)
+        def spy(self, *args, name=name, method=method):
+            calls.append(name)
+            return method(self, *args)
+        monkeypatch.setattr(TsvIndex, name, spy)
+
+    # 追記だけなら全エントリを調べ直さない
+    manager = NodeManager(base_dir=str(tmp_path))
+    assert calls == []
+    assert len(manager.tsv_entries) == 4
+    assert manager.get_next_relpath_and_folder() == "000/004.xml"
+
+    # index.tsv が書き直されていれば全エントリを調べ直す
+    os.remove(os.path.join(manager.data_dir, nodes[1].relpath))
+    manager.remove_entry(nodes[1].relpath)
+    manager.save_index()
+    manager = NodeManager(base_dir=str(tmp_path))
+    assert calls == ["sync_slots", "folder_counts", "count_slots_below"]
+    assert manager.get_next_relpath_and_folder() == "000/001.xml"
+
+def test_slot_order_matches_linear_search():
+    allocator = SlotAllocator("xml")
+    key = allocator.cursor
+    count = 0
+    for max in range(100, 400, 100):
+        for i in range(max):
+            for idx in range(max):
+                relpath = f"{i:03}/{idx:03}.xml"
+                if allocator.key(relpath)[0] == max // 100 - 1:
+                    assert allocator.relpath(key) == relpath
+                    assert allocator.ordinal(key) == count
+                    key = allocator.successor(key)
+                    count += 1
+
+def test_allocator_reuses_holes(tmp_path):
+    manager, nodes = make_nodes(str(tmp_path), 4)
+    os.remove(os.path.join(manager.data_dir, nodes[1].relpath))
+
+    manager = NodeManager(base_dir=str(tmp_path))
+    assert manager.get_next_relpath_and_folder() == "000/001.xml"
+    node = manager.create_node("prompt", "response", g)
+    assert node.relpath == "000/001.xml"
+    assert manager.get_next_relpath_and_folder() == "000/004.xml"
+
+    # 空き情報が古くても起動時に補正される
+    os.remove(manager.slots_path)
+    manager = NodeManager(base_dir=str(tmp_path))
+    assert manager.get_next_relpath_and_folder() == "000/004.xml"
+
+def test_sqlite_backend(tmp_path):
+    manager, nodes = make_nodes(str(tmp_path), 3)
+    entries = list(manager.tsv_entries.items())
+    manager.migrate_index("sqlite")
+    assert os.path.exists(os.path.join(manager.data_dir, "index.db"))
+
+    manager = NodeManager(base_dir=str(tmp_path))
+    assert manager.index.name == "sqlite"
+    assert list(manager.tsv_entries.items()) == entries
+    assert manager.uuid_map[nodes[1].id] == [nodes[1].relpath]
+    node = manager.create_node("prompt", "response", g)
+    assert node.relpath == "000/003.xml"
+
+    # index.tsv も同じ内容で書き出される
+    manager = NodeManager(base_dir=str(tmp_path), backend="tsv")
+    assert manager.uuid_map[node.id] == ["000/003.xml"]
+    assert len(manager.tsv_entries) == 4
+
+def test_collision_order(tmp_path):
+    from datetime import datetime, timedelta
+    from vizprompt.core.index import TsvIndex
+    from vizprompt.core.journal import Journal
+    journal = Journal(os.path.join(str(tmp_path), "index.tsv"))
+    index = TsvIndex(str(tmp_path), SlotAllocator("xml"), journal)
+    base = datetime.now().astimezone()
+    stamps = [0, 2, 1, 2, 0, 1]
+    for i, d in enumerate(stamps):
+        index.add(f"000/{i:03}.xml", "same", base + timedelta(seconds=d))
+    # タイムスタンプが新しい順、同一なら後から追加した順
+    expected = ["000/003.xml", "000/001.xml", "000/005.xml", "000/002.xml", "000/004.xml", "000/000.xml"]
+    assert index.relpaths("same") == expected
+
+    # 一括読み込みでも同じ順序になる
+    index.save()
+    loaded = TsvIndex(str(tmp_path), SlotAllocator("xml"), journal)
+    loaded.load()
+    assert loaded.relpaths("same") == expected
+
+    index.remove("000/001.xml")
+    assert index.relpaths("same") == expected[:1] + expected[2:]
+
+def test_journal_batches_and_recovers(tmp_path):
+    manager, nodes = make_nodes(str(tmp_path), 1)
+    manager = NodeManager(base_dir=str(tmp_path), flush_every=3)
+    # ロックを解放してもフラッシュせず、件数に達したらまとめて書き込む
+    for i in range(3):
+        with open(manager.map_path, encoding="utf-8") as f:
+            assert len(f.readlines()) == 2
+        manager.create_node("prompt", "response", g)
+    with open(manager.map_path, encoding="utf-8") as f:
+        assert len(f.readlines()) == 5
+
+    # 書き込み途中の行は捨てられ、ファイルから再登録される
+    with open(manager.map_path, "rb+") as f:
+        f.truncate(f.seek(0, os.SEEK_END) - 10)
+    manager = NodeManager(base_dir=str(tmp_path))
+    assert len(manager.tsv_entries) == 4
+    uuid, _ = manager.tsv_entries["000/003.xml"]
+    assert manager.get_node(uuid).relpath == "000/003.xml"
+    with open(manager.map_path, encoding="utf-8") as f:
+        assert f.read().endswith("\n")
+
+def test_journal_flushes_on_interval(tmp_path):
+    manager, nodes = make_nodes(str(tmp_path), 1)
+    manager.migrate_index("sqlite")
+    manager = NodeManager(base_dir=str(tmp_path), flush_every=2, flush_interval_ms=50)
+    for i in range(2):
+        manager.create_node("prompt", "response", g)
+    file = manager.journal.file
+    # ロックを取得し直してもファイルは開いたまま
+    for i in range(3):
+        manager.create_node("prompt", "response", g)
+    assert manager.journal.file is file and manager.journal.pending == 1
+    # 追記がなくてもタイマーでフラッシュされる
+    time.sleep(0.3)
+    assert manager.journal.pending == 0
+    with open(manager.map_path, encoding="utf-8") as f:
+        assert len(f.readlines()) == 7
+
+def test_parallel_rebuild(tmp_path):
+    manager, nodes = make_nodes(str(tmp_path), 150)
+    # 同じUUIDのファイルを複製して衝突を作る
+    for i in range(100):
+        with open(os.path.join(manager.data_dir, nodes[i].relpath), "rb") as f:
+            data = f.read()
+        os.makedirs(os.path.join(manager.data_dir, "005"), exist_ok=True)
+        with open(os.path.join(manager.data_dir, "005", f"{i:03}.xml"), "wb") as f:
+            f.write(data)
+    os.remove(manager.map_path)
+
+    sequential = NodeManager(base_dir=str(tmp_path), full_rescan=True, scan_workers=1)
+    os.remove(manager.map_path)
+    progress = []
+    parallel = NodeManager(
+        base_dir=str(tmp_path), full_rescan=True, scan_workers=4,
+        scan_progress=lambda done, total: progress.append((done, total)),
+    )
+    assert list(parallel.tsv_entries.items()) == list(sequential.tsv_entries.items())
+    assert dict(parallel.uuid_map.items()) == dict(sequential.uuid_map.items())
+    assert progress[-1] == (250, 250)
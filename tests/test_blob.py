@@ -0,0 +1,39 @@
+import os
+from vizprompt.core.blob import BlobStore
+from vizprompt.core.node import Node, LazyNode, NodeManager
+from test_base import g, make_nodes
+
+def test_blob_store_shares_identical_texts(tmp_path):
+    blobs = BlobStore(str(tmp_path))
+    ref = blobs.put("同じテキスト")
+    assert blobs.put("同じテキスト") == ref
+    assert len(os.listdir(tmp_path)) == 1
+    assert BlobStore(str(tmp_path)).get(ref) == "同じテキスト"
+
+def test_nodes_reference_shared_texts(tmp_path):
+    manager = NodeManager(base_dir=str(tmp_path), dedup=True, dedup_threshold=10)
+    prompt, response = "same prompt " * 10, "same response " * 10
+    a = manager.create_node(prompt, response, g)
+    b = manager.create_node(prompt, response, g)
+    c = manager.create_node("short", response, g)
+    assert a.contents[0]["ref"] == b.contents[0]["ref"]
+    assert "ref" not in c.contents[0]
+    blob_dir = os.path.join(str(tmp_path), "blobs")
+    assert sum(len(files) for _, _, files in os.walk(blob_dir)) == 2
+    with open(os.path.join(manager.data_dir, b.relpath), encoding="utf-8") as f:
+        assert prompt not in f.read()
+
+    manager = NodeManager(base_dir=str(tmp_path))
+    assert manager.get_contents([b.id, c.id]) == [
+        ("user", prompt), ("assistant", response), ("user", "short"), ("assistant", response),
+    ]
+    assert Node.load(manager.data_dir, a.relpath).contents[1]["text"] == response
+    lazy = LazyNode.load(manager.data_dir, c.relpath)
+    assert lazy.contents[1]["text"] == response and lazy.contents[0]["text"] == "short"
+
+def test_deduplicate_existing_nodes(tmp_path):
+    manager, nodes = make_nodes(str(tmp_path), 3)
+    assert manager.deduplicate(threshold=5) == (3, 3)
+    assert manager.deduplicate(threshold=5) == (0, 3)
+    manager = NodeManager(base_dir=str(tmp_path))
+    assert manager.get_contents([nodes[2].id]) == [("user", "prompt 2"), ("assistant", "response 2")]
@@ -0,0 +1,42 @@
+from vizprompt.core.cache import LRUCache
+from test_base import make_nodes
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(max_entries=2)
+    cache["a"] = 1
+    cache["b"] = 2
+    assert cache.get("a") == 1
+    cache["c"] = 3
+    assert "b" not in cache
+    assert cache.get("b") is None
+    assert cache.stats() == {"entries": 2, "bytes": 0, "pinned": 0, "hits": 1, "misses": 1, "evictions": 1}
+
+def test_lru_byte_budget_and_pins():
+    cache = LRUCache(max_bytes=10, sizeof=len)
+    cache.pin(["a"])
+    cache["a"] = "xxxx"
+    cache["b"] = "xxxx"
+    cache["c"] = "xxxx"
+    assert list(cache.entries) == ["a", "c"]
+    assert cache.bytes == 8
+
+    # 大きさが変わった値は取得時に測り直す
+    value = ["x"] * 4
+    cache["d"] = value
+    assert list(cache.entries) == ["a", "d"]
+    value.extend("xxxx")
+    assert cache.get("d") is value
+    assert cache.bytes == 12
+    cache.unpin()
+    assert list(cache.entries) == ["d"]
+
+def test_node_manager_cache_limit(tmp_path):
+    manager, nodes = make_nodes(str(tmp_path), 3)
+    assert len(manager.cache) == 3
+
+    from vizprompt.core.node import NodeManager
+    manager = NodeManager(base_dir=str(tmp_path), cache_entries=2)
+    for node in nodes:
+        assert manager.get_node(node.id).contents[1]["text"] == node.contents[1]["text"]
+    assert list(manager.cache.entries) == [nodes[1].id, nodes[2].id]
+    assert manager.cache.evictions == 1
@@ -0,0 +1,89 @@
+import os, multiprocessing
+from types import SimpleNamespace
+from vizprompt.core.node import NodeManager
+from vizprompt.core.flow import FlowManager
+
+PROCESSES = 4
+NODES = 25
+
+g = SimpleNamespace(
+    model="dummy",
+    prompt_count=1,
+    prompt_duration=0.1,
+    eval_count=2,
+    eval_duration=0.2,
+)
+
+def worker(base_dir, n, backend, flush_every, barrier):
+    node_manager = NodeManager(base_dir=base_dir, backend=backend, flush_every=flush_every)
+    flow_manager = FlowManager(base_dir=base_dir, backend=backend)
+    # 作成が重なるよう、全プロセスの起動を待つ
+    barrier.wait()
+    flow = flow_manager.create_flow(name=f"worker {n}")
+    prev = None
+    for i in range(NODES):
+        node = node_manager.create_node(f"prompt {n}-{i}", f"response {n}-{i}", g)
+        flow.connect(prev, node.id)
+        flow.save()
+        prev = node.id
+    # fork した子プロセスでは atexit が呼ばれないため、未フラッシュの追記を書き込む
+    node_manager.journal.close()
+
+def run_workers(base_dir, backend=None, flush_every=1):
+    ctx = multiprocessing.get_context("fork")
+    barrier = ctx.Barrier(PROCESSES)
+    procs = [ctx.Process(target=worker, args=(base_dir, n, backend, flush_every, barrier)) for n in range(PROCESSES)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+        assert p.exitcode == 0
+
+def check_index(manager, count):
+    with open(manager.map_path, encoding="utf-8") as f:
+        lines = f.read().splitlines()[1:]
+    relpaths = [line.split("\t")[0] for line in lines]
+    uuids = [line.split("\t")[1] for line in lines]
+    assert len(lines) == count
+    assert len(set(relpaths)) == count
+    assert len(set(uuids)) == count
+    for relpath, uuid in zip(relpaths, uuids):
+        path = os.path.join(manager.data_dir, relpath)
+        assert manager.get_uuid_and_timestamp_from_file(path)[0] == uuid
+
+def test_parallel_create(tmp_path):
+    base_dir = str(tmp_path)
+    # 起動時の整合性チェックも並行して行われるよう、空の状態から開始
+    run_workers(base_dir)
+
+    node_manager = NodeManager(base_dir=base_dir, full_rescan=True)
+    flow_manager = FlowManager(base_dir=base_dir, full_rescan=True)
+    check_index(node_manager, PROCESSES * NODES)
+    check_index(flow_manager, PROCESSES)
+    for _, (flow_id, _) in flow_manager.tsv_entries.items():
+        flow = flow_manager.get_flow(flow_id)
+        assert len(flow.nodes) == NODES
+        assert all(node_id in node_manager.uuid_map for node_id in flow.nodes)
+
+def test_parallel_create_sqlite(tmp_path):
+    base_dir = str(tmp_path)
+    NodeManager(base_dir=base_dir, backend="sqlite")
+    FlowManager(base_dir=base_dir, backend="sqlite")
+    run_workers(base_dir)
+
+    node_manager = NodeManager(base_dir=base_dir)
+    assert node_manager.index.name == "sqlite"
+    assert len(node_manager.tsv_entries) == PROCESSES * NODES
+    check_index(node_manager, PROCESSES * NODES)
+
+def test_parallel_create_batched(tmp_path):
+    base_dir = str(tmp_path)
+    # 他のプロセスがまだフラッシュしていないノードを登録しても、index.tsv の行は重複しない
+    run_workers(base_dir, flush_every=10)
+    # 起動時の整合性チェックで書き直される前の index.tsv を確認
+    with open(os.path.join(base_dir, "nodes", "index.tsv"), encoding="utf-8") as f:
+        relpaths = [line.split("\t")[0] for line in f.read().splitlines()[1:]]
+    assert len(relpaths) == len(set(relpaths)) == PROCESSES * NODES
+
+    node_manager = NodeManager(base_dir=base_dir)
+    check_index(node_manager, PROCESSES * NODES)
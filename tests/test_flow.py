@@ -0,0 +1,374 @@
+import pytest, random, json
+from datetime import datetime
+from vizprompt.core import flow as flow_module
+from vizprompt.core.flow import Flow, yaml as flow_yaml
+
+def make_flow(nodes, connections):
+    timestamp = datetime(2025, 1, 1).astimezone()
+    return Flow(
+        id="dummy",
+        name="test",
+        created=timestamp,
+        updated=timestamp,
+        description="",
+        nodes=list(nodes),
+        connections=connections,
+        data_dir=".",
+        relpath="dummy.yaml",
+    )
+
+def test_connect_rejects_cycles():
+    flow = make_flow("abcd", [("a", "b"), ("b", "c"), ("a", "d")])
+    with pytest.raises(Exception, match="循環"):
+        flow.connect("c", "a")
+    with pytest.raises(Exception, match="循環"):
+        flow.connect("b", "b")
+    flow.connect("d", "c")
+    assert list(flow.connections)[-1] == ("d", "c")
+    assert flow.graph_fwd == {"a": ["b", "d"], "b": ["c"], "d": ["c"]}
+
+def test_load_connections_skips_cycle_edges(capsys):
+    flow = make_flow("abc", [("a", "b"), ("b", "c"), ("c", "a"), ("a", "b"), ("c", "d")])
+    assert list(flow.connections) == [("a", "b"), ("b", "c"), ("c", "d")]
+    assert flow.nodes == ["a", "b", "c", "d"]
+    assert flow.updated == datetime(2025, 1, 1).astimezone()
+    assert "循環" in capsys.readouterr().err
+
+def test_load_connections_large_chain():
+    ids = [str(i) for i in range(20000)]
+    flow = make_flow(ids, list(zip(ids, ids[1:])))
+    assert len(flow.connections) == len(ids) - 1
+    with pytest.raises(Exception, match="循環"):
+        flow.connect(ids[-1], ids[0])
+    assert flow.get_history(ids[100]) == ids[:101]
+
+def test_disconnect_and_remove_node():
+    flow = make_flow("abcd", [("a", "b"), ("b", "c"), ("a", "d"), ("d", "c")])
+    flow.disconnect("a", "d")
+    assert list(flow.connections) == [("a", "b"), ("b", "c"), ("d", "c")]
+    assert "d" not in flow.graph_rev
+    assert [n for n in flow.nodes if n not in flow.graph_rev] == ["a", "d"]
+
+    flow.remove_node("b")
+    assert list(flow.connections) == [("d", "c")]
+    assert flow.nodes == ["a", "c", "d"]
+    assert flow.node_index == {"a": 1, "c": 2, "d": 3}
+    assert flow.graph_fwd == {"d": ["c"]} and flow.graph_rev == {"c": ["d"]}
+    assert flow.to_dict()["connections"] == [{"from": 3, "to": 2}]
+
+def test_connect_from_none_adds_node_only():
+    flow = make_flow("", [])
+    flow.connect(None, "a")
+    flow.connect("a", "b")
+    assert list(flow.connections) == [("a", "b")]
+    assert flow.get_history("b") == ["a", "b"]
+
+def test_history_with_outside_children():
+    flow = make_flow("abcd", [("a", "b"), ("b", "c"), ("a", "d")])
+    assert flow.get_history("b") == ["a", "b"]
+    assert flow.get_history("d") == ["a", "d"]
+
+def test_history_cache_append_and_invalidate():
+    flow = make_flow("", [])
+    flow.connect(None, "a")
+    assert flow.get_history("a") == ["a"]
+    for prev, curr in zip("abc", "bcd"):
+        flow.connect(prev, curr)
+        # 親の履歴がキャッシュにあれば計算せずに延長する
+        assert curr in flow.histories
+    history = flow.get_history("d")
+    assert history == ["a", "b", "c", "d"]
+    history.append("x")
+    assert flow.get_history("d") == ["a", "b", "c", "d"]
+
+    # 祖先の変更で子孫のキャッシュだけを削除する
+    flow.connect("a", "e")
+    flow.get_history("e")
+    flow.connect("e", "c")
+    assert "e" in flow.histories and "b" in flow.histories
+    assert "c" not in flow.histories and "d" not in flow.histories
+    assert flow.get_history("d") == ["a", "b", "e", "c", "d"]
+    flow.disconnect("b", "c")
+    assert flow.get_history("d") == ["a", "e", "c", "d"]
+    flow.remove_node("e")
+    assert flow.get_history("d") == ["c", "d"]
+
+def test_history_cache_matches_fresh_flow():
+    random.seed(1)
+    flow = make_flow("", [])
+    names = [f"n{i}" for i in range(40)]
+    for _ in range(300):
+        op = random.random()
+        a, b = random.sample(names, 2)
+        if op < 0.6:
+            try:
+                flow.connect(random.choice(flow.nodes) if flow.nodes and op < 0.4 else a, b)
+            except Exception:
+                pass
+        elif op < 0.8 and flow.connections:
+            flow.disconnect(*random.choice(list(flow.connections)))
+        elif flow.nodes:
+            flow.remove_node(random.choice(flow.nodes))
+        for n in random.sample(flow.nodes, min(3, len(flow.nodes))):
+            fresh = make_flow(flow.nodes, list(flow.connections))
+            assert flow.get_history(n) == fresh.get_history(n)
+
+def old_histories(flow):
+    """
+    Union-Find 導入前の get_histories（比較用、ノードIDの隣接リストで計算）
+    """
+    starts = [n for n in flow.nodes if n not in flow.graph_rev]
+    visited = set()
+    routes = []
+    for start in starts:
+        route = set()
+        stack = [start]
+        while stack:
+            n = stack.pop()
+            if n not in route:
+                route.add(n)
+                if n not in visited:
+                    stack.extend(flow.graph_fwd.get(n, []))
+        routes.append(route)
+        visited.update(route)
+    merged = []
+    for s in routes:
+        s = s.copy()
+        found = [m for m in merged if s & m]
+        for m in found:
+            s |= m
+            merged.remove(m)
+        merged.append(s)
+    histories = []
+    for s in merged:
+        in_degree = {n: 0 for n in s}
+        for n in s:
+            for m in flow.graph_fwd.get(n, []):
+                if m in s:
+                    in_degree[m] += 1
+        history = []
+        for start in [n for n in flow.nodes if in_degree.get(n, -1) == 0]:
+            stack = [start]
+            while stack:
+                n = stack.pop()
+                history.append(n)
+                for m in reversed(flow.graph_fwd.get(n, [])):
+                    in_degree[m] -= 1
+                    if in_degree[m] == 0:
+                        stack.append(m)
+        histories.append(history)
+    return histories
+
+def test_histories_match_old_implementation():
+    random.seed(2)
+    for _ in range(200):
+        names = [f"n{i}" for i in range(random.randint(1, 30))]
+        order = names[:]
+        random.shuffle(order)
+        # order の順にだけ接続して循環を作らない
+        connections = []
+        for _ in range(random.randint(0, 40)):
+            i, j = sorted(random.sample(range(len(order)), 2)) if len(order) > 1 else (0, 0)
+            if i != j:
+                connections.append((order[i], order[j]))
+        flow = make_flow(names, connections)
+        assert flow.get_histories() == old_histories(flow)
+        assert flow.get_routes() == [set(h) for h in old_histories(flow)]
+
+def test_save_appends_log_and_load_replays(tmp_path):
+    flow = make_flow("", [])
+    flow.data_dir = str(tmp_path)
+    flow.save()
+    assert flow.revision == 1
+    for prev, curr in zip([None, "a", "b"], "abc"):
+        flow.connect(prev, curr)
+        flow.save()
+    flow.disconnect("b", "c")
+    flow.connect("a", "c")
+    flow.save()
+    assert flow.logged == 5
+    with open(tmp_path / "dummy.log", encoding="utf-8") as f:
+        assert f.readline() == "revision\t1\n"
+    # YAMLは最初の保存のまま
+    with open(tmp_path / "dummy.yaml", encoding="utf-8") as f:
+        assert "nodes: []" in f.read()
+
+    # 書きかけの行は無視する
+    with open(tmp_path / "dummy.log", "a", encoding="utf-8") as f:
+        f.write("2025-01-01T00:00:00+00:00\tremove")
+    loaded = Flow.load(str(tmp_path), "dummy.yaml")
+    assert loaded.nodes == ["a", "b", "c"]
+    assert list(loaded.connections) == [("a", "b"), ("a", "c")]
+    assert loaded.updated == flow.updated
+    assert loaded.logged == 5 and not loaded.pending
+
+    loaded.remove_node("b")
+    loaded.save(compact=True)
+    assert loaded.revision == 2 and loaded.logged == 0
+    with open(tmp_path / "dummy.log", encoding="utf-8") as f:
+        assert f.read() == "revision\t2\n"
+    reloaded = Flow.load(str(tmp_path), "dummy.yaml")
+    assert reloaded.nodes == ["a", "c"]
+    assert list(reloaded.connections) == [("a", "c")]
+
+def test_load_skips_malformed_log_lines(tmp_path, capsys):
+    flow = make_flow("", [])
+    flow.data_dir = str(tmp_path)
+    flow.save()
+    flow.connect(None, "a")
+    flow.save()
+    with open(tmp_path / "dummy.log", "a", encoding="utf-8") as f:
+        f.write("garbage\n")
+        f.write("yesterday\tconnect\ta\tx\n")
+    flow.connect("a", "b")
+    flow.save()
+
+    loaded = Flow.load(str(tmp_path), "dummy.yaml")
+    assert loaded.nodes == ["a", "b"]
+    assert list(loaded.connections) == [("a", "b")]
+    assert loaded.updated == flow.updated
+    assert loaded.logged == 4
+    assert capsys.readouterr().err.count("\n") == 2
+
+def test_compact_keeps_changes_of_other_processes(tmp_path):
+    flow = make_flow("a", [])
+    flow.data_dir = str(tmp_path)
+    flow.save()
+    first = Flow.load(str(tmp_path), "dummy.yaml")
+    second = Flow.load(str(tmp_path), "dummy.yaml")
+
+    # 他のプロセスが編集ログに追記した操作を畳み込みで失わない
+    first.connect("a", "b")
+    first.save()
+    second.connect("a", "c")
+    second.save(compact=True)
+    loaded = Flow.load(str(tmp_path), "dummy.yaml")
+    assert loaded.nodes == ["a", "b", "c"] and loaded.revision == 2
+
+    # 他のプロセスが畳み込んだ新しいリビジョンも失わない
+    first.connect("b", "d")
+    first.save(compact=True)
+    second.connect("c", "e")
+    second.save()
+    loaded = Flow.load(str(tmp_path), "dummy.yaml")
+    assert loaded.nodes == ["a", "b", "c", "d", "e"]
+    assert list(loaded.connections) == [("a", "b"), ("a", "c"), ("b", "d"), ("c", "e")]
+    assert loaded.revision == 4 and second.revision == 4 and second.logged == 0
+
+def test_log_of_old_revision_is_ignored(tmp_path):
+    flow = make_flow("ab", [("a", "b")])
+    flow.data_dir = str(tmp_path)
+    flow.save()
+    flow.connect("b", "c")
+    flow.save()
+    # YAMLを書き直した直後に中断した場合（ログは古いリビジョンのまま）
+    flow.revision += 1
+    with open(tmp_path / "dummy.yaml", "w", encoding="utf-8") as f:
+        flow_yaml.dump(flow.to_dict(), f)
+    loaded = Flow.load(str(tmp_path), "dummy.yaml")
+    assert loaded.nodes == ["a", "b", "c"] and loaded.logged == 0
+    # 次の保存ではログを作り直す
+    loaded.connect("c", "d")
+    loaded.save()
+    assert loaded.revision == 3 and loaded.logged == 0
+    assert Flow.load(str(tmp_path), "dummy.yaml").nodes == ["a", "b", "c", "d"]
+
+def test_log_is_compacted(tmp_path, monkeypatch):
+    monkeypatch.setattr(flow_module, "LOG_COMPACT_OPS", 3)
+    flow = make_flow("", [])
+    flow.data_dir = str(tmp_path)
+    prev = None
+    for curr in "abcde":
+        flow.connect(prev, curr)
+        flow.save()
+        prev = curr
+    assert flow.revision == 2 and flow.logged == 0
+    assert Flow.load(str(tmp_path), "dummy.yaml").get_history("e") == list("abcde")
+
+def test_load_uses_fresh_sidecar(tmp_path):
+    flow = make_flow("abc", [("a", "b"), ("a", "c")])
+    flow.data_dir = str(tmp_path)
+    flow.save()
+    sidecar = tmp_path / "dummy.json"
+    with open(sidecar, encoding="utf-8") as f:
+        data = json.load(f)
+    assert data["nodes"] == ["a", "b", "c"] and data["connections"] == [[1, 2], [1, 3]]
+
+    # JSONが新しければYAMLは読まない
+    data["name"] = "from json"
+    with open(sidecar, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    loaded = Flow.load(str(tmp_path), "dummy.yaml")
+    assert loaded.name == "from json"
+    assert list(loaded.connections) == [("a", "b"), ("a", "c")]
+
+    # YAMLを手で編集すればYAMLを読み込み、JSONを作り直す
+    path = tmp_path / "dummy.yaml"
+    path.write_text(path.read_text(encoding="utf-8").replace("name: test", "name: edited"), encoding="utf-8")
+    assert Flow.load(str(tmp_path), "dummy.yaml").name == "edited"
+    with open(sidecar, encoding="utf-8") as f:
+        assert json.load(f)["name"] == "edited"
+
+def test_sidecar_is_not_written_after_concurrent_compaction(tmp_path, monkeypatch):
+    flow = make_flow("a", [])
+    flow.data_dir = str(tmp_path)
+    flow.save()
+    other = Flow.load(str(tmp_path), "dummy.yaml")
+    (tmp_path / "dummy.json").unlink()
+
+    # YAMLを読み込んでからJSONを書き込むまでの間に、他のプロセスが畳み込む
+    save_sidecar = Flow.save_sidecar
+    compactors = [other]
+    def compact_first(self, *args):
+        if compactors and self is not other:
+            compactors.pop().connect("a", "b")
+            other.save(compact=True)
+        save_sidecar(self, *args)
+    monkeypatch.setattr(Flow, "save_sidecar", compact_first)
+    assert Flow.load(str(tmp_path), "dummy.yaml").nodes == ["a"]
+    monkeypatch.undo()
+
+    loaded = Flow.load(str(tmp_path), "dummy.yaml")
+    assert loaded.nodes == ["a", "b"] and loaded.revision == 2
+
+def test_partial_load_keeps_unloaded_part(tmp_path):
+    flow = make_flow("abcdexy", [("a", "b"), ("b", "c"), ("a", "d"), ("d", "e"), ("x", "y")])
+    flow.data_dir = str(tmp_path)
+    flow.save()
+    loaded = Flow.load(str(tmp_path), "dummy.yaml", ["c"])
+    assert loaded.partial and loaded.nodes == ["a", "b", "c"]
+    assert (loaded.node_count, loaded.edge_count, loaded.last_node) == (7, 5, "y")
+    assert loaded.get_history("c") == ["a", "b", "c"]
+
+    # 追加したノードは読み込んだ範囲に加え、編集ログの再生後にも選ぶ
+    loaded.connect("c", "f")
+    loaded.save()
+    loaded = Flow.load(str(tmp_path), "dummy.yaml", ["f"])
+    assert loaded.nodes == ["a", "b", "c", "f"] and loaded.logged == 1
+    assert (loaded.node_count, loaded.last_node) == (8, "f")
+
+    # 読み込んでいないノードを操作すれば、その祖先を読み込む
+    loaded.connect("e", "g")
+    assert loaded.partial and loaded.nodes == list("abcdefg")
+    assert loaded.get_history("g") == list("adeg")
+    loaded.save(compact=True)
+    assert loaded.partial and loaded.logged == 0
+    full = Flow.load(str(tmp_path), "dummy.yaml")
+    assert full.nodes == list("abcdexyfg")
+    assert full.get_histories() == [list("abcfdeg"), list("xy")]
+
+def test_partial_load_by_generations(tmp_path):
+    flow = make_flow("abcd", [("a", "b"), ("b", "c"), ("a", "d")])
+    flow.data_dir = str(tmp_path)
+    flow.save()
+    loaded = Flow.load(str(tmp_path), "dummy.yaml", ["c"], generations=2)
+    assert loaded.nodes == ["b", "c"] and loaded.border == {"b"}
+    assert loaded.get_history("c") == ["b", "c"]
+    # 親を読み込んでいないノードの前を求めれば全体を読み込む
+    assert loaded.get_previous("b") == ["a"]
+    assert not loaded.partial and loaded.nodes == list("abcd")
+
+    loaded = Flow.load(str(tmp_path), "dummy.yaml", ["c"], generations=2)
+    loaded.remove_node("a")
+    loaded.save()
+    assert list(Flow.load(str(tmp_path), "dummy.yaml").connections) == [("b", "c")]
@@ -0,0 +1,46 @@
+import random
+from vizprompt.core import graph as graph_module
+from vizprompt.core.graph import Graph
+
+def test_graph_matches_adjacency_lists(monkeypatch):
+    # 作り直しも頻繁に起きるよう、しきい値を小さくする
+    monkeypatch.setattr(graph_module, "REBUILD_MIN", 4)
+    random.seed(3)
+    size = 8
+    edges = {}  # (a, b) -> None（追加順）
+    graph = Graph(size)
+    for _ in range(500):
+        op = random.random()
+        if op < 0.6:
+            a, b = random.randrange(size), random.randrange(size)
+            if (a, b) not in edges:
+                edges[(a, b)] = None
+                graph.add_edge(a, b)
+        elif op < 0.9 and edges:
+            a, b = random.choice(list(edges))
+            del edges[(a, b)]
+            graph.remove_edge(a, b)
+        elif op < 0.95:
+            graph.add_node()
+            size += 1
+        elif size > 1:
+            k = random.randrange(size)
+            graph.remove_node(k)
+            size -= 1
+            edges = {(a - (a > k), b - (b > k)): None for a, b in edges if k not in (a, b)}
+        assert graph.edges() == list(edges)
+        assert len(graph) == len(edges)
+        for n in range(size):
+            assert graph.next(n) == [b for a, b in edges if a == n]
+            assert graph.prev(n) == [a for a, b in edges if b == n]
+        assert graph.in_degrees() == [len(graph.prev(n)) for n in range(size)]
+        for a, b in edges:
+            assert graph.has_edge(a, b)
+
+def test_is_acyclic():
+    assert Graph(3, [(0, 1), (1, 2)]).is_acyclic()
+    assert Graph(3, [(2, 1), (1, 0)]).is_acyclic()
+    assert not Graph(3, [(0, 1), (1, 2), (2, 0)]).is_acyclic()
+    graph = Graph(2, [(1, 0)])
+    graph.add_edge(0, 1)
+    assert not graph.is_acyclic()
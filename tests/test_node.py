@@ -0,0 +1,136 @@
+import io, os, shutil, pytest
+from datetime import datetime, timezone, timedelta
+from vizprompt.core.node import Node, LazyNode, NodeManager, json_to_xml, iterparse_headers
+from test_base import make_nodes, g
+
+def make_node(text, summary="", tags=(), model="dummy"):
+    timestamp = datetime(2025, 1, 2, 3, 4, 5, 678901, tzinfo=timezone(timedelta(hours=9)))
+    return Node(
+        id="12345678-1234-1234-1234-123456789abc",
+        timestamp=timestamp,
+        contents=[
+            {"role": "user", "count": 3, "duration": 0.5, "text": text},
+            {"role": "assistant", "count": 0, "duration": 0, "text": ""},
+        ],
+        model=model,
+        summary=summary,
+        summary_updated=bool(summary),
+        summary_last_built=timestamp,
+        tags=list(tags),
+        data_dir="",
+        relpath="000/000.xml",
+    )
+
+def minidom_xml(node):
+    doc = json_to_xml(node.to_dict())
+    return doc.toprettyxml(encoding='utf-8', indent='').decode('utf-8')
+
+def test_to_xml_matches_minidom():
+    nodes = [
+        make_node("hello"),
+        make_node("1 < 2 && 3 > 2\n\n  indented\n", summary="要約 <b>", tags=["a", "b&c"]),
+        make_node("", model=""),
+        make_node("surrogate \udc80"),
+    ]
+    for node in nodes:
+        assert node.to_xml() == minidom_xml(node)
+
+def test_to_xml_escapes_text():
+    node = make_node("x", model='a "quoted" <model>')
+    assert '<model>a &quot;quoted&quot; &lt;model&gt;</model>' in node.to_xml()
+
+def test_lazy_node_loads_text_on_demand(tmp_path):
+    node = make_node("1 < 2\n", summary="summary", tags=["a"])
+    node.data_dir = str(tmp_path)
+    os.makedirs(tmp_path / "000")
+    node.save()
+
+    full = Node.load(node.data_dir, node.relpath)
+    lazy = LazyNode.load(node.data_dir, node.relpath)
+    for name in ["id", "timestamp", "model", "summary", "summary_updated", "summary_last_built", "tags"]:
+        assert getattr(lazy, name) == getattr(full, name)
+    assert [c["count"] for c in lazy.contents] == [3, 0]
+    assert not any(dict.__contains__(c, "text") for c in lazy.contents)
+
+    assert lazy.contents[0]["text"] == "1 < 2\n"
+    assert lazy.contents[1].get("text") == ""
+    assert lazy.to_xml() == full.to_xml()
+
+    # 空の model も Node.load と同じく空文字列
+    node = make_node("x", model="")
+    node.data_dir = str(tmp_path)
+    node.save()
+    full = Node.load(node.data_dir, node.relpath)
+    lazy = LazyNode.load(node.data_dir, node.relpath)
+    assert lazy.model == full.model == ""
+    assert lazy.to_xml() == full.to_xml()
+
+def test_iterparse_headers_reads_in_chunks():
+    data = make_node("x]] y] <content>" * 20, summary="s", tags=["a"]).to_xml().encode("utf-8")
+    def events(chunk_size):
+        reads = []
+        class File(io.BytesIO):
+            def read(self, size=-1):
+                reads.append(size)
+                return super().read(size)
+        result = []
+        for event, elem in iterparse_headers(File(data), chunk_size):
+            result.append((event, elem.tag, dict(elem.attrib), elem.text if event == "end" else None))
+            if event == "end" and elem.tag == "metadata":
+                break
+        assert all(0 < size <= chunk_size for size in reads)
+        return result
+    expected = events(len(data))
+    assert [tag for _, tag, _, _ in expected if tag == "content"] == ["content"] * 4
+    for chunk_size in range(1, 64):
+        assert events(chunk_size) == expected
+
+def test_get_nodes_keeps_order(tmp_path):
+    manager, nodes = make_nodes(str(tmp_path), 12)
+    manager = NodeManager(base_dir=str(tmp_path))
+    manager.get_node(nodes[3].id)
+    ids = [node.id for node in reversed(nodes)] + [nodes[0].id]
+    loaded = manager.get_nodes(ids)
+    assert [node.id for node in loaded] == ids
+    assert loaded[-1] is loaded[-2]
+    contents = manager.get_contents(ids[:3])
+    assert contents[1] == ("assistant", "response 11")
+    assert all(node.texts_loaded() for node in manager.get_nodes(ids, lazy=False))
+    with pytest.raises(FileNotFoundError):
+        manager.get_nodes([nodes[0].id, "missing"])
+
+def test_get_nodes_with_sqlite_backend(tmp_path):
+    # SQLiteの接続は作成したスレッドでしか使えないため、並列の読み込みでもインデックスは引かない
+    manager, nodes = make_nodes(str(tmp_path), 12)
+    manager.migrate_index("sqlite")
+    manager = NodeManager(base_dir=str(tmp_path), scan_workers=4)
+    assert manager.index.name == "sqlite"
+    ids = [node.id for node in nodes]
+    assert [node.id for node in manager.get_nodes(ids, lazy=False)] == ids
+
+def test_compressed_contents_round_trip(tmp_path):
+    long_text = "長いテキスト <code> & \n" * 2000
+    manager = NodeManager(base_dir=str(tmp_path), compression="zlib", compress_threshold=1000)
+    node = manager.create_node("short", long_text, g)
+    with open(os.path.join(manager.data_dir, node.relpath), encoding="utf-8") as f:
+        xml = f.read()
+    assert '<content role="user" count="1" duration="0.1" rate="10.0"><![CDATA[\nshort\n]]></content>' in xml
+    assert 'encoding="zlib"' in xml and len(xml) < len(long_text)
+
+    manager = NodeManager(base_dir=str(tmp_path))
+    assert Node.load(manager.data_dir, node.relpath).contents[1]["text"] == long_text
+    assert manager.get_node(node.id).contents[1]["text"] == long_text
+
+    assert manager.recompress("lzma", 1000) == (1, 1)
+    assert manager.recompress("lzma", 1000) == (0, 1)
+    assert manager.recompress(None) == (1, 1)
+    assert 'encoding="lzma"' not in open(os.path.join(manager.data_dir, node.relpath), encoding="utf-8").read()
+    assert manager.get_contents([node.id])[1] == ("assistant", long_text)
+
+    # UUIDが衝突したファイルもすべて保存し直す
+    os.makedirs(os.path.join(manager.data_dir, "001"))
+    shutil.copy(os.path.join(manager.data_dir, node.relpath), os.path.join(manager.data_dir, "001", "000.xml"))
+    manager = NodeManager(base_dir=str(tmp_path))
+    assert manager.recompress("zlib", 1000) == (2, 2)
+    for relpath in manager.uuid_map[node.id]:
+        assert 'encoding="zlib"' in open(os.path.join(manager.data_dir, relpath), encoding="utf-8").read()
@@ -0,0 +1,44 @@
+import os
+from datetime import datetime, timedelta
+from vizprompt.core.node import NodeManager
+from test_base import make_nodes, g
+
+def test_pack_moves_old_nodes_to_segment(tmp_path):
+    manager, nodes = make_nodes(str(tmp_path), 3)
+    count, segment = manager.pack(nodes[1].timestamp + timedelta(microseconds=1))
+    assert (count, segment) == (2, "000001.seg")
+    assert not os.path.exists(os.path.join(manager.data_dir, "000/000.xml"))
+    assert len(manager.tsv_entries) == 1
+
+    # 別のインスタンスからもパックから読み込める
+    manager = NodeManager(base_dir=str(tmp_path))
+    node = manager.get_node(nodes[0].id)
+    assert node.relpath == "packs/000001.seg#0"
+    assert node.contents[0]["text"] == "prompt 0"
+    assert manager.get_contents([nodes[1].id, nodes[2].id]) == [
+        ("user", "prompt 1"), ("assistant", "response 1"),
+        ("user", "prompt 2"), ("assistant", "response 2"),
+    ]
+
+    # 空いたスロットは新しいノードに使われる
+    assert manager.create_node("new", "node", g).relpath == "000/000.xml"
+    assert manager.pack(datetime.now().astimezone() - timedelta(days=1)) == (0, None)
+
+def test_pack_keeps_priority_of_collisions(tmp_path):
+    manager, nodes = make_nodes(str(tmp_path), 1)
+    # 同じUUIDで古いタイムスタンプのファイルを作って衝突させる
+    path = os.path.join(manager.data_dir, nodes[0].relpath)
+    with open(path, encoding="utf-8") as f:
+        data = f.read()
+    old = (nodes[0].timestamp - timedelta(days=1)).isoformat()
+    data = data.replace(nodes[0].timestamp.isoformat(), old).replace("prompt 0", "OLD COPY")
+    os.makedirs(os.path.join(manager.data_dir, "001"))
+    with open(os.path.join(manager.data_dir, "001", "000.xml"), "w", encoding="utf-8") as f:
+        f.write(data)
+
+    manager = NodeManager(base_dir=str(tmp_path))
+    assert manager.get_node(nodes[0].id).contents[0]["text"] == "prompt 0"
+    assert manager.pack(datetime.now().astimezone()) == (2, "000001.seg")
+    manager = NodeManager(base_dir=str(tmp_path))
+    assert nodes[0].id not in manager.uuid_map
+    assert manager.get_node(nodes[0].id).contents[0]["text"] == "prompt 0"
@@ -0,0 +1,96 @@
+import os
+from vizprompt.core import summary as summary_module
+from vizprompt.core.flow import FlowManager, FLOW_SORT_KEYS
+from test_base import make_nodes
+
+def make_flows(base_dir, sizes):
+    flow_manager = FlowManager(base_dir=base_dir)
+    for i, size in enumerate(sizes):
+        flow = flow_manager.create_flow(name=f"flow\t{i}")
+        prev = None
+        for j in range(size):
+            flow.connect(prev, f"n{i}-{j}")
+            flow.save()
+            prev = f"n{i}-{j}"
+    return flow_manager
+
+def test_summaries_follow_saves(tmp_path):
+    make_flows(str(tmp_path), [2, 0, 3])
+    # 別のプロセスから見たときと同じく、フローを読み込まずに一覧を作る
+    flow_manager = FlowManager(base_dir=str(tmp_path))
+    summaries = flow_manager.get_summaries()
+    assert len(flow_manager.cache) == 0
+    assert [(n, s["name"], s["nodes"], s["edges"], s["head"]) for n, _, s in summaries] == [
+        (1, "flow 0", 2, 1, "n0-1"),
+        (2, "flow 1", 0, 0, ""),
+        (3, "flow 2", 3, 2, "n2-2"),
+    ]
+    summaries.sort(key=FLOW_SORT_KEYS["nodes"], reverse=True)
+    assert [n for n, _, _ in summaries] == [3, 1, 2]
+
+    flow = flow_manager.get_flow(summaries[0][2]["id"])
+    flow.connect("n2-2", "n2-3")
+    flow.save()
+    assert flow_manager.get_summaries()[2][2]["nodes"] == 4
+
+def test_missing_summaries_are_rebuilt(tmp_path):
+    make_flows(str(tmp_path), [1, 2])
+    os.remove(tmp_path / "flows" / "summary.tsv")
+    flow_manager = FlowManager(base_dir=str(tmp_path))
+    assert [s["nodes"] for _, _, s in flow_manager.get_summaries()] == [1, 2]
+    assert len(FlowManager(base_dir=str(tmp_path)).get_summaries()) == 2
+
+def test_summaries_are_compacted(tmp_path, monkeypatch):
+    monkeypatch.setattr(summary_module, "COMPACT_MARGIN", 0)
+    flow_manager = make_flows(str(tmp_path), [5, 5])
+    summaries = flow_manager.summaries
+    summaries.refresh()
+    assert summaries.lines == 2
+    with open(summaries.path, encoding="utf-8") as f:
+        assert len(f.readlines()) == 3
+    assert [s["nodes"] for _, _, s in flow_manager.get_summaries()] == [5, 5]
+
+def test_refs_follow_saves(tmp_path):
+    flow_manager = make_flows(str(tmp_path), [2, 3])
+    ids = [id for id, _ in flow_manager.tsv_entries.values()]
+    # 逆引きインデックスは最初に参照したときにすべてのフローから作る
+    assert not flow_manager.refs.exists()
+    assert flow_manager.get_flows_of_node("n0-1") == [ids[0]]
+
+    flow = flow_manager.get_flow(ids[1])
+    flow.connect("n1-2", "n0-1")
+    flow.remove_node("n1-0")
+    flow.save()
+    # 別のプロセスからは追記された行だけを読み込む
+    flow_manager = FlowManager(base_dir=str(tmp_path))
+    assert flow_manager.get_flows_of_node("n0-1") == ids
+    assert flow_manager.get_flows_of_node("n1-0") == []
+    assert len(flow_manager.cache) == 0
+    with open(flow_manager.refs.path, encoding="utf-8") as f:
+        assert f.readlines()[-2:] == [f"n0-1\t{ids[1]}\t+\n", f"n1-0\t{ids[1]}\t-\n"]
+
+    os.remove(flow_manager.refs.path)
+    assert FlowManager(base_dir=str(tmp_path)).get_flows_of_node("n0-1") == ids
+
+def test_orphan_nodes(tmp_path):
+    node_manager, nodes = make_nodes(str(tmp_path), 3)
+    flow_manager = FlowManager(base_dir=str(tmp_path))
+    flow = flow_manager.create_flow(name="flow")
+    flow.connect(nodes[0].id, nodes[2].id)
+    flow.save()
+    assert node_manager.get_orphans(flow_manager) == [nodes[1].id]
+
+def test_partial_flow_keeps_summary(tmp_path):
+    flow_manager = make_flows(str(tmp_path), [3])
+    id = next(iter(flow_manager.tsv_entries.values()))[0]
+    flow_manager = FlowManager(base_dir=str(tmp_path))
+    head = flow_manager.get_last_node(id)
+    flow = flow_manager.get_flow(id, [head], generations=1)
+    assert head == "n0-2" and flow.nodes == ["n0-2"]
+    flow.connect("n0-2", "n0-3")
+    flow.save()
+    s = flow_manager.get_summaries()[0][2]
+    assert (s["nodes"], s["edges"], s["head"]) == (4, 3, "n0-3")
+    # 全体を求めればキャッシュの部分読み込みを広げる
+    assert flow_manager.get_flow(id) is flow and not flow.partial
+    assert flow.nodes == ["n0-0", "n0-1", "n0-2", "n0-3"]
@@ -1,7 +1,21 @@
 '''VizPromptのコマンドラインインターフェース'''
 import argparse
+from ..core.index import INDEX_BACKENDS
+from ..core.node import ENCODINGS, COMPRESS_THRESHOLD, DEDUP_THRESHOLD
+from ..core.flow import FLOW_SORT_KEYS
 
 parser = argparse.ArgumentParser(description="VizPrompt CLI")
+parser.add_argument("--full-rescan", action="store_true", help="前回走査結果を使わず全フォルダを走査します")
+parser.add_argument("--flush-every", type=int, default=1, metavar="N", help="インデックスへの追記をN件ごとにフラッシュします")
+parser.add_argument("--flush-interval", type=int, metavar="MS", help="最初の未フラッシュの追記からMSミリ秒後にフラッシュします")
+parser.add_argument("--fsync", action="store_true", help="フラッシュ時にディスクへの書き込みを待ちます")
+parser.add_argument("--scan-workers", type=int, metavar="N", help="インデックス修復時にファイルを読み込むスレッド数")
+parser.add_argument("--cache-entries", type=int, metavar="N", help="読み込んだノード・フローをN件までキャッシュします")
+parser.add_argument("--compress", choices=list(ENCODINGS), help="新規作成するノードの長いテキストを圧縮します")
+parser.add_argument("--compress-threshold", type=int, default=COMPRESS_THRESHOLD, metavar="N", help=f"N文字以上のテキストを圧縮します（既定: {COMPRESS_THRESHOLD}）")
+parser.add_argument("--dedup", action="store_true", help="新規作成するノードの長いテキストを project/blobs で共有します")
+parser.add_argument("--dedup-threshold", type=int, default=DEDUP_THRESHOLD, metavar="N", help=f"N文字以上のテキストを共有します（既定: {DEDUP_THRESHOLD}）")
+parser.add_argument("--cache-mb", type=float, default=64, metavar="MB", help="キャッシュの上限をMBで指定します（0なら無制限）")
 subparsers = parser.add_subparsers(dest="command", help='トップレベルコマンド', required=True)
 
 # 'chat' サブコマンド
@@ -16,6 +30,7 @@ service_group.add_argument("--ollama", action="store_true", help="Ollamaとチ
 # プロンプト引数
 chat_command_parser.add_argument("-m", "--model", type=str, help="使用するモデル名")
 chat_command_parser.add_argument("prompt", type=str, nargs="?", help="LLMへのプロンプト")
+chat_command_parser.add_argument("--generations", type=int, metavar="N", help="フローの選択時に最後のノードからN世代前までだけを読み込みます（履歴もN世代に限られます）")
 
 # 'flow' サブコマンド
 flow_command_parser = subparsers.add_parser("flow", help="フロー管理コマンド")
@@ -23,19 +38,98 @@ flow_subparsers = flow_command_parser.add_subparsers(dest="flow_command", help='
 
 # 'flow list' サブコマンド
 flow_list_parser = flow_subparsers.add_parser("list", help="フロー一覧を表示します")
+flow_list_parser.add_argument("--sort", choices=list(FLOW_SORT_KEYS), default="number", help="並べ替えのキー（既定: number）")
+flow_list_parser.add_argument("-r", "--reverse", action="store_true", help="逆順に並べます")
+flow_list_parser.add_argument("-n", "--limit", type=int, metavar="N", help="1ページにN件ずつ表示します")
+flow_list_parser.add_argument("-p", "--page", type=int, default=1, metavar="P", help="Pページ目を表示します（既定: 1）")
 
 # 'flow show' サブコマンド
 flow_show_parser = flow_subparsers.add_parser("show", help="フローの詳細またはログを表示します")
 flow_show_parser.add_argument("id_or_number", type=str, help="フロー番号またはUUID")
 
+# 'flow where' サブコマンド
+flow_where_parser = flow_subparsers.add_parser("where", help="ノードを含むフローを表示します")
+flow_where_parser.add_argument("node_id", type=str, help="ノードのUUID")
+
+# 'flow orphans' サブコマンド
+flow_orphans_parser = flow_subparsers.add_parser("orphans", help="どのフローにも含まれないノードを表示します")
+
+# 'index' サブコマンド
+index_command_parser = subparsers.add_parser("index", help="インデックス管理コマンド")
+index_subparsers = index_command_parser.add_subparsers(dest="index_command", help='インデックス操作', required=True)
+
+# 'index migrate' サブコマンド
+index_migrate_parser = index_subparsers.add_parser("migrate", help="インデックスを別のバックエンドに移行します")
+index_migrate_parser.add_argument("backend", choices=list(INDEX_BACKENDS), help="移行先のバックエンド")
+
+# 'index refs' サブコマンド
+index_refs_parser = index_subparsers.add_parser("refs", help="ノードからフローへの逆引きインデックスを作り直します")
+
+# 'pack' サブコマンド
+pack_command_parser = subparsers.add_parser("pack", help="古いノードをセグメントファイルにまとめます")
+pack_command_parser.add_argument("--days", type=float, default=30, metavar="N", help="N日より前のノードをまとめます（既定: 30）")
+
+# 'recompress' サブコマンド
+recompress_command_parser = subparsers.add_parser("recompress", help="ノードのテキストを指定した圧縮方式で保存し直します")
+recompress_command_parser.add_argument("encoding", choices=[*ENCODINGS, "none"], help="圧縮方式（none なら展開）")
+recompress_command_parser.add_argument("--threshold", type=int, default=COMPRESS_THRESHOLD, metavar="N", help=f"N文字以上のテキストを圧縮します（既定: {COMPRESS_THRESHOLD}）")
+
+# 'dedup' サブコマンド
+dedup_command_parser = subparsers.add_parser("dedup", help="ノードのテキストを project/blobs に移して共有します")
+dedup_command_parser.add_argument("--threshold", type=int, default=DEDUP_THRESHOLD, metavar="N", help=f"N文字以上のテキストを共有します（既定: {DEDUP_THRESHOLD}）")
+
 import sys, re
+from datetime import datetime, timedelta
 from .terminal import bold, convert_markdown, MarkdownStreamConverter
 from ..core.node import NodeManager
 from ..core.flow import FlowManager
 
 base_dir = "project"
-node_manager = NodeManager(base_dir=base_dir)
-flow_manager = FlowManager(base_dir=base_dir)
+node_manager = None
+flow_manager = None
+
+def show_scan_progress(done, total):
+    """
+    インデックス修復の進捗を表示（1000件ごと）
+    """
+    if done % 1000 == 0 or done == total:
+        end = "\n" if done == total else ""
+        print(f"\rインデックスを修復しています: {done}/{total}", end=end, file=sys.stderr, flush=True)
+
+def init_managers(args):
+    """
+    コマンドライン引数に従ってマネージャーを初期化
+    """
+    global node_manager, flow_manager
+    options = {
+        "full_rescan": args.full_rescan,
+        "flush_every": args.flush_every,
+        "flush_interval_ms": args.flush_interval,
+        "fsync": args.fsync,
+        "scan_workers": args.scan_workers,
+        "scan_progress": show_scan_progress,
+        "cache_entries": args.cache_entries,
+        "cache_bytes": int(args.cache_mb * 1024 * 1024) or None,
+    }
+    node_manager = NodeManager(base_dir=base_dir, compression=args.compress,
+                               compress_threshold=args.compress_threshold,
+                               dedup=args.dedup, dedup_threshold=args.dedup_threshold, **options)
+    flow_manager = FlowManager(base_dir=base_dir, **options)
+
+def pin_history(flow, history_ids):
+    """
+    選択中のフローと履歴のノードをキャッシュから追い出さないようにする
+    """
+    flow_manager.cache.unpin()
+    flow_manager.cache.pin([flow.id])
+    node_manager.cache.unpin()
+    node_manager.cache.pin(history_ids)
+
+def show_cache_stats():
+    for name, manager in [("nodes", node_manager), ("flows", flow_manager)]:
+        stats = manager.cache.stats()
+        print(f"{name}: {stats['entries']} 件 ({stats['bytes'] / 1024 / 1024:.1f} MB, 固定 {stats['pinned']} 件)",
+              f"ヒット {stats['hits']} / ミス {stats['misses']} / 追い出し {stats['evictions']}")
 
 def chat(manager, generator, prompt, history=None):
     prompt = prompt.rstrip()
@@ -62,6 +156,7 @@ commands = {
     "/flow select <id>": "フローを選択します",
     "/prev": "前のノードを表示します",
     "/retry": "前のノードを再実行します",
+    "/cache": "キャッシュの統計を表示します",
     "/?": "このヘルプを表示します"
 }
 commands_max = max(len(cmd) for cmd in commands)
@@ -87,13 +182,21 @@ def parse_command(line):
             return command, None
     return None, ["不明なコマンドです。"]
 
-def repl(generator):
+def close_flow(flow):
+    """
+    フローの編集ログをYAMLに畳み込む（セッションの終了時やフローの切り替え時）
+    """
+    if flow and flow.logged:
+        flow.save(compact=True)
+
+def repl(generator, generations=None):
     flow = None
     prev_node = None
     while True:
         try:
             prompt = input(bold("User:") + " ")
             if prompt is None:
+                close_flow(flow)
                 return
             cmd, args = parse_command(prompt)
             if cmd:
@@ -103,9 +206,11 @@ def repl(generator):
                     continue
                 match cmd:
                     case "/q":
+                        close_flow(flow)
                         return
                     case "/clear":
                         print("セッションをクリアしました。")
+                        close_flow(flow)
                         flow = None
                         continue
                     case "/flow list":
@@ -117,8 +222,12 @@ def repl(generator):
                         continue
                     case "/flow select":
                         try:
-                            flow = get_flow(args[0])
-                            prev_node = node_manager.get_node(flow.nodes[-1]) if flow.nodes else None
+                            selected = get_flow(args[0], partial=True, generations=generations)
+                            if selected is not flow:
+                                close_flow(flow)
+                            flow = selected
+                            prev_node = node_manager.get_node(flow.last_node) if flow.last_node else None
+                            pin_history(flow, flow.get_history(prev_node.id) if prev_node else [])
                             print("フローを選択しました:", flow.id, flow.relpath)
                         except Exception as e:
                             print(e, file=sys.stderr)
@@ -142,6 +251,10 @@ def repl(generator):
                                 flow.connect(prev, curr_node.id)
                             flow.save()
                             prev_node = curr_node
+                            pin_history(flow, history_ids + [curr_node.id])
+                        continue
+                    case "/cache":
+                        show_cache_stats()
                         continue
                     case "/?":
                         show_commands()
@@ -163,8 +276,10 @@ def repl(generator):
             flow.connect(prev_node.id if prev_node else None, curr_node.id)
             flow.save()
             prev_node = curr_node
+            pin_history(flow, history_ids + [curr_node.id])
             print()
         except EOFError:
+            close_flow(flow)
             return
         except Exception as e:
             print(f"エラーが発生しました: {e}", file=sys.stderr)
@@ -187,26 +302,41 @@ def cmd_chat(args):
             print(bold("User:"), args.prompt)
             chat(node_manager, generator, args.prompt)
         else:
-            repl(generator)
+            repl(generator, args.generations)
     else:
         # 排他・必須オプションのため、このelse節には到達しない想定
         chat_command_parser.print_help()
 
 def cmd_flow(args):
     if args.flow_command == "list":
-        cmd_flow_list()
+        cmd_flow_list(args.sort, args.reverse, args.limit, args.page)
     elif args.flow_command == "show":
         cmd_flow_show(args.id_or_number)
+    elif args.flow_command == "where":
+        cmd_flow_where(args.node_id)
+    elif args.flow_command == "orphans":
+        cmd_flow_orphans()
     else:
         flow_command_parser.print_help()
 
-def cmd_flow_list():
+def cmd_flow_list(sort="number", reverse=False, limit=None, page=1):
+    # フローは読み込まず、Flow.save で追記された要約から表示
+    summaries = flow_manager.get_summaries()
+    if sort != "number" or reverse:
+        summaries.sort(key=FLOW_SORT_KEYS[sort], reverse=reverse)
+    if limit:
+        pages = max(1, -(-len(summaries) // limit))
+        if not 1 <= page <= pages:
+            print(f"ページは 1 から {pages} までです。", file=sys.stderr)
+            return
+        summaries = summaries[(page - 1) * limit:page * limit]
     format = len(str(len(flow_manager.tsv_entries)))
-    for idx, (_, (id, _)) in enumerate(flow_manager.tsv_entries.items(), 1):
-        f = flow_manager.get_flow(id)
-        print(f"{idx:{format}}.", f.updated, f.id, f.relpath, f.name, f"({len(f.nodes)})")
+    for idx, relpath, s in summaries:
+        print(f"{idx:{format}}.", s["updated"], s["id"], relpath, s["name"], f"({s['nodes']})")
+    if limit:
+        print(f"[{page} / {pages} ページ]")
 
-def get_flow(id_or_number):
+def get_flow(id_or_number, partial=False, generations=None):
     # 数字なら番号→UUID変換
     if re.fullmatch(r"\d+", id_or_number):
         idx = int(id_or_number)
@@ -217,6 +347,9 @@ def get_flow(id_or_number):
             raise ValueError("指定された番号のフローは存在しません")
     else:
         id = id_or_number
+    # チャットでは最後のノードの祖先だけを読み込む（必要になれば Flow が範囲を広げる）
+    if partial and (head := flow_manager.get_last_node(id)):
+        return flow_manager.get_flow(id, [head], generations)
     return flow_manager.get_flow(id)
 
 def show_node(node):
@@ -243,17 +376,78 @@ def cmd_flow_show(id_or_number):
     for i, history in enumerate(histories, 1):
         print()
         print(f"======== 履歴 {i}/{len(histories)} ========")
-        for node_id in history:
-            node = node_manager.get_node(node_id)
+        for node in node_manager.get_nodes(history, lazy=False):
             print()
             show_node(node)
 
+def cmd_flow_where(node_id):
+    # フローは読み込まず、逆引きインデックスと要約から表示
+    flow_ids = set(flow_manager.get_flows_of_node(node_id))
+    if not flow_ids:
+        print("ノードを含むフローはありません", file=sys.stderr)
+        return
+    format = len(str(len(flow_manager.tsv_entries)))
+    for idx, relpath, s in flow_manager.get_summaries():
+        if s["id"] in flow_ids:
+            print(f"{idx:{format}}.", s["updated"], s["id"], relpath, s["name"], f"({s['nodes']})")
+
+def cmd_flow_orphans():
+    for node_id in node_manager.get_orphans(flow_manager):
+        print(node_id)
+
+def show_refs_progress(done, total):
+    if done % 100 == 0 or done == total:
+        end = "\n" if done == total else ""
+        print(f"\rフローを読み込んでいます: {done}/{total}", end=end, file=sys.stderr, flush=True)
+
+def cmd_index(args):
+    if args.index_command == "migrate":
+        for manager in [node_manager, flow_manager]:
+            manager.migrate_index(args.backend)
+            print(f"{manager.data_dir}: {args.backend} に移行しました ({len(manager.tsv_entries)} 件)")
+    elif args.index_command == "refs":
+        count = flow_manager.rebuild_refs(show_refs_progress)
+        print(f"{count} 件のフローから逆引きインデックスを作り直しました")
+    else:
+        index_command_parser.print_help()
+
+def cmd_pack(args):
+    before = datetime.now().astimezone() - timedelta(days=args.days)
+    count, segment = node_manager.pack(before)
+    if count:
+        print(f"{count} 件のノードを {segment} にまとめました")
+    else:
+        print("まとめるノードはありません")
+
+def show_rewrite_progress(done, total):
+    if done % 100 == 0 or done == total:
+        end = "\n" if done == total else ""
+        print(f"\rノードを保存し直しています: {done}/{total}", end=end, file=sys.stderr, flush=True)
+
+def cmd_recompress(args):
+    compression = None if args.encoding == "none" else args.encoding
+    changed, total = node_manager.recompress(compression, args.threshold, show_rewrite_progress)
+    print(f"{total} 件中 {changed} 件のノードを保存し直しました")
+
+def cmd_dedup(args):
+    changed, total = node_manager.deduplicate(args.threshold, show_rewrite_progress)
+    print(f"{total} 件中 {changed} 件のノードを保存し直しました")
+
 def main():
     args = parser.parse_args()
+    init_managers(args)
     if args.command == "chat":
         cmd_chat(args)
     elif args.command == "flow":
         cmd_flow(args)
+    elif args.command == "index":
+        cmd_index(args)
+    elif args.command == "pack":
+        cmd_pack(args)
+    elif args.command == "recompress":
+        cmd_recompress(args)
+    elif args.command == "dedup":
+        cmd_dedup(args)
     else:
         parser.print_help()
 
@@ -1,129 +1,323 @@
 import os, re, uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from vizprompt.core.slots import SlotAllocator
+from vizprompt.core.journal import Journal
+from vizprompt.core.lock import FileLock
+from vizprompt.core.cache import LRUCache
+from vizprompt.core.index import (
+    INDEX_BACKENDS, IndexEntries, UuidMap, detect_backend, file_id, folder_of, read_tsv_tail,
+)
+
+# 読み込むファイルがこれより少なければ並列化しない
+PARALLEL_THRESHOLD = 64
+
+# 読み込んだインスタンスのキャッシュの既定の上限（バイト数）
+CACHE_BYTES = 64 * 1024 * 1024
+
+def file_stamp(path):
+    """
+    ファイルのスタンプ (st_dev, st_ino, st_size, st_mtime_ns)（なければNone）
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
 
 class BaseManager:
     """
     UUIDとタイムスタンプでファイルを管理するベースクラス
+
+    full_rescan: 前回走査結果を使わず全フォルダを走査
+    backend: インデックスのバックエンド（"tsv" または "sqlite"、Noneなら自動判定）
+    flush_every, flush_interval_ms, fsync: index.tsv への追記のフラッシュ方針（Journal参照）
+    scan_workers: 走査時にファイルを並列に読み込むスレッド数（Noneなら既定値）
+    scan_progress: 走査時にファイルを読み込むごとに呼び出す関数 (読み込み済み数, 総数)
+    cache_entries, cache_bytes: 読み込んだインスタンスのキャッシュの上限（Noneなら無制限）
     """
 
-    def __init__(self, data_dir, ext):
+    def __init__(self, data_dir, ext, full_rescan=False, backend=None,
+                 flush_every=1, flush_interval_ms=None, fsync=False,
+                 scan_workers=None, scan_progress=None,
+                 cache_entries=None, cache_bytes=CACHE_BYTES):
         self.data_dir = data_dir
         self.map_path = os.path.join(data_dir, "index.tsv")
+        self.scan_path = os.path.join(data_dir, "scan.tsv")
+        self.slots_path = os.path.join(data_dir, "slots.tsv")
         self.ext = ext
+        self.scan_workers = scan_workers
+        self.scan_progress = scan_progress
+        self.cache = LRUCache(cache_entries, cache_bytes, self.sizeof)
         os.makedirs(self.data_dir, exist_ok=True)
-        self.tsv_entries = {}  # relpath -> (uuid, timestamp)
-        self.uuid_map = {}     # uuid -> [relpath]
-        self.check_and_update_map()
+        self.slots = SlotAllocator(ext)
+        self.lock = FileLock(os.path.join(data_dir, "index.lock"))
+        self.journal = Journal(self.map_path, flush_every, flush_interval_ms, fsync, self.lock)
+        self.index = INDEX_BACKENDS[backend or detect_backend(data_dir)](data_dir, self.slots, self.journal)
+        self.tsv_entries = IndexEntries(self.index)  # relpath -> (uuid, timestamp)
+        self.uuid_map = UuidMap(self.index)          # uuid -> [relpath]
+        self.check_and_update_map(full_rescan=full_rescan)
+
+    @contextmanager
+    def locked(self):
+        """
+        スロットの割り当てとインデックスの更新を他のプロセスと排他する
+        最も外側でロックを取得したときに他のプロセスの追記を読み込み、解放前に変更を確定する
+        index.tsv への追記は解放時にはフラッシュせず、Journal のフラッシュの方針に任せる
+        """
+        with self.lock:
+            outermost = self.lock.depth == 1
+            if outermost:
+                self.index.refresh(self.slots)
+            try:
+                yield
+            finally:
+                if outermost:
+                    self.index.release()
 
     def add_entry(self, relpath, uuid, timestamp):
         """
         エントリを追加
         """
-        self.tsv_entries[relpath] = (uuid, timestamp)
-        lst = self.uuid_map.setdefault(uuid, [])
-        # タイムスタンプ降順（新しい順）で挿入、同一なら先頭
-        for i, rp in enumerate(lst):
-            ts = self.tsv_entries[rp][1]
-            if timestamp >= ts:
-                lst.insert(i, relpath)
-                return
-        lst.append(relpath)
+        self.index.add(relpath, uuid, timestamp)
+        self.slots.mark_used(relpath)
 
-    def check_and_update_map(self):
+    def remove_entry(self, relpath):
         """
-        TSVファイルとディレクトリの整合性チェック・自動修正
+        エントリを削除
+        """
+        self.index.remove(relpath)
+        self.slots.mark_free(relpath)
+
+    def load_scan_snapshot(self):
+        """
+        前回走査時のフォルダごとのスタンプ (mtime_ns, ファイル数) と、
+        そのときの index.tsv (st_dev, st_ino, st_size)・slots.tsv (file_stamp) を読み込む
+        戻り値: (snapshot, {"index": ..., "slots": ...})
         """
-        self.tsv_entries = {}
-        self.uuid_map = {}
-        if os.path.exists(self.map_path):
-            with open(self.map_path, encoding="utf-8") as f:
-                first = True
+        snapshot = {}
+        stamps = {}
+        if os.path.exists(self.scan_path):
+            with open(self.scan_path, encoding="utf-8") as f:
                 for line in f:
-                    if first:
-                        if line.strip().lower().startswith("relpath"):
-                            first = False
-                            continue
-                        first = False
-                    parts = line.strip().split("\t")
-                    if len(parts) == 3:
-                        relpath, uuid, timestamp = parts
-                        try:
-                            dt = datetime.fromisoformat(timestamp)
-                        except Exception:
-                            dt = datetime.now().astimezone()
-                        self.add_entry(relpath, uuid, dt)
-
-        # ディレクトリ配下の全ファイルを列挙しつつ不足分を即時追加
+                    parts = line.rstrip("\n").split("\t")
+                    if parts[0] in ("#index", "#slots") and all(part.isdigit() for part in parts[1:]):
+                        stamps[parts[0][1:]] = tuple(map(int, parts[1:]))
+                    elif len(parts) == 3 and parts[1].isdigit() and parts[2].isdigit():
+                        snapshot[parts[0]] = (int(parts[1]), int(parts[2]))
+        return snapshot, stamps
+
+    def save_scan_snapshot(self, snapshot, stamps):
+        """
+        フォルダごとのスタンプと index.tsv・slots.tsv のスタンプを保存
+        """
+        with open(self.scan_path, "w", encoding="utf-8") as f:
+            f.write("folder\tmtime_ns\tcount\n")
+            for name, stamp in stamps.items():
+                if stamp is not None:
+                    print(f"#{name}", *stamp, sep="\t", file=f)
+            for folder, (mtime_ns, count) in sorted(snapshot.items()):
+                print(folder, mtime_ns, count, sep="\t", file=f)
+
+    def scan_stamps(self):
+        """
+        現在の index.tsv と slots.tsv のスタンプ
+        """
+        current, size = file_id(self.map_path)
+        return {
+            "index": None if current is None else (*current, size),
+            "slots": file_stamp(self.slots_path),
+        }
+
+    def read_index_tail(self, stamps):
+        """
+        前回走査時から index.tsv に追記されたrelpathのリスト
+        index.tsv が書き直された・切り詰められた、または slots.tsv が変わっていればNone
+        """
+        index_stamp, slots_stamp = stamps.get("index"), stamps.get("slots")
+        if index_stamp is None or slots_stamp is None or slots_stamp != file_stamp(self.slots_path):
+            return None
+        current, size = file_id(self.map_path)
+        if current != index_stamp[:2] or size < index_stamp[2]:
+            return None
+        entries, _ = read_tsv_tail(self.map_path, index_stamp[2])
+        return [relpath for relpath, _, _ in entries]
+
+    def read_headers(self, relpaths):
+        """
+        ファイルからUUIDとタイムスタンプを取得（スレッドプールで並列に読み込み、結果は入力順）
+        """
+        paths = [os.path.join(self.data_dir, relpath) for relpath in relpaths]
+        results = []
+        if len(paths) < PARALLEL_THRESHOLD or self.scan_workers == 1:
+            headers = map(self.get_uuid_and_timestamp_from_file, paths)
+            pool = None
+        else:
+            pool = ThreadPoolExecutor(self.scan_workers)
+            headers = pool.map(self.get_uuid_and_timestamp_from_file, paths)
+        try:
+            for header in headers:
+                results.append(header)
+                if self.scan_progress:
+                    self.scan_progress(len(results), len(paths))
+        finally:
+            if pool:
+                pool.shutdown()
+        return results
+
+    def scan_folders(self, folders, relpaths):
+        """
+        フォルダを走査して不足分を追加・過剰分を削除
+        フォルダの列挙とファイルの読み込みは並列に行い、追加は逐次走査と同じ順序で行う
+        （UUID衝突時の優先順位を変えないため）
+        戻り値: (変更の有無, {フォルダ: 該当ファイル数})
+        """
+        regex = re.compile(r"[0-9]+\." + re.escape(self.ext))
+        folder_paths = [os.path.join(self.data_dir, folder) for folder in folders]
+        if len(folders) < 2 or self.scan_workers == 1:
+            listings = list(map(os.listdir, folder_paths))
+        else:
+            with ThreadPoolExecutor(self.scan_workers) as pool:
+                listings = list(pool.map(os.listdir, folder_paths))
         changed = False
-        for folder in os.listdir(self.data_dir):
-            folder_path = os.path.join(self.data_dir, folder)
-            if not os.path.isdir(folder_path):
-                continue
-            regex = re.compile(r"[0-9]+\." + re.escape(self.ext))
-            for fname in os.listdir(folder_path):
-                if regex.match(fname):
+        counts = {}
+        missing = []
+        for folder, fnames in zip(folders, listings):
+            found = set()
+            for fname in fnames:
+                if regex.fullmatch(fname):
                     relpath = f"{folder}/{fname}"
+                    found.add(relpath)
                     if relpath not in self.tsv_entries:
-                        path = os.path.join(self.data_dir, folder, fname)
-                        uuid, timestamp = self.get_uuid_and_timestamp_from_file(path)
-                        self.add_entry(relpath, uuid, timestamp)
-                        changed = True
-
-        # 過剰分を削除
-        all_uuid_relpaths = set()
-        for relpaths in self.uuid_map.values():
-            all_uuid_relpaths.update(relpaths)
-        for relpath in list(self.tsv_entries.keys()):
-            if relpath not in all_uuid_relpaths:
-                self.tsv_entries.pop(relpath)
+                        missing.append(relpath)
+            for relpath in relpaths[folder]:
+                if relpath not in found:
+                    self.remove_entry(relpath)
+                    changed = True
+            counts[folder] = len(found)
+        for relpath, (uuid, timestamp) in zip(missing, self.read_headers(missing)):
+            self.add_entry(relpath, uuid, timestamp)
+            changed = True
+        return changed, counts
+
+    def check_and_update_map(self, full_rescan=False):
+        """
+        TSVファイルとディレクトリの整合性チェック・自動修正
+        前回走査時からフォルダのmtimeとファイル数が変わっていなければ走査を省略する
+        full_rescan=True なら全フォルダを走査
+        """
+        with self.lock:
+            snapshot, old_snapshot, old_stamps = self._check_and_update_map(full_rescan)
+            self.index.flush()
+            # 次回の起動でフラッシュ後の index.tsv との差分だけを調べられるよう、スタンプを記録
+            stamps = self.scan_stamps()
+            if (snapshot, stamps) != (old_snapshot, old_stamps):
+                self.save_scan_snapshot(snapshot, stamps)
+
+    def _check_and_update_map(self, full_rescan):
+        self.slots.reset()
+        self.index.load()
+        old_snapshot, old_stamps = ({}, {}) if full_rescan else self.load_scan_snapshot()
+
+        # 前回走査時から index.tsv が追記されただけなら、全エントリを調べ直さず追記分だけを反映する
+        # 前回の slots.tsv とフォルダごとのファイル数はそのときの index.tsv と一致している
+        tail = None if full_rescan else self.read_index_tail(old_stamps)
+        if tail is None:
+            if not full_rescan:
+                self.slots.load(self.slots_path)
+            self.index.sync_slots(self.slots)
+            counts = self.index.folder_counts()
+        else:
+            self.slots.load(self.slots_path)
+            counts = {folder: count for folder, (_, count) in old_snapshot.items()}
+            for relpath in tail:
+                self.slots.mark_used(relpath)
+                # 追記のあったフォルダは必ず走査する
+                counts[folder_of(relpath)] = -1
+
+        # 変更のあったフォルダを判定
+        snapshot = {}
+        stale = {}
+        with os.scandir(self.data_dir) as it:
+            for entry in it:
+                if not entry.is_dir():
+                    continue
+                folder = entry.name
+                # 走査中の追加を取りこぼさないよう、列挙より先にmtimeを取得
+                mtime_ns = entry.stat().st_mtime_ns
+                if old_snapshot.get(folder) == (mtime_ns, counts.pop(folder, 0)):
+                    snapshot[folder] = old_snapshot[folder]
+                else:
+                    stale[folder] = mtime_ns
+
+        # 変更のあったフォルダだけを走査して不足分・過剰分を修正
+        # countsに残ったのは存在しないフォルダのエントリ
+        relpaths = self.index.folder_relpaths(stale.keys() | counts.keys())
+        changed, file_counts = self.scan_folders(list(stale), relpaths)
+        for folder, mtime_ns in stale.items():
+            snapshot[folder] = (mtime_ns, file_counts[folder])
+        for folder in counts:
+            for relpath in relpaths[folder]:
+                self.remove_entry(relpath)
                 changed = True
 
         # 変更があればTSV書き直し
         if changed:
             self.save_index()
 
+        # 空きスロット情報がTSVと矛盾していれば再構築（前回から追記だけなら確認済み）
+        if tail is None and not self.slots.is_consistent(self.index.count_slots_below(self.slots)):
+            self.slots.rebuild(self.index)
+        if self.slots.dirty:
+            self.slots.save(self.slots_path)
+        return snapshot, old_snapshot, old_stamps
+
     def save_index(self):
         """
-        TSVファイル全体を保存
+        インデックス全体を保存
         """
-        with open(self.map_path, "w", encoding="utf-8") as f:
-            f.write("relpath\tuuid\ttimestamp\n")
-            for relpath, (uuid, timestamp) in self.tsv_entries.items():
-                print(relpath, uuid, timestamp.isoformat(), sep="\t", file=f)
+        self.index.save()
 
     def append_index(self, relpath, uuid, timestamp):
         """
-        エントリをTSVに追加
+        追加したエントリをインデックスに反映
         """
-        if os.path.exists(self.map_path):
-            with open(self.map_path, "a", encoding="utf-8") as f:
-                print(relpath, uuid, timestamp.isoformat(), sep="\t", file=f)
-        else:
-            # TSVファイルが存在しない場合は新規作成
-            self.save_index()
+        self.index.append(relpath, uuid, timestamp)
+
+    def migrate_index(self, backend):
+        """
+        インデックスを別のバックエンドに移行（index.tsv は常に書き出す）
+        """
+        if backend == self.index.name:
+            return
+        index = INDEX_BACKENDS[backend](self.data_dir, self.slots, self.journal)
+        for relpath, (uuid, timestamp) in self.index.items():
+            index.add(relpath, uuid, timestamp)
+        index.save()
+        old = self.index
+        old.close()
+        if db_path := getattr(old, "db_path", None):
+            os.remove(db_path)
+        self.index = index
+        self.tsv_entries = IndexEntries(index)
+        self.uuid_map = UuidMap(index)
 
     def get_next_relpath_and_folder(self):
         """
         空きのrelpathを探す
+        他のプロセスと同じrelpathを使わないよう、locked() の中で呼び出してファイルを作成する
         """
-        used = set(self.tsv_entries.keys())
-        for max in range(100, 1000, 100):
-            for i in range(max):
-                folder = f"{i:03}"
-                folder_path = os.path.join(self.data_dir, folder)
-                os.makedirs(folder_path, exist_ok=True)
-                for idx in range(max):
-                    filename = f"{idx:03}.{self.ext}"
-                    relpath = f"{folder}/{filename}"
-                    if relpath not in used:
-                        path = os.path.join(folder_path, filename)
-                        if os.path.exists(path):
-                            uuid, timestamp = self.get_uuid_and_timestamp_from_file(path)
-                            self.add_entry(relpath, uuid, timestamp)
-                            with open(self.map_path, "a", encoding="utf-8") as f:
-                                f.write(f"{relpath}\t{uuid}\t{timestamp.isoformat()}\n")
-                        else:
-                            return relpath
+        while relpath := self.slots.peek():
+            path = os.path.join(self.data_dir, relpath)
+            if os.path.exists(path):
+                # TSVにないファイルがあれば登録して次を探す
+                uuid, timestamp = self.get_uuid_and_timestamp_from_file(path)
+                self.add_entry(relpath, uuid, timestamp)
+                self.append_index(relpath, uuid, timestamp)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                return relpath
         raise Exception("保存上限に達しました")
 
     def generate_uuid(self):
@@ -135,6 +329,13 @@ class BaseManager:
             node_id = str(uuid.uuid4())
         return node_id
 
+    def sizeof(self, obj):
+        """
+        キャッシュするインスタンスのおおよそのバイト数
+        サブクラスでオーバーライド推奨
+        """
+        return 1024
+
     def get_uuid_and_timestamp_from_file(self, path):
         """
         ファイルからUUIDとタイムスタンプを取得（なければゼロUUIDと現在時刻）
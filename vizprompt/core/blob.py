@@ -0,0 +1,58 @@
+import os, hashlib, threading
+from vizprompt.core.cache import LRUCache
+
+# 読み込んだテキストのキャッシュの既定の上限（バイト数）
+BLOB_CACHE_BYTES = 8 * 1024 * 1024
+
+class BlobStore:
+    """
+    テキストをハッシュ値で管理する格納庫（同じテキストは1つのファイルを共有する）
+
+    blobs/ab/cdef...: SHA-256 の16進表記の先頭2文字をフォルダ名、残りをファイル名とする
+    参照は "sha256:16進表記" の文字列で表す。
+    ファイルは作成後に変更しないため、読み込んだテキストはキャッシュする。
+    """
+    def __init__(self, blob_dir, cache_bytes=BLOB_CACHE_BYTES):
+        self.dir = blob_dir
+        self.cache = LRUCache(max_bytes=cache_bytes, sizeof=len)
+        self.lock = threading.Lock()
+
+    def path(self, ref):
+        algorithm, _, digest = ref.partition(":")
+        if algorithm != "sha256" or len(digest) != 64:
+            raise ValueError(f"不正な参照です: {ref}")
+        return os.path.join(self.dir, digest[:2], digest[2:])
+
+    def put(self, text):
+        """
+        テキストを格納して参照を返す（同じテキストがあれば書き込まない）
+        """
+        data = text.encode("utf-8", "surrogatepass")
+        ref = "sha256:" + hashlib.sha256(data).hexdigest()
+        path = self.path(ref)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 書き込み途中のファイルを参照されないよう、一時ファイルに書いてから置き換える
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        with self.lock:
+            self.cache[ref] = text
+        return ref
+
+    def get(self, ref):
+        """
+        参照からテキストを取得
+        """
+        with self.lock:
+            if (text := self.cache.get(ref)) is not None:
+                return text
+        try:
+            with open(self.path(ref), "rb") as f:
+                text = f.read().decode("utf-8", "surrogatepass")
+        except FileNotFoundError:
+            raise FileNotFoundError(f"テキストが見つかりません: {ref}") from None
+        with self.lock:
+            self.cache[ref] = text
+        return text
@@ -0,0 +1,124 @@
+from collections import OrderedDict
+
+class LRUCache:
+    """
+    エントリ数とバイト数に上限のあるLRUキャッシュ
+
+    max_entries: エントリ数の上限（Noneなら無制限）
+    max_bytes: 値の大きさの合計の上限（Noneなら無制限）
+    sizeof: 値のおおよそのバイト数を返す関数（Noneなら大きさを数えない）
+    上限を超えたら最近使われていない順に追い出す。固定（pin）したキーは追い出さない。
+    値の大きさは遅延読み込みなどで変わるため、取得のたびに測り直す。
+    """
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = OrderedDict()  # key -> [value, size]（古い順）
+        self.pinned = set()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def measure(self, value):
+        return self.sizeof(value) if self.sizeof else 0
+
+    def get(self, key, default=None):
+        """
+        値を取得して最近使ったものとする（なければ default）
+        """
+        if (entry := self.entries.get(key)) is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        size = self.measure(entry[0])
+        if size != entry[1]:
+            self.bytes += size - entry[1]
+            entry[1] = size
+            self.evict()
+        return entry[0]
+
+    def __setitem__(self, key, value):
+        if (entry := self.entries.pop(key, None)) is not None:
+            self.bytes -= entry[1]
+        size = self.measure(value)
+        self.entries[key] = [value, size]
+        self.bytes += size
+        self.evict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def pop(self, key, default=None):
+        if (entry := self.entries.pop(key, None)) is None:
+            return default
+        self.bytes -= entry[1]
+        return entry[0]
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def pin(self, keys):
+        """
+        キーを固定して追い出さないようにする（まだキャッシュにないキーも指定できる）
+        """
+        self.pinned.update(keys)
+
+    def unpin(self, keys=None):
+        """
+        キーの固定を解除（Noneならすべて）
+        """
+        if keys is None:
+            self.pinned.clear()
+        else:
+            self.pinned.difference_update(keys)
+        self.evict()
+
+    def over_budget(self):
+        if self.max_entries is not None and len(self.entries) > self.max_entries:
+            return True
+        return self.max_bytes is not None and self.bytes > self.max_bytes
+
+    def evict(self):
+        """
+        上限に収まるまで古い順に追い出す（固定したキーと、最後に使ったエントリは残す）
+        """
+        if not self.over_budget():
+            return
+        victims = []
+        entries = len(self.entries)
+        size = self.bytes
+        newest = next(reversed(self.entries))
+        for key, (_, s) in self.entries.items():
+            if key == newest:
+                break
+            if key in self.pinned:
+                continue
+            victims.append(key)
+            entries -= 1
+            size -= s
+            if (self.max_entries is None or entries <= self.max_entries) and \
+                    (self.max_bytes is None or size <= self.max_bytes):
+                break
+        for key in victims:
+            self.pop(key)
+        self.evictions += len(victims)
+
+    def stats(self):
+        """
+        統計情報の辞書
+        """
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "pinned": len(self.pinned),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
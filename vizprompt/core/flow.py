@@ -1,14 +1,105 @@
-import sys, os, uuid
+import sys, os, uuid, json
+from array import array
+from bisect import bisect_left
+from itertools import compress
+from collections.abc import Mapping, Set
 from datetime import datetime
 from ruamel.yaml import YAML
 from vizprompt.core.base import BaseManager
+from vizprompt.core.lock import FileLock
+from vizprompt.core.cache import LRUCache
+from vizprompt.core.journal import recover_torn_line
+from vizprompt.core.summary import FlowSummaries, NodeRefs
+from vizprompt.core.graph import Graph
+
+# ノードごとの履歴をキャッシュする件数
+HISTORY_CACHE_SIZE = 32
+
+# 編集ログがこの操作数を超えたら保存時にYAMLへ畳み込む
+LOG_COMPACT_OPS = 256
 
 yaml = YAML()
 yaml.default_flow_style = False
 yaml.allow_unicode = True
 
+class ConnectionsView(Set):
+    """
+    Flow の接続をノードIDの組 (from_id, to_id) で見せるビュー（追加順）
+    """
+    def __init__(self, flow):
+        self.flow = flow
+
+    def __contains__(self, edge):
+        from_id, to_id = edge
+        a = self.flow.node_index.get(from_id)
+        b = self.flow.node_index.get(to_id)
+        return bool(a and b) and self.flow.graph.has_edge(a - 1, b - 1)
+
+    def __iter__(self):
+        nodes = self.flow.nodes
+        for a, b in self.flow.graph.edges():
+            yield nodes[a], nodes[b]
+
+    def __len__(self):
+        return len(self.flow.graph)
+
+class AdjacencyView(Mapping):
+    """
+    Flow の隣接リストをノードIDで見せるビュー（接続のあるノードのみ）
+    """
+    def __init__(self, flow, neighbors):
+        self.flow = flow
+        self.neighbors = neighbors
+
+    def __getitem__(self, node_id):
+        if (i := self.flow.node_index.get(node_id)) is None or not (adjacent := self.neighbors(i - 1)):
+            raise KeyError(node_id)
+        return [self.flow.nodes[n] for n in adjacent]
+
+    def __iter__(self):
+        for n, node_id in enumerate(self.flow.nodes):
+            if self.neighbors(n):
+                yield node_id
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+def yaml_stamp(st):
+    """
+    JSONに記録するYAMLのスタンプ [mtime_ns, 大きさ]
+    """
+    return [st.st_mtime_ns, st.st_size]
+
+def select_window(size, pairs, starts, generations=None):
+    """
+    部分読み込みで読み込むノードを1から始まる番号で選ぶ
+    starts から接続を逆にたどって到達できるノード（generations を指定すれば、
+    starts を1世代目としてその世代まで）を選ぶ
+    戻り値: (ノード番号のリスト（番号の順）, 親を選ばなかったノード番号の集合)
+    """
+    # 一度しか使わないため、ソートの要る CSR 形式ではなくリストで逆方向の隣接を作る
+    prevs = [[] for _ in range(size + 1)]
+    for f, t in pairs:
+        prevs[t].append(f)
+    selected = set(starts)
+    level = list(selected)
+    depth = 1
+    while level:
+        if generations is not None and depth >= generations:
+            border = {n for n in level if any(m not in selected for m in prevs[n])}
+            return sorted(selected), border
+        next_level = []
+        for n in level:
+            for m in prevs[n]:
+                if m not in selected:
+                    selected.add(m)
+                    next_level.append(m)
+        level = next_level
+        depth += 1
+    return sorted(selected), set()
+
 class Flow:
-    def __init__(self, id, name, created, updated, description, nodes, connections, data_dir, relpath):
+    def __init__(self, id, name, created, updated, description, nodes, connections, data_dir, relpath, revision=0):
         self.id = id
         self.name = name
         self.created = created
@@ -16,177 +107,563 @@ class Flow:
         self.description = description
         self.data_dir = data_dir
         self.relpath = relpath
-        self.nodes = nodes
-        self.node_index = self._node_index()
-
-        # 有向グラフに変換（双方向）
-        self.connections = [] # (from_id, to_id) のリスト
-        self.graph_fwd = {}
-        self.graph_rev = {}
-        for from_id, to_id in connections:
-            try:
-                self.connect(from_id, to_id)
-            except Exception as e:
-                print(e, file=sys.stderr)
+        self.revision = revision             # YAMLに畳み込んだ回数（編集ログとの対応に使う）
+        self.logged = 0                      # 編集ログに書き込まれている操作の数
+        self.pending = []                    # 未保存の操作 (updated, op, *args) のリスト
+        self.summaries = None                # 一覧表示用の要約の格納先（FlowManager が共有）
+        self.refs = None                     # ノードからフローへの逆引きインデックス（同上）
+        self.ref_changes = {}                # 未保存のノードID -> 追加したか（Falseなら削除）
+
+        # 部分読み込み（Flow.load で heads を指定）の範囲（heads が None なら全体を読み込み済み）
+        self.heads = None                    # 起点のノードID（その祖先を読み込む、追加したノードも加える）
+        self.generations = None              # 起点を1世代目として読み込む世代数（Noneなら祖先すべて）
+        self.border = set()                  # 親を読み込んでいないノードID（世代数を指定した場合のみ）
+        self.unloaded = array("q")           # 読み込んでいないノードIDのハッシュ値（ソート済み）
+        self.unloaded_edges = 0              # 読み込んでいない接続の数
+        self.tail = None                     # フロー全体で最後に追加したノードID
+        self.nodes = nodes                   # ノードIDのリスト（追加順）
+        self.node_index = self._node_index() # ノードID -> 1から始まる番号（存在確認にも使う）
+
+        # 有向グラフ（ノード番号は node_index - 1、ノードIDへの変換は外部とのやり取りでのみ行う）
+        self.graph = Graph(len(nodes))
+        # ノードID -> get_history の結果（大きさは履歴の長さ）
+        self.histories = LRUCache(max_entries=HISTORY_CACHE_SIZE, sizeof=len)
+        self.load_connections(connections)
+        self.pending.clear()
+        self.ref_changes.clear()
 
     def _node_index(self):
         return {n: i for i, n in enumerate(self.nodes, 1)}
 
+    @property
+    def connections(self):
+        """
+        接続 (from_id, to_id) の集合（追加順）
+        """
+        return ConnectionsView(self)
+
+    @property
+    def partial(self):
+        """
+        部分読み込みしたフローか
+        """
+        return self.heads is not None
+
+    @property
+    def node_count(self):
+        """
+        フロー全体のノード数（読み込んでいないノードを含む）
+        """
+        return len(self.nodes) + len(self.unloaded)
+
+    @property
+    def edge_count(self):
+        """
+        フロー全体の接続数（読み込んでいない接続を含む）
+        """
+        return len(self.graph) + self.unloaded_edges
+
+    @property
+    def last_node(self):
+        """
+        フロー全体で最後に追加したノードID（なければNone）
+        """
+        if self.partial:
+            return self.tail
+        return self.nodes[-1] if self.nodes else None
+
+    @property
+    def graph_fwd(self):
+        """
+        ノードID -> 接続先のノードIDのリスト（接続のあるノードのみ）
+        """
+        return AdjacencyView(self, self.graph.next)
+
+    @property
+    def graph_rev(self):
+        """
+        ノードID -> 接続元のノードIDのリスト（接続のあるノードのみ）
+        """
+        return AdjacencyView(self, self.graph.prev)
+
     def to_dict(self):
+        self.expand()
         nodes = [{"index": i, "id": node_id} for i, node_id in enumerate(self.nodes, 1)]
-        connections = []
-        for (from_id, to_id) in self.connections:
-            from_index = self.node_index.get(from_id)
-            to_index   = self.node_index.get(to_id)
-            if from_index is not None and to_index is not None:
-                connections.append({
-                    "from": from_index,
-                    "to": to_index
-                })
+        connections = [{"from": a + 1, "to": b + 1} for a, b in self.graph.edges()]
 
         return {
             "id": self.id,
             "name": self.name,
             "created": self.created.isoformat(),
             "updated": self.updated.isoformat(),
+            "revision": self.revision,
             "description": self.description,
             "nodes": nodes,
             "connections": connections,
         }
 
-    def save(self):
+    def path(self, ext):
+        return os.path.join(self.data_dir, os.path.splitext(self.relpath)[0] + ext)
+
+    def save(self, compact=False):
+        """
+        未保存の操作を編集ログに追記する
+        compact: 編集ログをYAMLに畳み込む（操作数が LOG_COMPACT_OPS を超えた場合や、
+                 編集ログがこのフローのYAMLに対応していない場合も畳み込む）
+        """
+        # 同じフローへの書き込みだけを排他（別のフローへの書き込みは互いに待たない）
+        with FileLock(self.path(".lock")):
+            log_path = self.path(".log")
+            if compact or self.logged + len(self.pending) > LOG_COMPACT_OPS or \
+                    self.read_log_revision(log_path) != self.revision:
+                self.compact(log_path)
+            elif self.pending:
+                recover_torn_line(log_path)
+                with open(log_path, "a", encoding="utf-8") as f:
+                    f.writelines(self.format_ops(self.pending))
+                    f.flush()
+                    os.fsync(f.fileno())
+                self.logged += len(self.pending)
+            self.pending.clear()
+        self.summary_store().put(self)
+        self.ref_store().put(self.id, self.ref_changes)
+        self.ref_changes.clear()
+
+    def summary_store(self):
+        if self.summaries is None:
+            self.summaries = FlowSummaries(self.data_dir)
+        return self.summaries
+
+    def ref_store(self):
+        if self.refs is None:
+            self.refs = NodeRefs(self.data_dir)
+        return self.refs
+
+    def compact(self, log_path):
+        """
+        YAMLを書き直して、新しいリビジョンの空の編集ログを作成する（ロック中に呼び出す）
+        他のプロセスが追記・畳み込みした操作や、部分読み込みで読み込んでいない部分を失わないよう、
+        ファイルから全体を読み込み直して未保存の操作を適用したものを書き込む
+        """
+        if os.path.exists(os.path.join(self.data_dir, self.relpath)):
+            flow = Flow.load(self.data_dir, self.relpath)
+            for _, op, *args in self.pending:
+                # 他のプロセスの変更と両立しない操作は、編集ログの再生と同じく読み飛ばす
+                try:
+                    flow.apply(op, args)
+                except Exception as e:
+                    print(e, file=sys.stderr)
+            flow.updated = max(flow.updated, self.updated)
+        else:
+            # まだ保存していないフローはこのインスタンスの内容を書き込む
+            flow = self
+        flow.write_revision(log_path)
+        self.revision = flow.revision
+        self.logged = 0
+
+    def write_revision(self, log_path):
+        """
+        このインスタンスの内容で次のリビジョンのYAMLと空の編集ログを書き込む
+        YAMLの置き換え後に中断しても、古い編集ログはリビジョンが異なるため再生されない
+        """
+        self.revision += 1
+        # 読み込み中の他のプロセスが書きかけのファイルを見ないよう、一時ファイルから置き換える
         path = os.path.join(self.data_dir, self.relpath)
-        with open(path, "w", encoding="utf-8") as f:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
             yaml.dump(self.to_dict(), f)
+        os.replace(tmp_path, path)
+        self.save_sidecar(yaml_stamp(os.stat(path)))
+        tmp_path = log_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(f"revision\t{self.revision}\n")
+        os.replace(tmp_path, log_path)
+        self.logged = 0
+
+    @staticmethod
+    def format_ops(ops):
+        for updated, *args in ops:
+            yield "\t".join([updated.isoformat(), *args]) + "\n"
+
+    @staticmethod
+    def read_log_revision(log_path):
+        """
+        編集ログの先頭行のリビジョン（なければNone）
+        """
+        try:
+            with open(log_path, "r", encoding="utf-8") as f:
+                name, _, revision = f.readline().rstrip("\n").partition("\t")
+        except FileNotFoundError:
+            return None
+        return int(revision) if name == "revision" and revision.isdigit() else None
+
+    @staticmethod
+    def read_log(log_path, revision):
+        """
+        編集ログの操作の行のリスト（YAMLとリビジョンが異なるログは無視）
+        """
+        try:
+            with open(log_path, "r", encoding="utf-8") as f:
+                lines = f.read().split("\n")
+        except FileNotFoundError:
+            return []
+        name, _, log_revision = lines[0].partition("\t")
+        if name != "revision" or log_revision != str(revision):
+            return []
+        # 最後の要素は改行で終わっていない書きかけの行（空文字列なら完全）
+        return lines[1:-1]
+
+    def apply(self, op, args):
+        """
+        編集ログの形式の操作を適用する
+        """
+        match op:
+            case "connect":
+                self.connect(*(a or None for a in args))
+            case "disconnect":
+                self.disconnect(*args)
+            case "remove":
+                self.remove_node(*args)
+
+    def replay(self, lines):
+        """
+        編集ログの操作（read_log の戻り値）を適用する
+        """
+        for line in lines:
+            # 解釈できない行は失敗した操作と同じく読み飛ばす（行数には数える）
+            try:
+                updated, op, *args = line.split("\t")
+                updated = datetime.fromisoformat(updated)
+            except ValueError as e:
+                print(e, file=sys.stderr)
+            else:
+                try:
+                    self.apply(op, args)
+                except Exception as e:
+                    print(e, file=sys.stderr)
+                self.updated = updated
+            self.logged += 1
+        self.pending.clear()
+        self.ref_changes.clear()
+
+    def save_sidecar(self, stamp):
+        """
+        YAMLの読み込みを省略するためのJSONを書き込む（YAMLの mtime と大きさで鮮度を確認）
+        stamp: このフローの内容を読み込んだ（書き込んだ）YAMLの [mtime_ns, 大きさ]
+        その後に他のプロセスがYAMLを書き直していれば、古い内容を書き込まないよう何もしない
+        nodes はノードIDのリスト、connections は1から始まる番号の組のリスト
+        YAMLから作り直せるため、書き込めなくても無視する
+        """
+        path = os.path.join(self.data_dir, self.relpath)
+        sidecar_path = self.path(".json")
+        try:
+            if yaml_stamp(os.stat(path)) != stamp:
+                return
+            data = {
+                "yaml": stamp,
+                "id": self.id,
+                "name": self.name,
+                "created": self.created.isoformat(),
+                "updated": self.updated.isoformat(),
+                "revision": self.revision,
+                "description": self.description,
+                "nodes": self.nodes,
+                "connections": [[a + 1, b + 1] for a, b in self.graph.edges()],
+            }
+            # ロックせずに書き込むこともあるため、一時ファイルはプロセスごとに分ける
+            tmp_path = f"{sidecar_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp_path, sidecar_path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def load_sidecar(path, sidecar_path):
+        """
+        YAMLと対応するJSONがあれば読み込む（なければNone）
+        """
+        try:
+            with open(sidecar_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            st = os.stat(path)
+        except (OSError, ValueError):
+            return None
+        if data.get("yaml") != yaml_stamp(st):
+            return None
+        return data
 
     @classmethod
-    def load(cls, data_dir, relpath):
+    def load(cls, data_dir, relpath, heads=None, generations=None):
+        """
+        フローを読み込む
+        heads: 指定すれば、これらのノードの祖先だけを読み込む（部分読み込み）
+        generations: 部分読み込みで heads を1世代目として読み込む世代数（Noneなら祖先すべて）
+        """
         path = os.path.join(data_dir, relpath)
-        with open(path, "r", encoding="utf-8") as f:
-            data = yaml.load(f)
-
-        nodes = []
-        index_to_id = {}
-        for node_id in data.get("nodes", []):
-            nodes.append(node_id["id"])
-            index_to_id[node_id["index"]] = node_id["id"]
-        connections = [
-            (index_to_id[f], index_to_id[t])
-            for conn in data.get("connections", [])
-            if (f := conn["from"]) in index_to_id and (t := conn["to"]) in index_to_id
-        ]
-
-        return cls(
+        sidecar_path = os.path.join(data_dir, os.path.splitext(relpath)[0] + ".json")
+        if data := cls.load_sidecar(path, sidecar_path):
+            nodes = data["nodes"]
+            pairs = data["connections"]
+        else:
+            with open(path, "r", encoding="utf-8") as f:
+                # 読み込んだファイルのスタンプ（読み込み中に置き換えられても変わらない）
+                stamp = yaml_stamp(os.fstat(f.fileno()))
+                data = yaml.load(f)
+
+            nodes = []
+            index_to_number = {}
+            for node_id in data.get("nodes", []):
+                nodes.append(node_id["id"])
+                index_to_number[node_id["index"]] = len(nodes)
+            pairs = [
+                (index_to_number[f], index_to_number[t])
+                for conn in data.get("connections", [])
+                if (f := conn["from"]) in index_to_number and (t := conn["to"]) in index_to_number
+            ]
+
+        kwargs = dict(
             id=data["id"],
             name=data.get("name", ""),
             created=datetime.fromisoformat(data["created"]),
             updated=datetime.fromisoformat(data["updated"]),
             description=data.get("description", ""),
-            nodes=nodes,
-            connections=connections,
             data_dir=data_dir,
             relpath=relpath,
+            revision=data.get("revision", 0),
         )
+        lines = cls.read_log(os.path.join(data_dir, os.path.splitext(relpath)[0] + ".log"), kwargs["revision"])
+        if heads is not None and not lines:
+            # 編集ログがなければ、保存された接続から直接選ぶ（JSONは全体を読み込んだときに作成する）
+            return cls.window(nodes, pairs, heads, generations, **kwargs)
+
+        flow = cls(nodes=nodes, connections=[(nodes[f - 1], nodes[t - 1]) for f, t in pairs], **kwargs)
+        if "yaml" not in data:
+            # YAMLを読み込んだ場合は次回のためにJSONを作成
+            flow.save_sidecar(stamp)
+        flow.replay(lines)
+        if heads is not None:
+            # 編集ログを再生した全体から選ぶ
+            kwargs.update(updated=flow.updated)
+            pairs = [(a + 1, b + 1) for a, b in flow.graph.edges()]
+            window = cls.window(flow.nodes, pairs, heads, generations, **kwargs)
+            window.logged = flow.logged
+            return window
+        return flow
+
+    @classmethod
+    def window(cls, nodes, pairs, heads, generations=None, **kwargs):
+        """
+        ノードIDのリストと1から始まる番号の接続のリストから、部分読み込みしたフローを作成
+        heads がどれも含まれていなければ全体を読み込む
+        """
+        starts = [nodes.index(h) + 1 for h in dict.fromkeys(heads) if h in nodes]
+        if not starts:
+            return cls(nodes=list(nodes), connections=[(nodes[f - 1], nodes[t - 1]) for f, t in pairs], **kwargs)
+        selected, border = select_window(len(nodes), pairs, starts, generations)
+        unloaded = bytearray(b"\x01") * (len(nodes) + 1)
+        for n in selected:
+            unloaded[n] = 0
+        connections = [(nodes[f - 1], nodes[t - 1]) for f, t in pairs if not unloaded[f] and not unloaded[t]]
+        flow = cls(nodes=[nodes[n - 1] for n in selected], connections=connections, **kwargs)
+        flow.heads = [nodes[n - 1] for n in starts]
+        flow.generations = generations
+        flow.border = {nodes[n - 1] for n in border}
+        # ノードIDの文字列は保持せず、読み込んでいないノードの操作の検出にハッシュ値だけを使う
+        flow.unloaded = array("q", sorted(map(hash, compress(nodes, unloaded[1:]))))
+        flow.unloaded_edges = len(pairs) - len(connections)
+        flow.tail = nodes[-1]
+        return flow
 
-    def update(self):
+    def maybe_unloaded(self, node_id):
+        """
+        読み込んでいないノードの可能性があるか（ハッシュ値の衝突では誤って True になる）
+        """
+        h = hash(node_id)
+        i = bisect_left(self.unloaded, h)
+        return i < len(self.unloaded) and self.unloaded[i] == h
+
+    def ensure_loaded(self, *node_ids):
+        """
+        部分読み込みで、読み込んでいないノードを操作する前に範囲を広げる
+        """
+        if missing := [n for n in node_ids if n and n not in self.node_index and self.maybe_unloaded(n)]:
+            self.expand(missing)
+
+    def expand(self, heads=None):
+        """
+        部分読み込みの範囲を広げる（heads の祖先を加える、Noneか世代数の指定があれば全体）
+        ファイルから読み込み直して、未保存の操作を適用し直す
+        """
+        if not self.partial:
+            return
+        if heads is None or self.generations is not None:
+            flow = Flow.load(self.data_dir, self.relpath)
+        else:
+            flow = Flow.load(self.data_dir, self.relpath, self.heads + list(heads))
+        for _, op, *args in self.pending:
+            flow.apply(op, args)
+        flow.pending, flow.ref_changes, flow.updated = self.pending, self.ref_changes, self.updated
+        flow.summaries, flow.refs = self.summaries, self.refs
+        # 呼び出し側が持っている参照のため、このインスタンスの中身を入れ替える
+        self.__dict__.update(flow.__dict__)
+
+    def update(self, *op):
+        """
+        更新日時を更新し、操作を未保存の操作に加える
+        """
         self.updated = datetime.now().astimezone()
+        self.pending.append((self.updated, *op))
+
+    def add_node(self, node_id):
+        """
+        ノードを追加（追加済みなら何もしない）
+        戻り値: ノード番号
+        """
+        if (i := self.node_index.get(node_id)) is None:
+            self.nodes.append(node_id)
+            self.node_index[node_id] = i = len(self.nodes)
+            self.graph.add_node()
+            self.ref_changes[node_id] = True
+            if self.partial:
+                self.heads.append(node_id)
+                self.tail = node_id
+        return i - 1
 
     def connect(self, from_id, to_id):
-        if from_id and from_id not in self.nodes:
-            self.nodes.append(from_id)
-            self.node_index[from_id] = len(self.nodes)
-        if to_id and to_id not in self.nodes:
-            self.nodes.append(to_id)
-            self.node_index[to_id] = len(self.nodes)
-        if (from_id, to_id) not in self.connections:
-            if self.would_create_cycle(from_id, to_id):
+        """
+        ノードを接続（どちらかがNoneならノードの追加のみ）
+        """
+        if self.partial:
+            self.ensure_loaded(from_id, to_id)
+            # 親を読み込んでいないノードがあると、既存のノードへの接続で循環を判定できない
+            if self.border and to_id in self.node_index:
+                self.expand()
+        a = self.add_node(from_id) if from_id else None
+        b = self.add_node(to_id) if to_id else None
+        if a is not None and b is not None and not self.graph.has_edge(a, b):
+            if self.would_create_cycle(a, b):
                 raise Exception("循環が検出されました")
-            self.connections.append((from_id, to_id))
-            self.graph_fwd.setdefault(from_id, []).append(to_id)
-            self.graph_rev.setdefault(to_id, []).append(from_id)
-        self.update()
-
-    def would_create_cycle(self, from_id, to_id):
+            self.graph.add_edge(a, b)
+            self.invalidate_histories(b)
+            # 親が1つだけなら、親の履歴の末尾に追加したものが履歴になる（チャットの追記）
+            if self.graph.prev(b) == [a] and (history := self.histories.get(from_id)) is not None:
+                self.histories[to_id] = history + [to_id]
+            if self.partial and from_id in self.heads and to_id in self.heads:
+                # 接続先の祖先に含まれるため、起点から外す
+                self.heads.remove(from_id)
+        self.update("connect", from_id or "", to_id or "")
+
+    def load_connections(self, connections):
         """
-        (from_id, to_id) を追加した場合に循環が発生するか判定（DFS）
+        保存されていた接続をまとめて追加（更新日時は変更しない）
+        1回のトポロジカルソートで循環がないことを確認し、循環があれば
+        1本ずつ追加して循環を作る接続だけを除外する
         """
-        # 確認用にコピーして仮接続
-        graph = {k: v.copy() for k, v in self.graph_fwd.items()}
-        graph.setdefault(from_id, []).append(to_id)
+        index = self.node_index
+        number = lambda n: index[n] - 1 if n in index else self.add_node(n)
+        edges = dict.fromkeys((number(f), number(t)) for f, t in connections if f and t)
+        graph = Graph(len(self.nodes), edges)
+        if graph.is_acyclic():
+            self.graph = graph
+            return
+        updated = self.updated
+        for a, b in edges:
+            try:
+                self.connect(self.nodes[a], self.nodes[b])
+            except Exception as e:
+                print(e, file=sys.stderr)
+        self.updated = updated
 
-        # DFSで循環を検出
-        stack = [to_id]
-        visited = set() # 訪れたノードを記録
+    def would_create_cycle(self, a, b):
+        """
+        ノード番号 a から b への接続を追加した場合に循環が発生するか判定
+        グラフはコピーせず、b から a に到達できるかを深さ優先で探索する
+        """
+        if a == b:
+            return True
+        stack = [b]
+        visited = {b} # 訪れたノードを記録
         while stack:
-            current = stack.pop()
-            if current in visited:
-                continue
-            if current == from_id:
-                # 循環を検出
-                return True
-            visited.add(current)
-            stack.extend(graph.get(current, []))
+            for n in self.graph.next(stack.pop()):
+                if n == a:
+                    # 循環を検出
+                    return True
+                if n not in visited:
+                    visited.add(n)
+                    stack.append(n)
 
         # 循環が検出されなかった
         return False
 
-    def _rebuild_graph(self):
-        """
-        グラフを再構築する（接続が変更された場合に呼び出す）
-        """
-        self.connections = []
-        self.graph_fwd = {}
-        self.graph_rev = {}
-        for from_id, to_id in self.connections:
-            self.graph_fwd.setdefault(from_id, []).append(to_id)
-            self.graph_rev.setdefault(to_id, []).append(from_id)
-
     def disconnect(self, from_id, to_id):
-        if (from_id, to_id) in self.connections:
-            self.connections.remove((from_id, to_id))
-            self._rebuild_graph()
-        self.update()
+        if self.partial:
+            self.ensure_loaded(from_id, to_id)
+        a = self.node_index.get(from_id)
+        b = self.node_index.get(to_id)
+        if a and b and self.graph.has_edge(a - 1, b - 1):
+            self.graph.remove_edge(a - 1, b - 1)
+            self.invalidate_histories(b - 1)
+        self.update("disconnect", from_id, to_id)
 
     def remove_node(self, node_id):
-        for conn in list(self.connections):
-            if node_id in conn:
-                self.connections.remove(conn)
-        if node_id in self.nodes:
-            self.nodes.remove(node_id)
+        if self.partial and (node_id in self.node_index or self.maybe_unloaded(node_id)):
+            # 読み込んでいないノードへの接続も削除されるため、全体を読み込む
+            self.expand()
+        if (i := self.node_index.get(node_id)) is not None:
+            # 後ろのノードの番号が変わるため、グラフも番号を詰めて作り直す
+            for b in self.graph.next(i - 1):
+                self.invalidate_histories(b)
+            self.histories.pop(node_id)
+            self.graph.remove_node(i - 1)
+            del self.nodes[i - 1]
             self.node_index = self._node_index()
-        self._rebuild_graph()
-        self.update()
+            self.ref_changes[node_id] = False
+        self.update("remove", node_id)
 
-    def get_previous(self, node_id):
+    def invalidate_histories(self, b):
         """
-        指定したノードの前のノードを取得
+        ノード番号 b とその子孫の履歴のキャッシュを削除（接続の変更で履歴が変わるノード）
         """
-        return self.graph_rev.get(node_id, [])
+        if not len(self.histories):
+            return
+        stack = [b]
+        visited = {b}
+        while stack:
+            n = stack.pop()
+            self.histories.pop(self.nodes[n])
+            for m in self.graph.next(n):
+                if m not in visited:
+                    visited.add(m)
+                    stack.append(m)
 
-    def get_in_degree_map(self, nodes: set[str]) -> dict[str, int]:
+    def get_previous(self, node_id):
         """
-        指定した部分グラフにおけるノードの入次数を取得
+        指定したノードの前のノードを取得
         """
-        # ルートを限定するため、graph_fwdの個数とは異なる
-        in_degree = {n: 0 for n in nodes}
-        for n in nodes:
-            for m in self.graph_fwd.get(n, []):
-                if m in nodes:
-                    in_degree[m] += 1
-        return in_degree
+        if node_id in self.border:
+            self.expand()
+        if (i := self.node_index.get(node_id)) is None:
+            return []
+        return [self.nodes[n] for n in self.graph.prev(i - 1)]
 
-    def build_history_by_kahn_lifo(self, in_degree: dict[str, int]) -> list[str]:
+    def build_history_by_kahn_lifo(self, in_degree: dict[int, int], starts: list[int] = None) -> list[int]:
         """
         Kahn 法 (LIFO) を用いて履歴を構築する
+        starts: 開始ノード（省略時は入次数が0のノードを番号の順に）
         """
         history = []
-        starts = [n for n in self.nodes if in_degree.get(n, -1) == 0]
-        for node_id in starts:
-            stack = [node_id]
+        if starts is None:
+            starts = sorted(n for n, d in in_degree.items() if d == 0)
+        for n in starts:
+            stack = [n]
             while stack:
                 n = stack.pop()
                 history.append(n)
-                for m in reversed(self.graph_fwd.get(n, [])):
+                for m in reversed(self.graph.next(n)):
+                    if m not in in_degree:
+                        # 部分グラフの外のノードは対象外
+                        continue
                     in_degree[m] -= 1
                     # すべての合流が解消すれば先に進む（分岐のjoin）
                     if in_degree[m] == 0:
@@ -196,82 +673,82 @@ class Flow:
     def get_history(self, node_id: str) -> list[str]:
         """
         指定したノード以前の履歴を取得
+        結果はキャッシュし、呼び出し側で変更できるようコピーを返す
         """
-        if node_id not in self.nodes:
+        if (i := self.node_index.get(node_id)) is None:
             return []
-
-        # 開始ノードから到達出来るノードを深さ優先で探索
-        visited = set()
-        stack = [node_id]
+        if (history := self.histories.get(node_id)) is None:
+            nodes = self.nodes
+            history = [nodes[n] for n in self._get_history(i - 1)]
+            self.histories[node_id] = history
+        return list(history)
+
+    def _get_history(self, b):
+        # 開始ノードから到達出来るノードを深さ優先で探索し、入次数を数える
+        # （祖先の親も祖先のため、部分グラフでの入次数はグラフ全体と同じ）
+        in_degree = {}
+        stack = [b]
         while stack:
             n = stack.pop()
-            if n not in visited:
-                visited.add(n)
-                stack.extend(self.graph_rev.get(n, []))
-
-        in_degree = self.get_in_degree_map(visited)
+            if n not in in_degree:
+                prevs = self.graph.prev(n)
+                in_degree[n] = len(prevs)
+                stack.extend(prevs)
         return self.build_history_by_kahn_lifo(in_degree)
 
-    @staticmethod
-    def merge_overlapping_sets(list_of_sets: list[set[str]]) -> list[set[str]]:
-        """
-        setのlistを渡して、setに重複があれば統合したlistを返す
-        """
-        merged = []
-        for s in list_of_sets:
-            s = s.copy()
-            found = []
-            for m in merged:
-                if s & m:
-                    found.append(m)
-            if found:
-                # すべての重複集合を統合
-                for m in found:
-                    s |= m
-                    merged.remove(m)
-            merged.append(s)
-        return merged
-
-    def get_routes(self):
+    def get_groups(self):
         """
-        すべてのルートを取得
+        つながっているノードのグループを取得
+        戻り値: (ノード番号のリスト, 開始ノードのリスト) のリスト（番号の順）
+        グループは含まれる最後の開始ノードの順に並べる。
         """
-        # 開始ノードを取得
-        starts = [n for n in self.nodes if n not in self.graph_rev]
-
-        # 開始ノードから到達できるノードを深さ優先探索で取得
-        visited = set()
-        routes = []
-        for start in starts:
-            route = set()
-            stack = [start]
-            while stack:
-                n = stack.pop()
-                if n not in route:
-                    route.add(n)
-                    if n not in visited:
-                        stack.extend(self.graph_fwd.get(n, []))
-            routes.append(route)
-            visited.update(route)
-
-        # 循環したノードをチェック（原則的にないはず）
-        left_nodes = set(self.nodes) - visited
+        self.expand()
+        # Union-Find で接続をたどってグループにまとめる
+        parent = list(range(len(self.nodes)))
+
+        def find(n):
+            while (p := parent[n]) != n:
+                parent[n] = n = parent[p]
+            return n
+
+        for a, b in self.graph.edges():
+            a, b = find(a), find(b)
+            if a != b:
+                parent[b] = a
+
+        groups = {}  # 代表ノード -> (ノード, 開始ノード, 最後の開始ノード)
+        in_degree = self.graph.in_degrees()
+        for n in range(len(self.nodes)):
+            group = groups.setdefault(find(n), [[], [], -1])
+            group[0].append(n)
+            if not in_degree[n]:
+                group[1].append(n)
+                group[2] = n
+
+        # 開始ノードから到達できないノードは循環している（原則的にないはず）
+        left_nodes = {self.nodes[n] for nodes, starts, _ in groups.values() if not starts for n in nodes}
         if left_nodes:
             print("循環ノード:", left_nodes, file=sys.stderr)
 
-        # 重複を統合
-        return self.merge_overlapping_sets(routes)
+        ordered = sorted((g for g in groups.values() if g[1]), key=lambda g: g[2])
+        return [(nodes, starts) for nodes, starts, _ in ordered]
+
+    def get_routes(self):
+        """
+        すべてのルートを取得
+        """
+        return [{self.nodes[n] for n in nodes} for nodes, _ in self.get_groups()]
 
     def get_histories(self):
         """
         すべての履歴を取得
         """
-        histories = []
-        for s in self.get_routes():
-            in_degree = self.get_in_degree_map(s)
-            history = self.build_history_by_kahn_lifo(in_degree)
-            histories.append(history)
-        return histories
+        self.expand()
+        # グループの間に接続はないため、入次数は全体で一度に数える
+        in_degree = dict(enumerate(self.graph.in_degrees()))
+        nodes = self.nodes
+        return [[nodes[n] for n in self.build_history_by_kahn_lifo(in_degree, starts)]
+                for _, starts in self.get_groups()]
 
     def convert_map(self, history: list[str]) -> list[str]:
         """
@@ -285,21 +762,22 @@ class Flow:
             - 分岐点（out-degree>1）で"<"、合流点（in-degree>1）で">"を付ける
             - 2行目以降はスペース2つでインデント（ネストは数えない）
         """
-        # history 限定の fwd / rev を構築
+        # ノード番号に変換して history 限定の fwd / rev を構築
+        history = [self.node_index[n] - 1 for n in history]
         in_history = set(history)
-        fwd = {n: [m for m in self.graph_fwd.get(n, []) if m in in_history] for n in history}
+        fwd = {n: [m for m in self.graph.next(n) if m in in_history] for n in history}
         rev = {n: [] for n in history}
         for n in history:
             for m in fwd[n]:
                 rev[m].append(n)
 
-        def idx(n: str) -> str:
-            return str(self.node_index[n])
+        def idx(n: int) -> str:
+            return str(n + 1)
 
         is_branch = lambda n: len(fwd[n]) > 1
         is_merge  = lambda n: len(rev[n]) > 1
 
-        def walk(entry: str, skip_if_merge: bool = False):
+        def walk(entry: int, skip_if_merge: bool = False):
             """
             entry から前方に1直線に進み、分岐・マージ・終端のいずれかで停止する。
             戻り値: (通過ノードのリスト, ("branch"|"merge"|"terminal", 関連ノード or None))
@@ -324,7 +802,7 @@ class Flow:
                     return nodes, ("branch", nxt)
                 current = nxt
 
-        def render(head: str, depth: int, nodes: list[str], end) -> str:
+        def render(head: str, depth: int, nodes: list[int], end) -> str:
             parts = []
             if depth > 0:
                 parts.append("  " * depth)
@@ -339,9 +817,9 @@ class Flow:
                 parts.append(f">{idx(target)}")
             return "".join(parts)
 
-        merge_cont_depth: dict[str, int] = {}
+        merge_cont_depth: dict[int, int] = {}
 
-        def process_branch(branch: str, depth: int):
+        def process_branch(branch: int, depth: int):
             for target in fwd[branch]:
                 sub_nodes, sub_end = walk(target, skip_if_merge=True)
                 lines.append(render(f"{idx(branch)}<", depth, sub_nodes, sub_end))
@@ -376,24 +854,41 @@ class Flow:
 
         return lines
 
+# フロー一覧の並べ替えのキー（FlowManager.get_summaries の要素に対する関数）
+FLOW_SORT_KEYS = {
+    "number": lambda e: e[0],
+    "updated": lambda e: e[2]["updated"],
+    "created": lambda e: e[2]["created"],
+    "name": lambda e: e[2]["name"],
+    "nodes": lambda e: e[2]["nodes"],
+}
+
+# キャッシュの大きさの見積もりに使う、おおよそのバイト数
+FLOW_SIZE = 2048
+NODE_SIZE = 160  # ノードIDの文字列と node_index の要素
+EDGE_SIZE = 48   # 隣接配列の要素（追加直後の接続は辞書のリスト）
+
 class FlowManager(BaseManager):
-    def __init__(self, base_dir="project"):
+    def __init__(self, base_dir="project", **kwargs):
         self.base_dir = base_dir
-        self.cache = {}
         super().__init__(
             data_dir=os.path.join(base_dir, "flows"),
             ext="yaml",
+            **kwargs,
         )
+        self.summaries = FlowSummaries(self.data_dir)
+        self.refs = NodeRefs(self.data_dir)
 
     def get_uuid_and_timestamp_from_file(self, path):
         try:
             id, updated = None, None
             with open(path, "r", encoding="utf-8") as f:
                 for line in f:
+                    # 値にコロンを含む場合や、YAMLで引用符が付く場合を考慮
                     if line.startswith("id:"):
-                        id = line.split(":")[1].strip()
+                        id = line.split(":", 1)[1].strip().strip("'\"")
                     elif line.startswith("updated:"):
-                        updated = line.split(":")[1].strip()
+                        updated = line.split(":", 1)[1].strip().strip("'\"")
                     if id and updated:
                         return id, datetime.fromisoformat(updated)
         except Exception:
@@ -401,43 +896,127 @@ class FlowManager(BaseManager):
         # 取得できなかった場合はゼロUUIDと現在のタイムスタンプを返す
         return str(uuid.UUID(int=0)), datetime.now().astimezone()
 
-    def get_flow(self, flow_id):
+    def sizeof(self, flow):
+        """
+        Flowのおおよそのバイト数（ノードと接続の数から見積もる）
+        """
+        # キャッシュした履歴はノードIDへの参照のリスト、部分読み込みでは読み込んでいないノードのハッシュ値も数える
+        return FLOW_SIZE + NODE_SIZE * len(flow.nodes) + EDGE_SIZE * len(flow.graph) + \
+            8 * (flow.histories.bytes + len(flow.unloaded))
+
+    def get_flow(self, flow_id, heads=None, generations=None):
         """
         UUIDからFlowインスタンスを取得
+        heads, generations: 部分読み込みの範囲（Flow.load と同じ、省略時は全体）
         """
         if flow := self.cache.get(flow_id):
-            # キャッシュにある場合はキャッシュから取得
+            # キャッシュにある場合はキャッシュから取得（部分読み込みなら必要に応じて範囲を広げる）
+            if heads is None:
+                flow.expand()
+            elif not all(h in flow.node_index for h in heads):
+                flow.expand(heads)
             return flow
         if flow_id in self.uuid_map:
             # キャッシュにない場合はファイルから読み込む
             relpath = self.uuid_map[flow_id][0]
-            flow = Flow.load(self.data_dir, relpath)
+            flow = Flow.load(self.data_dir, relpath, heads, generations)
+            flow.summaries = self.summaries
+            flow.refs = self.refs
             self.cache[flow_id] = flow
             return flow
         raise FileNotFoundError(f"Flow with ID {flow_id} not found.")
 
-    def create_flow(self, name, description=""):
-        relpath = self.get_next_relpath_and_folder()
-
-        # 新規作成
-        flow_id = self.generate_uuid()
-        timestamp = datetime.now().astimezone()
-        flow = Flow(
-            id=flow_id,
-            name=name,
-            created=timestamp,
-            updated=timestamp,
-            description=description,
-            nodes=[],
-            connections=[],
-            data_dir=self.data_dir,
-            relpath=relpath,
-        )
-        flow.save()
+    def get_summaries(self):
+        """
+        (番号, relpath, 要約) のリスト（番号はインデックスの順で、フローの選択に使う）
+        要約のないフロー（要約の導入前に保存したもの）は読み込んで要約を追記する
+        """
+        self.summaries.refresh()
+        entries = list(self.tsv_entries.items())
+        missing = [id for _, (id, _) in entries if self.summaries.get(id) is None]
+        for id in missing:
+            self.summaries.put(self.get_flow(id))
+        if missing:
+            self.summaries.refresh()
+        return [(number, relpath, s)
+                for number, (relpath, (id, _)) in enumerate(entries, 1)
+                if (s := self.summaries.get(id))]
+
+    def get_last_node(self, flow_id):
+        """
+        フロー全体で最後に追加したノードID（フローを読み込まずに要約から取得、なければNone）
+        """
+        self.summaries.refresh()
+        if s := self.summaries.get(flow_id):
+            return s["head"] or None
+        return None
 
-        # キャッシュ・TSV追記
-        self.cache[flow_id] = flow
-        self.add_entry(relpath, flow_id, timestamp)
-        self.append_index(relpath, flow_id, timestamp)
+    def rebuild_refs(self, progress=None):
+        """
+        すべてのフローを読み込んで、ノードからフローへの逆引きインデックスを作り直す
+        読み込んだフローはキャッシュに入れない
+        戻り値: フローの数
+        """
+        entries = list(self.tsv_entries.items())
+        flows = []
+        for i, (relpath, (id, _)) in enumerate(entries, 1):
+            flow = self.cache.get(id)
+            if flow is None or flow.partial:
+                flow = Flow.load(self.data_dir, relpath)
+            flows.append((id, flow.nodes))
+            if progress:
+                progress(i, len(entries))
+        self.refs.rebuild(flows)
+        return len(flows)
+
+    def refresh_refs(self):
+        """
+        他のプロセスの追記を読み込む（逆引きインデックスがなければ作り直す）
+        """
+        if not self.refs.exists() and len(self.tsv_entries):
+            self.rebuild_refs()
+        self.refs.refresh()
 
-        return flow
+    def get_flows_of_node(self, node_id):
+        """
+        ノードを含むフローのIDのリスト
+        """
+        self.refresh_refs()
+        return self.refs.get(node_id)
+
+    def orphan_nodes(self, node_ids):
+        """
+        どのフローにも含まれないノードのIDのリスト
+        """
+        self.refresh_refs()
+        return [node_id for node_id in node_ids if not self.refs.get(node_id)]
+
+    def create_flow(self, name, description=""):
+        # 他のプロセスと同じrelpathを使わないよう、作成からTSV追記までをロック
+        with self.locked():
+            relpath = self.get_next_relpath_and_folder()
+
+            # 新規作成
+            flow_id = self.generate_uuid()
+            timestamp = datetime.now().astimezone()
+            flow = Flow(
+                id=flow_id,
+                name=name,
+                created=timestamp,
+                updated=timestamp,
+                description=description,
+                nodes=[],
+                connections=[],
+                data_dir=self.data_dir,
+                relpath=relpath,
+            )
+            flow.summaries = self.summaries
+            flow.refs = self.refs
+            flow.save()
+
+            # キャッシュ・TSV追記
+            self.cache[flow_id] = flow
+            self.add_entry(relpath, flow_id, timestamp)
+            self.append_index(relpath, flow_id, timestamp)
+
+            return flow
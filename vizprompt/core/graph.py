@@ -0,0 +1,178 @@
+import operator
+from array import array
+from collections import Counter
+from itertools import accumulate, chain
+
+# 構築後に追加・削除した接続がこの数と構築時の接続数の半分を超えたら配列を作り直す
+REBUILD_MIN = 256
+
+def build_csr(size, keys, values):
+    """
+    CSR 形式の隣接配列を作成（同じキーの値は元の順）
+    戻り値: (offsets, values, positions) positions は各値の元の位置
+    """
+    # 安定ソートでキーごとにまとめる（ループは組み込み関数の中で回す）
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+    counts = Counter(keys)
+    offsets = array("i", accumulate(map(counts.__getitem__, range(size)), initial=0))
+    return offsets, array("i", map(values.__getitem__, order)), array("i", order)
+
+class Graph:
+    """
+    0から始まる整数のノード番号による有向グラフ（接続の追加順を保持）
+
+    構築時の接続は CSR 形式の配列（offsets, targets）に、順方向と逆方向の両方で格納する。
+    その後に追加した接続は辞書のリストに追記し、削除した接続は配列の値を -1 にする。
+    追加・削除が多くなれば配列を作り直す。ノードの削除では後ろのノードの番号を詰める。
+    """
+    def __init__(self, size=0, edges=()):
+        self.build(size, list(edges))
+
+    def build(self, size, edges):
+        self.size = size
+        self.src = array("i", [a for a, _ in edges])  # 構築時の接続（追加順、削除は -1）
+        self.dst = array("i", [b for _, b in edges])
+        self.fwd_offsets, self.fwd, self.fwd_pos = build_csr(size, self.src, self.dst)
+        self.rev_offsets, self.rev, _ = build_csr(size, self.dst, self.src)
+        self.extra = []      # 構築後に追加した接続 (a, b) のリスト（追加順）
+        self.extra_fwd = {}  # a -> 構築後に追加した b のリスト
+        self.extra_rev = {}  # b -> 構築後に追加した a のリスト
+        self.removed = 0     # 配列から削除した接続の数
+        self.edge_count = len(edges)
+
+    def rebuild(self, size=None, renumber=None):
+        """
+        接続を追加順に並べて配列を作り直す
+        renumber: ノード番号の変換関数（Noneを返した接続は除外）
+        """
+        edges = self.edges()
+        if renumber:
+            edges = [(a, b) for a, b in ((renumber(a), renumber(b)) for a, b in edges)
+                     if a is not None and b is not None]
+        self.build(self.size if size is None else size, list(edges))
+
+    def maybe_rebuild(self):
+        if len(self.extra) + self.removed > max(REBUILD_MIN, len(self.src) // 2):
+            self.rebuild()
+
+    def __len__(self):
+        return self.edge_count
+
+    def add_node(self):
+        """
+        ノードを追加して番号を返す
+        """
+        self.fwd_offsets.append(self.fwd_offsets[-1])
+        self.rev_offsets.append(self.rev_offsets[-1])
+        self.size += 1
+        return self.size - 1
+
+    def remove_node(self, k):
+        """
+        ノードとその接続を削除し、後ろのノードの番号を1つずつ詰める
+        """
+        self.rebuild(self.size - 1, lambda n: None if n == k else n - (n > k))
+
+    def next(self, a):
+        """
+        a から出る接続の先のノード（追加順）
+        """
+        nodes = self.fwd[self.fwd_offsets[a]:self.fwd_offsets[a + 1]].tolist()
+        if self.removed:
+            nodes = [n for n in nodes if n >= 0]
+        if extra := self.extra_fwd.get(a):
+            nodes += extra
+        return nodes
+
+    def prev(self, b):
+        """
+        b に入る接続の元のノード（追加順）
+        """
+        nodes = self.rev[self.rev_offsets[b]:self.rev_offsets[b + 1]].tolist()
+        if self.removed:
+            nodes = [n for n in nodes if n >= 0]
+        if extra := self.extra_rev.get(b):
+            nodes += extra
+        return nodes
+
+    def has_edge(self, a, b):
+        return b in self.fwd[self.fwd_offsets[a]:self.fwd_offsets[a + 1]] or \
+            b in self.extra_fwd.get(a, ())
+
+    def add_edge(self, a, b):
+        self.extra.append((a, b))
+        self.extra_fwd.setdefault(a, []).append(b)
+        self.extra_rev.setdefault(b, []).append(a)
+        self.edge_count += 1
+        self.maybe_rebuild()
+
+    def remove_edge(self, a, b):
+        """
+        接続を削除（存在する前提）
+        """
+        self.edge_count -= 1
+        if b in (extra := self.extra_fwd.get(a, ())):
+            extra.remove(b)
+            if not extra:
+                del self.extra_fwd[a]
+            extra = self.extra_rev[b]
+            extra.remove(a)
+            if not extra:
+                del self.extra_rev[b]
+            self.extra.remove((a, b))
+            return
+        start, end = self.fwd_offsets[a], self.fwd_offsets[a + 1]
+        p = self.fwd.index(b, start, end)
+        self.fwd[p] = -1
+        self.src[self.fwd_pos[p]] = -1
+        start, end = self.rev_offsets[b], self.rev_offsets[b + 1]
+        self.rev[self.rev.index(a, start, end)] = -1
+        self.removed += 1
+        self.maybe_rebuild()
+
+    def in_degrees(self):
+        """
+        ノードごとの入次数のリスト
+        """
+        if self.removed:
+            degrees = [0] * self.size
+            for _, b in self.edges():
+                degrees[b] += 1
+            return degrees
+        o = self.rev_offsets
+        degrees = list(map(operator.sub, o[1:], o[:-1]))
+        for b, prevs in self.extra_rev.items():
+            degrees[b] += len(prevs)
+        return degrees
+
+    def is_acyclic(self):
+        """
+        グラフに循環がないか判定（Kahn法）
+        """
+        # 番号の小さいノードから大きいノードへの接続だけなら循環はない（チャットの追記）
+        if all(map(operator.lt, self.src, self.dst)) and all(a < b for a, b in self.extra):
+            return True
+        in_degree = self.in_degrees()
+        stack = [n for n, d in enumerate(in_degree) if d == 0]
+        count = len(stack)
+        fwd, offsets, extra = self.fwd, self.fwd_offsets, self.extra_fwd
+        while stack:
+            n = stack.pop()
+            for m in chain(fwd[offsets[n]:offsets[n + 1]], extra.get(n, ())):
+                if m < 0:
+                    continue
+                in_degree[m] -= 1
+                if in_degree[m] == 0:
+                    stack.append(m)
+                    count += 1
+        # すべてのノードを取り出せれば循環はない
+        return count == self.size
+
+    def edges(self):
+        """
+        接続 (a, b) のリスト（追加順）
+        """
+        edges = list(zip(self.src, self.dst))
+        if self.removed:
+            edges = [e for e in edges if e[0] >= 0]
+        return edges + self.extra
@@ -0,0 +1,641 @@
+import os, re, sys, bisect, sqlite3
+from array import array
+from vizprompt.core.journal import recover_torn_line
+from collections.abc import Mapping, ItemsView
+from datetime import datetime, timezone, timedelta
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+def parse_timestamp(text):
+    """
+    TSVのタイムスタンプを解釈（不正なら現在時刻）
+    """
+    try:
+        return datetime.fromisoformat(text)
+    except Exception:
+        return datetime.now().astimezone()
+
+def to_micros(timestamp):
+    """
+    タイムスタンプをUTCのエポックからのマイクロ秒に変換
+    """
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.astimezone()
+    return (timestamp - EPOCH) // MICROSECOND
+
+def read_tsv(map_path):
+    """
+    TSVファイルから (relpath, uuid, timestamp) を順に読み込む
+    """
+    if not os.path.exists(map_path):
+        return
+    with open(map_path, encoding="utf-8") as f:
+        first = True
+        for line in f:
+            if first:
+                first = False
+                if line.strip().lower().startswith("relpath"):
+                    continue
+            parts = line.strip().split("\t")
+            if len(parts) == 3:
+                relpath, uuid, timestamp = parts
+                yield relpath, uuid, parse_timestamp(timestamp)
+
+def write_tsv(map_path, items):
+    """
+    TSVファイル全体を保存（一時ファイルに書いてから置き換える）
+    """
+    tmp_path = map_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write("relpath\tuuid\ttimestamp\n")
+        for relpath, (uuid, timestamp) in items:
+            print(tsv_line(relpath, uuid, timestamp), file=f)
+    os.replace(tmp_path, map_path)
+
+def file_id(path):
+    """
+    ファイルの同一性と大きさ ((st_dev, st_ino), st_size)（なければ (None, 0)）
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None, 0
+    return (st.st_dev, st.st_ino), st.st_size
+
+def read_tsv_tail(map_path, offset):
+    """
+    TSVファイルの offset 以降に追記された完全な行を読み込む
+    戻り値: ([(relpath, uuid, timestamp)], 読み込んだ末尾の位置)
+    """
+    entries = []
+    with open(map_path, "rb") as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b"\n") + 1
+    for line in data[:end].decode("utf-8").splitlines():
+        parts = line.strip().split("\t")
+        if len(parts) == 3 and parts[0].lower() != "relpath":
+            relpath, uuid, timestamp = parts
+            entries.append((relpath, uuid, parse_timestamp(timestamp)))
+    return entries, offset + end
+
+def tsv_line(relpath, uuid, timestamp):
+    return f"{relpath}\t{uuid}\t{timestamp.isoformat()}"
+
+def folder_of(relpath):
+    return relpath.split("/", 1)[0]
+
+NAIVE = -(2 ** 31)  # タイムゾーンのないタイムスタンプを表すUTCオフセット
+
+ZERO_UUID = bytes(16)
+
+def uuid_key(uuid):
+    """
+    UUID文字列を16バイトに変換（小文字の標準表記でなければインターンした文字列のまま）
+    """
+    if len(uuid) == 36 and uuid[8] == uuid[13] == uuid[18] == uuid[23] == "-" and uuid == uuid.lower():
+        try:
+            return bytes.fromhex(uuid.replace("-", ""))
+        except ValueError:
+            pass
+    return sys.intern(uuid)
+
+def uuid_str(key):
+    if isinstance(key, str):
+        return key
+    h = key.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+class TsvIndex:
+    """
+    index.tsv の内容をすべてメモリに展開するインデックス
+
+    メモリを節約するため、エントリは行番号で管理し、列ごとに配列で保持する。
+    - relpath: 3桁表記 (000/000.xml) ならフォルダ番号・ファイル番号の整数
+    - uuid: 16バイト（標準表記でなければ文字列）
+    - timestamp: UTCのエポックからのマイクロ秒とUTCオフセット（秒）
+    削除した行は再利用せず、TSVを書き直して読み込み直すときに詰める。
+    UUIDごとの行番号のリストは (-タイムスタンプ, -追加順) の順に並べ、二分探索で挿入位置を求める。
+    """
+    name = "tsv"
+
+    def __init__(self, data_dir, slots, journal):
+        self.map_path = os.path.join(data_dir, "index.tsv")
+        self.slots = slots
+        self.journal = journal
+        self.relpath_regex = re.compile(r"([0-9]{3})/([0-9]{3})\." + re.escape(slots.ext))
+        self.epochs = {}    # UTCオフセット -> その時刻帯のエポック
+        self.file_id = None # 読み込んだTSVファイルの同一性
+        self.offset = 0     # 読み込み・書き込み済みの末尾の位置
+        self.clear()
+
+    def clear(self):
+        self.folders = array("i")   # 行 -> フォルダ番号（3桁表記でなければ -1）
+        self.files = array("i")     # 行 -> ファイル番号
+        self.uuid_bytes = bytearray() # 行 -> 16バイトのUUID（16バイトずつ）
+        self.times = array("q")     # 行 -> UTCのエポックからのマイクロ秒
+        self.offsets = array("i")   # 行 -> UTCオフセット（秒）
+        self.seqs = array("q")      # 行 -> 追加順
+        self.alive = bytearray()    # 行 -> 削除済みなら0
+        self.slot_rows = array("i") # フォルダ番号*1000+ファイル番号 -> 行+1（未登録なら0）
+        self.odd_rows = {}          # 3桁表記でないrelpath -> 行
+        self.odd_relpaths = {}      # 行 -> 3桁表記でないrelpath
+        self.odd_uuids = {}         # 行 -> 16バイトで表せないUUID文字列
+        self.uuid_rows = {}         # UUIDのキー -> 行、衝突があれば優先順の行のリスト
+        self.count = 0
+        self.seq = 0
+
+    def locate(self, relpath):
+        """
+        relpathの検索キー（3桁表記なら フォルダ番号*1000+ファイル番号、それ以外は文字列）と行番号
+        """
+        if m := self.relpath_regex.fullmatch(relpath):
+            k = int(m[1]) * 1000 + int(m[2])
+            if k < len(self.slot_rows) and (row := self.slot_rows[k]):
+                return k, row - 1
+            return k, None
+        return relpath, self.odd_rows.get(relpath)
+
+    def find(self, relpath):
+        """
+        relpathの行番号（なければNone）
+        """
+        return self.locate(relpath)[1]
+
+    def relpath(self, row):
+        if (folder := self.folders[row]) < 0:
+            return self.odd_relpaths[row]
+        return f"{folder:03}/{self.files[row]:03}.{self.slots.ext}"
+
+    def uuid_key(self, row):
+        if (key := self.odd_uuids.get(row)) is not None:
+            return key
+        return bytes(self.uuid_bytes[row * 16:row * 16 + 16])
+
+    def timestamp(self, row):
+        if (offset := self.offsets[row]) == NAIVE:
+            t = EPOCH + timedelta(microseconds=self.times[row])
+            return t.astimezone().replace(tzinfo=None)
+        # UTCオフセットごとにその時刻帯で表したエポックを用意して加算
+        if (epoch := self.epochs.get(offset)) is None:
+            epoch = self.epochs[offset] = EPOCH.astimezone(timezone(timedelta(seconds=offset)))
+        return epoch + timedelta(microseconds=self.times[row])
+
+    def sort_key(self, row):
+        # タイムスタンプ降順（新しい順）、同一なら後から追加した順
+        return -self.times[row], -self.seqs[row]
+
+    def new_row(self, k):
+        """
+        locate() で得た検索キーの行を追加
+        """
+        row = len(self.folders)
+        if isinstance(k, int):
+            if k >= len(self.slot_rows):
+                # フォルダ単位で拡張
+                self.slot_rows.frombytes(bytes(self.slot_rows.itemsize * (k // 1000 * 1000 + 1000 - len(self.slot_rows))))
+            self.slot_rows[k] = row + 1
+            self.folders.append(k // 1000)
+            self.files.append(k % 1000)
+        else:
+            self.odd_rows[k] = row
+            self.odd_relpaths[row] = k
+            self.folders.append(-1)
+            self.files.append(-1)
+        self.uuid_bytes += ZERO_UUID
+        self.times.append(0)
+        self.offsets.append(0)
+        self.seqs.append(0)
+        self.alive.append(1)
+        self.count += 1
+        return row
+
+    def set_row(self, row, uuid, timestamp):
+        key = uuid_key(uuid)
+        if isinstance(key, str):
+            self.odd_uuids[row] = key
+        else:
+            self.odd_uuids.pop(row, None)
+            self.uuid_bytes[row * 16:row * 16 + 16] = key
+        if (offset := timestamp.utcoffset()) is None:
+            self.offsets[row] = NAIVE
+            timestamp = timestamp.astimezone()
+        else:
+            self.offsets[row] = offset // timedelta(seconds=1)
+        self.times[row] = (timestamp - EPOCH) // MICROSECOND
+        self.seq += 1
+        self.seqs[row] = self.seq
+        return key
+
+    def load(self):
+        """
+        TSVファイルを読み込む
+        UUIDごとのリストは全件読み込んでから一括でソートする
+        書き込み途中で中断した末尾の行は捨てる（ファイルはフォルダの走査で再登録される）
+        """
+        self.journal.close()
+        recover_torn_line(self.map_path)
+        self.file_id, self.offset = file_id(self.map_path)
+        self.clear()
+        uuid_rows = self.uuid_rows
+        for relpath, uuid, timestamp in read_tsv(self.map_path):
+            k, row = self.locate(relpath)
+            if row is None:
+                row = self.new_row(k)
+            else:
+                # 同じrelpathの行が重複していれば後の行で上書き
+                self.unlink(row)
+            key = self.set_row(row, uuid, timestamp)
+            if (rows := uuid_rows.get(key)) is None:
+                uuid_rows[key] = row
+            elif isinstance(rows, int):
+                uuid_rows[key] = [rows, row]
+            else:
+                rows.append(row)
+        for rows in uuid_rows.values():
+            if not isinstance(rows, int):
+                rows.sort(key=self.sort_key)
+
+    def add(self, relpath, uuid, timestamp):
+        k, row = self.locate(relpath)
+        if row is None:
+            row = self.new_row(k)
+        else:
+            self.unlink(row)
+        key = self.set_row(row, uuid, timestamp)
+        if (rows := self.uuid_rows.get(key)) is None:
+            self.uuid_rows[key] = row
+            return
+        if isinstance(rows, int):
+            rows = self.uuid_rows[key] = [rows]
+        bisect.insort(rows, row, key=self.sort_key)
+
+    def remove(self, relpath):
+        if (row := self.find(relpath)) is None:
+            raise KeyError(relpath)
+        self.unlink(row)
+        self.alive[row] = 0
+        self.count -= 1
+        if self.folders[row] < 0:
+            del self.odd_rows[relpath]
+        else:
+            self.slot_rows[self.folders[row] * 1000 + self.files[row]] = 0
+
+    def unlink(self, row):
+        """
+        UUIDごとのリストから行を取り除く
+        """
+        key = self.uuid_key(row)
+        rows = self.uuid_rows[key]
+        if isinstance(rows, int):
+            del self.uuid_rows[key]
+            return
+        rows.remove(row)
+        if len(rows) == 1:
+            self.uuid_rows[key] = rows[0]
+
+    def rows(self):
+        return (row for row in range(len(self.folders)) if self.alive[row])
+
+    def get(self, relpath):
+        if (row := self.find(relpath)) is None:
+            return None
+        return uuid_str(self.uuid_key(row)), self.timestamp(row)
+
+    def __contains__(self, relpath):
+        return self.find(relpath) is not None
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return (self.relpath(row) for row in self.rows())
+
+    def items(self):
+        relpath, uuid_key, timestamp = self.relpath, self.uuid_key, self.timestamp
+        for row in self.rows():
+            yield relpath(row), (uuid_str(uuid_key(row)), timestamp(row))
+
+    def relpaths(self, uuid):
+        """
+        UUIDに対応するrelpathのリスト（優先順）
+        """
+        if (rows := self.uuid_rows.get(uuid_key(uuid))) is None:
+            return []
+        if isinstance(rows, int):
+            return [self.relpath(rows)]
+        return [self.relpath(row) for row in rows]
+
+    def has_uuid(self, uuid):
+        return uuid_key(uuid) in self.uuid_rows
+
+    def uuids(self):
+        return (uuid_str(key) for key in self.uuid_rows)
+
+    def count_uuids(self):
+        return len(self.uuid_rows)
+
+    def folder_name(self, row):
+        if (folder := self.folders[row]) < 0:
+            return folder_of(self.odd_relpaths[row])
+        return f"{folder:03}"
+
+    def folder_counts(self):
+        counts = {}
+        for row in self.rows():
+            folder = self.folder_name(row)
+            counts[folder] = counts.get(folder, 0) + 1
+        return counts
+
+    def folder_relpaths(self, folders):
+        """
+        指定したフォルダのrelpathをフォルダごとに取得
+        """
+        result = {folder: [] for folder in folders}
+        if result:
+            for row in self.rows():
+                if (lst := result.get(self.folder_name(row))) is not None:
+                    lst.append(self.relpath(row))
+        return result
+
+    def sync_slots(self, slots):
+        """
+        全エントリを空きスロット情報に反映
+        """
+        for relpath in self:
+            slots.mark_used(relpath)
+
+    def count_slots_below(self, slots):
+        """
+        空きスロット情報のcursorより前にある使用済みスロット数
+        """
+        count = 0
+        for relpath in self:
+            if (key := slots.key(relpath)) is not None and slots.below_cursor(key):
+                count += 1
+        return count
+
+    def save(self):
+        self.journal.close()
+        write_tsv(self.map_path, self.items())
+        self.file_id, self.offset = file_id(self.map_path)
+
+    def append(self, relpath, uuid, timestamp):
+        if os.path.exists(self.map_path):
+            self.journal.append(tsv_line(relpath, uuid, timestamp))
+        else:
+            # TSVファイルが存在しない場合は新規作成
+            self.save()
+
+    def flush(self):
+        """
+        追記をフラッシュし、書き込み済みの位置を記録
+        """
+        self.journal.flush()
+        self.file_id, self.offset = file_id(self.map_path)
+
+    def release(self):
+        """
+        ロックの解放時に呼ぶ（未フラッシュの追記は Journal の方針でフラッシュする）
+        その間に他のプロセスがファイルから同じエントリを登録していれば、Journal はその行を書き込まない
+        """
+
+    def refresh(self, slots):
+        """
+        他のプロセスによる変更を読み込む（ロック中に呼び出す）
+        追記されていれば差分だけを読み、書き直されていれば全体を読み直す
+        （未フラッシュの自分の追記は load で新しいファイルに書き込む）
+        """
+        current, size = file_id(self.map_path)
+        if current is None:
+            return
+        if current != self.file_id or size < self.offset:
+            self.load()
+            slots.reset()
+            self.sync_slots(slots)
+            return
+        if size > self.offset:
+            recover_torn_line(self.map_path)
+            entries, self.offset = read_tsv_tail(self.map_path, self.offset)
+            for relpath, uuid, timestamp in entries:
+                if self.get(relpath) != (uuid, timestamp):
+                    self.add(relpath, uuid, timestamp)
+                    slots.mark_used(relpath)
+
+    def close(self):
+        self.journal.close()
+
+class SqliteIndex:
+    """
+    index.db (SQLite) を使うインデックス
+    全体をメモリに展開せず、UUIDやフォルダでの検索はSQLiteの索引を使う
+    index.tsv はGitでの管理用に同じ内容を書き出す
+    """
+    name = "sqlite"
+
+    def __init__(self, data_dir, slots, journal):
+        self.map_path = os.path.join(data_dir, "index.tsv")
+        self.db_path = os.path.join(data_dir, "index.db")
+        self.slots = slots
+        self.journal = journal
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                relpath   TEXT PRIMARY KEY,
+                folder    TEXT NOT NULL,
+                uuid      TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                ts        INTEGER NOT NULL,
+                slot      INTEGER,
+                seq       INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_uuid ON entries (uuid, ts, seq);
+            CREATE INDEX IF NOT EXISTS entries_folder ON entries (folder);
+            CREATE INDEX IF NOT EXISTS entries_slot ON entries (slot);
+            CREATE INDEX IF NOT EXISTS entries_seq ON entries (seq);
+        """)
+        self.seq = self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM entries").fetchone()[0]
+
+    def load(self):
+        pass
+
+    def add(self, relpath, uuid, timestamp):
+        self.seq += 1
+        key = self.slots.key(relpath)
+        slot = None if key is None else self.slots.ordinal(key)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (relpath, folder_of(relpath), uuid, timestamp.isoformat(), to_micros(timestamp), slot, self.seq),
+        )
+
+    def remove(self, relpath):
+        self.conn.execute("DELETE FROM entries WHERE relpath = ?", (relpath,))
+
+    def get(self, relpath):
+        row = self.conn.execute(
+            "SELECT uuid, timestamp FROM entries WHERE relpath = ?", (relpath,)
+        ).fetchone()
+        return None if row is None else (row[0], parse_timestamp(row[1]))
+
+    def __contains__(self, relpath):
+        return self.conn.execute(
+            "SELECT 1 FROM entries WHERE relpath = ?", (relpath,)
+        ).fetchone() is not None
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def __iter__(self):
+        for (relpath,) in self.conn.execute("SELECT relpath FROM entries ORDER BY seq"):
+            yield relpath
+
+    def items(self):
+        for relpath, uuid, timestamp in self.conn.execute(
+            "SELECT relpath, uuid, timestamp FROM entries ORDER BY seq"
+        ):
+            yield relpath, (uuid, parse_timestamp(timestamp))
+
+    def relpaths(self, uuid):
+        return [relpath for (relpath,) in self.conn.execute(
+            "SELECT relpath FROM entries WHERE uuid = ? ORDER BY ts DESC, seq DESC", (uuid,)
+        )]
+
+    def has_uuid(self, uuid):
+        return self.conn.execute(
+            "SELECT 1 FROM entries WHERE uuid = ? LIMIT 1", (uuid,)
+        ).fetchone() is not None
+
+    def uuids(self):
+        for (uuid,) in self.conn.execute("SELECT DISTINCT uuid FROM entries"):
+            yield uuid
+
+    def count_uuids(self):
+        return self.conn.execute("SELECT COUNT(DISTINCT uuid) FROM entries").fetchone()[0]
+
+    def folder_counts(self):
+        return dict(self.conn.execute("SELECT folder, COUNT(*) FROM entries GROUP BY folder"))
+
+    def folder_relpaths(self, folders):
+        return {
+            folder: [relpath for (relpath,) in self.conn.execute(
+                "SELECT relpath FROM entries WHERE folder = ? ORDER BY seq", (folder,)
+            )]
+            for folder in folders
+        }
+
+    def sync_slots(self, slots):
+        """
+        前回保存以降に使われたスロットを空きスロット情報に反映
+        割り当ては空きの先頭から行うため、確認は空きとcursor以降だけでよい
+        """
+        for key in list(slots.hole_set):
+            if slots.relpath(key) in self:
+                slots.mark_used(slots.relpath(key))
+        if slots.cursor is not None:
+            for (relpath,) in self.conn.execute(
+                "SELECT relpath FROM entries WHERE slot >= ? ORDER BY slot", (slots.ordinal(slots.cursor),)
+            ):
+                slots.mark_used(relpath)
+
+    def count_slots_below(self, slots):
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM entries WHERE slot < ?", (slots.ordinal(slots.cursor),)
+        ).fetchone()[0]
+
+    def save(self):
+        self.conn.commit()
+        self.journal.close()
+        write_tsv(self.map_path, self.items())
+
+    def append(self, relpath, uuid, timestamp):
+        self.conn.commit()
+        if os.path.exists(self.map_path):
+            self.journal.append(tsv_line(relpath, uuid, timestamp))
+        else:
+            self.save()
+
+    def flush(self):
+        self.conn.commit()
+        self.journal.flush()
+
+    def release(self):
+        """
+        ロックの解放時に呼ぶ（データベースは確定し、index.tsv は Journal の方針でフラッシュする）
+        """
+        self.conn.commit()
+
+    def refresh(self, slots):
+        """
+        他のプロセスによる変更を読み込む（ロック中に呼び出す）
+        データベースは共有されているため、追加順の番号と空きスロット情報だけを更新する
+        """
+        self.seq = self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM entries").fetchone()[0]
+        self.sync_slots(slots)
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+        self.journal.close()
+
+INDEX_BACKENDS = {
+    TsvIndex.name: TsvIndex,
+    SqliteIndex.name: SqliteIndex,
+}
+
+def detect_backend(data_dir):
+    """
+    既存のファイルからバックエンドを判定（index.db があればSQLite）
+    """
+    if os.path.exists(os.path.join(data_dir, "index.db")):
+        return SqliteIndex.name
+    return TsvIndex.name
+
+class IndexEntries(Mapping):
+    """
+    relpath -> (uuid, timestamp) のビュー
+    """
+    def __init__(self, index):
+        self.index = index
+
+    def __getitem__(self, relpath):
+        if (entry := self.index.get(relpath)) is None:
+            raise KeyError(relpath)
+        return entry
+
+    def __contains__(self, relpath):
+        return relpath in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def items(self):
+        return IndexItems(self)
+
+class IndexItems(ItemsView):
+    def __iter__(self):
+        return self._mapping.index.items()
+
+class UuidMap(Mapping):
+    """
+    uuid -> [relpath] のビュー（リストは優先順）
+    """
+    def __init__(self, index):
+        self.index = index
+
+    def __getitem__(self, uuid):
+        if not (relpaths := self.index.relpaths(uuid)):
+            raise KeyError(uuid)
+        return relpaths
+
+    def __contains__(self, uuid):
+        return self.index.has_uuid(uuid)
+
+    def __iter__(self):
+        return self.index.uuids()
+
+    def __len__(self):
+        return self.index.count_uuids()
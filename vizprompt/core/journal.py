@@ -0,0 +1,137 @@
+import os, atexit, threading
+from contextlib import nullcontext
+
+def recover_torn_line(path):
+    """
+    改行で終わっていない末尾の行（書き込み途中で中断した行）を切り詰める
+    戻り値: 切り詰めたかどうか
+    """
+    if not os.path.exists(path):
+        return False
+    with open(path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return False
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return False
+        # 最後の改行を後ろから探す
+        pos = size
+        while pos > 0:
+            start = max(0, pos - 4096)
+            f.seek(start)
+            chunk = f.read(pos - start)
+            if (i := chunk.rfind(b"\n")) >= 0:
+                f.truncate(start + i + 1)
+                return True
+            pos = start
+        f.truncate(0)
+        return True
+
+class Journal:
+    """
+    追記専用のテキストファイルに、ファイルを開いたまま行単位でまとめて書き込むクラス
+
+    flush_every: 指定した件数ごとにフラッシュ（1なら毎回）
+    flush_interval_ms: 最初の未フラッシュの行から指定時間（ミリ秒）が経てばフラッシュ（タイマーでも書き込む）
+    fsync: フラッシュ時に os.fsync でディスクへの書き込みを待つ
+    lock: タイマーでフラッシュするときに取得するロック（他のプロセスの書き込みとの排他）
+    未フラッシュの行はメモリに保持し、フラッシュ時に1回の書き込みで追記する（行の途中で途切れない）。
+    残りは close() またはプロセス終了時に書き込まれる。
+    他のプロセスがファイルを置き換えていれば、フラッシュ時に開き直して新しいファイルに書き込む。
+    未フラッシュの間に他のプロセスが同じ行を追記していれば（ファイルから再登録された場合など）、その行は書き込まない。
+    """
+    def __init__(self, path, flush_every=1, flush_interval_ms=None, fsync=False, lock=None):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval_ms = flush_interval_ms
+        self.fsync = fsync
+        self.lock = lock
+        self.file = None
+        self.lines = []     # 未フラッシュの行
+        self.mark = None    # 最初の未フラッシュの行を追加したときのファイルの (st_ino, st_size)
+        self.timer = None   # flush_interval_ms によるフラッシュのタイマー
+        self.mutex = threading.RLock()
+        atexit.register(self.close)
+
+    @property
+    def pending(self):
+        return len(self.lines)
+
+    def open(self):
+        if self.file is not None:
+            try:
+                replaced = os.stat(self.path).st_ino != os.fstat(self.file.fileno()).st_ino
+            except FileNotFoundError:
+                replaced = True
+            if not replaced:
+                return self.file
+            self.file.close()
+        recover_torn_line(self.path)
+        self.file = open(self.path, "a", encoding="utf-8")
+        return self.file
+
+    def append(self, line):
+        """
+        1行追記（改行は自動で付加）
+        """
+        with self.mutex:
+            if not self.lines:
+                try:
+                    st = os.stat(self.path)
+                    self.mark = st.st_ino, st.st_size
+                except FileNotFoundError:
+                    self.mark = None
+            self.lines.append(line + "\n")
+            if len(self.lines) >= self.flush_every:
+                self.flush()
+            elif self.flush_interval_ms is not None and self.timer is None:
+                self.timer = threading.Timer(self.flush_interval_ms / 1000, self.flush_on_timer)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush_on_timer(self):
+        with self.lock or nullcontext(), self.mutex:
+            self.flush()
+
+    def flush(self):
+        with self.mutex:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.lines:
+                return
+            f = self.open()
+            if lines := self.unwritten(f):
+                f.write("".join(lines))
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            self.lines.clear()
+
+    def unwritten(self, f):
+        """
+        未フラッシュの行のうち、最初の行を追加した後に他のプロセスが追記していないもの
+        ファイルが置き換えられていれば、新しいファイル全体と照合する
+        """
+        st = os.fstat(f.fileno())
+        start = 0
+        if self.mark is not None and self.mark[0] == st.st_ino and self.mark[1] <= st.st_size:
+            start = self.mark[1]
+        if st.st_size <= start:
+            return self.lines
+        with open(self.path, "rb") as r:
+            r.seek(start)
+            written = set(r.read(st.st_size - start).decode("utf-8", errors="replace").splitlines(keepends=True))
+        return [line for line in self.lines if line not in written]
+
+    def close(self):
+        """
+        フラッシュしてファイルを閉じる（次の追記で開き直す）
+        """
+        # プロセスの終了時にも他のプロセスの書き込みと排他する
+        with self.lock if self.lines and self.lock else nullcontext(), self.mutex:
+            self.flush()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
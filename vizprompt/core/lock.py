@@ -0,0 +1,45 @@
+import os, threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windowsなど fcntl がない環境ではプロセス内の排他のみ
+    fcntl = None
+
+class FileLock:
+    """
+    ロックファイルに対する fcntl.flock による排他ロック（アドバイザリロック）
+
+    同一プロセス内では再入可能で、スレッド間の排他も兼ねる。
+    depth は現在のネストの深さで、1なら最も外側のロック。
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.depth = 0
+        self.rlock = threading.RLock()
+
+    def __enter__(self):
+        self.rlock.acquire()
+        if self.depth == 0:
+            try:
+                self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                if fcntl:
+                    fcntl.flock(self.fd, fcntl.LOCK_EX)
+            except BaseException:
+                if self.fd is not None:
+                    os.close(self.fd)
+                    self.fd = None
+                self.rlock.release()
+                raise
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.depth -= 1
+        if self.depth == 0:
+            if fcntl:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+        self.rlock.release()
@@ -1,8 +1,13 @@
-import os, uuid
+import io, os, sys, uuid, base64, lzma, zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from datetime import datetime
 import xml.etree.ElementTree as ET
 from xml.dom.minidom import Document
 from vizprompt.core.base import BaseManager
+from vizprompt.core.pack import PackStore
+from vizprompt.core.blob import BlobStore
+from vizprompt.core.index import to_micros
 
 def json_to_xml(json_obj):
     """
@@ -39,6 +44,155 @@ def json_to_xml(json_obj):
     build_xml_element(doc, None, json_obj)
     return doc
 
+def escape_xml(text):
+    """
+    minidom と同じ規則で文字をエスケープ（&, <, ", >）
+    """
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if '"' in text:
+        text = text.replace('"', "&quot;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text
+
+def write_xml(write, json_obj):
+    """
+    JSONオブジェクトをXML形式で書き出す関数
+    json_to_xml の結果を toprettyxml(encoding='utf-8', indent='') で出力したものと同じ内容になる
+    write: 文字列を受け取る関数（file.write など）
+    """
+    write('<?xml version="1.0" encoding="utf-8"?>\n')
+
+    def write_element(key, value):
+        if isinstance(value, dict):
+            pairs = value.items()
+        else:
+            # リストの要素は1要素の辞書で、辞書の要素と同様に扱う
+            pairs = []
+            for item in value:
+                if not isinstance(item, dict) or len(item) != 1:
+                    raise ValueError(f"1要素の辞書でなければなりません: {item}")
+                pairs.append(next(iter(item.items())))
+        attrs = {}
+        children = []  # ("element", key, value), (":text", 文字列), (":cdata", 文字列)
+        for k, v in pairs:
+            if isinstance(v, (dict, list)):
+                children.append(("element", k, v))
+            elif k == ":text" or k == ":cdata":
+                if v := str(v):
+                    children.append((k, v))
+            else:
+                attrs[k] = str(v)
+        write(f"<{key}")
+        for k, v in attrs.items():
+            write(f' {k}="{escape_xml(v)}"')
+        if not children:
+            write("/>\n")
+            return
+        write(">")
+        if len(children) == 1 and children[0][0] != "element":
+            # テキストのみの要素は改行を入れない
+            write_child(children[0], "")
+        else:
+            write("\n")
+            for child in children:
+                write_child(child, "\n")
+        write(f"</{key}>\n")
+
+    def write_child(child, newl):
+        kind, *args = child
+        if kind == "element":
+            write_element(*args)
+        elif kind == ":text":
+            # minidom と同様、改行もエスケープの対象に含める（結果は変わらない）
+            write(escape_xml(args[0] + newl))
+        else:
+            # minidom と同様、CDATAの後には改行を入れない
+            if "]]>" in args[0]:
+                raise ValueError("']]>' not allowed in a CDATA section")
+            write(f"<![CDATA[\n{args[0]}\n]]>")
+
+    if not isinstance(json_obj, dict) or len(json_obj) != 1:
+        raise ValueError(f"1要素の辞書でなければなりません: {json_obj}")
+    write_element(*next(iter(json_obj.items())))
+
+# 読み込むノードがこれより少なければ並列化しない
+PREFETCH_THRESHOLD = 8
+
+# キャッシュの大きさの見積もりに使う、テキスト以外のおおよそのバイト数
+NODE_SIZE = 2048
+CONTENT_SIZE = 512
+
+# ヘッダーを読み込むときに一度に読み込むバイト数
+HEADER_CHUNK = 16 * 1024
+
+def read_cdata(elem):
+    """
+    要素のテキストを取得（write_xml でCDATAの前後に付けた改行を除く）
+    """
+    text = elem.text or ""
+    if text.startswith("\n") and text.endswith("\n"):
+        text = text[1:-1]
+    return text
+
+# content のテキストの圧縮方式（圧縮・展開する関数）
+ENCODINGS = {
+    "zlib": (zlib.compress, zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+# 既定ではこの文字数以上のテキストを圧縮する
+COMPRESS_THRESHOLD = 16 * 1024
+
+def encode_text(text, encoding):
+    """
+    テキストを圧縮してBase64（76文字ごとに改行）にする
+    """
+    data = ENCODINGS[encoding][0](text.encode("utf-8", "surrogatepass"))
+    return base64.encodebytes(data).decode("ascii").rstrip("\n")
+
+def decode_text(text, encoding):
+    """
+    encode_text で圧縮したテキストを元に戻す
+    """
+    if encoding not in ENCODINGS:
+        raise ValueError(f"不明な圧縮方式です: {encoding}")
+    data = base64.b64decode(text)
+    return ENCODINGS[encoding][1](data).decode("utf-8", "surrogatepass")
+
+# 既定ではこの文字数以上のテキストを共有する
+DEDUP_THRESHOLD = 256
+
+def blob_store(data_dir):
+    """
+    ノードの保存先に対応するテキストの格納庫（project/nodes → project/blobs）
+    """
+    return BlobStore(os.path.join(os.path.dirname(os.path.normpath(data_dir)), "blobs"))
+
+def content_dict(c):
+    """
+    content のXML構造を辞書で返す
+    ref があればテキストは埋め込まず参照だけを書き、encoding があればテキストを圧縮
+    """
+    d = {
+        "role": c["role"],
+        "count": c.get("count", 0),
+        "duration": c.get("duration", 0),
+        "rate": c.get("rate", 0),
+    }
+    if ref := c.get("ref"):
+        d["ref"] = ref
+        return d
+    text = c.get("text", "")
+    if (encoding := c.get("encoding")) and text:
+        d["encoding"] = encoding
+        text = encode_text(text, encoding)
+    d[":cdata"] = text
+    return d
+
 class Node:
     """
     XMLノード情報と一対一対応するデータクラス
@@ -67,6 +221,8 @@ class Node:
         self.tags = tags
         self.data_dir = data_dir
         self.relpath = relpath
+        self.source = None  # パックされたノードならファイルの内容を返す関数
+        self.blobs = None   # 共有テキストの格納庫（参照を解決するときに作成）
 
         for content in self.contents:
             if "rate" not in content:
@@ -77,8 +233,15 @@ class Node:
         """
         NodeインスタンスをXML文字列に変換
         """
-        doc = json_to_xml(self.to_dict())
-        return doc.toprettyxml(encoding='utf-8', indent='').decode('utf-8')
+        parts = []
+        write_xml(parts.append, self.to_dict())
+        xml = "".join(parts)
+        try:
+            xml.encode("utf-8")
+        except UnicodeEncodeError:
+            # toprettyxml と同様、UTF-8で表せない文字（サロゲート）は文字参照にする
+            xml = xml.encode("utf-8", "xmlcharrefreplace").decode("utf-8")
+        return xml
 
     def to_dict(self) -> dict:
         """
@@ -89,15 +252,7 @@ class Node:
                 "id": self.id,
                 "timestamp": self.timestamp.isoformat(),
                 "contents": [
-                    {
-                        "content": {
-                            "role": c["role"],
-                            "count": c.get("count", 0),
-                            "duration": c.get("duration", 0),
-                            "rate": c.get("rate", 0),
-                            ":cdata": c.get("text", ""),
-                        }
-                    }
+                    {"content": content_dict(c)}
                     for c in self.contents
                 ],
                 "metadata": {
@@ -116,23 +271,44 @@ class Node:
             }
         }
 
+    def blob_store(self):
+        if self.blobs is None:
+            self.blobs = blob_store(self.data_dir)
+        return self.blobs
+
+    def open_file(self):
+        """
+        ノードのファイルをバイナリモードで開く（パックされていればセグメントの該当部分）
+        """
+        if self.source:
+            return io.BytesIO(self.source())
+        return open(os.path.join(self.data_dir, self.relpath), "rb")
+
     def save(self):
         """
         NodeインスタンスをXMLファイルに保存
         """
+        if self.source:
+            raise ValueError(f"パックされたノードは保存できません: {self.id}")
         xml = self.to_xml()
         path = os.path.join(self.data_dir, self.relpath)
-        with open(path, "w", encoding="utf-8") as f:
+        # 書き換え中に中断しても壊れないよう、一時ファイルに書いてから置き換える
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
             f.write(xml)
+        os.replace(tmp_path, path)
 
     @classmethod
-    def load(cls, data_dir, relpath):
+    def load(cls, data_dir, relpath, source=None, blobs=None):
         """
         XMLファイルからNodeインスタンスを読み込む
+        source: パックされたノードならファイルの内容を返す関数
+        blobs: 共有テキストの格納庫（Noneなら data_dir から決める）
         """
-        path = os.path.join(data_dir, relpath)
-        tree = ET.parse(path)
-        root = tree.getroot()
+        if source:
+            root = ET.fromstring(source())
+        else:
+            root = ET.parse(os.path.join(data_dir, relpath)).getroot()
         node_id = root.attrib["id"]
         timestamp = datetime.fromisoformat(root.attrib["timestamp"])
         contents = []
@@ -141,16 +317,22 @@ class Node:
             count = int(content.attrib["count"])
             duration = float(content.attrib["duration"])
             rate = float(content.attrib["rate"])
-            text = content.text or ""
-            if text.startswith("\n") and text.endswith("\n"):
-                text = text[1:-1]
-            contents.append({
+            text = read_cdata(content)
+            c = {
                 "role": role,
                 "count": count,
                 "duration": duration,
                 "rate": rate,
-                "text": text,
-            })
+            }
+            if ref := content.attrib.get("ref"):
+                c["ref"] = ref
+                blobs = blobs or blob_store(data_dir)
+                text = blobs.get(ref)
+            elif encoding := content.attrib.get("encoding"):
+                c["encoding"] = encoding
+                text = decode_text(text, encoding)
+            c["text"] = text
+            contents.append(c)
         model = root.findtext(".//model")
         summary_node = root.find(".//summary")
         summary = summary_node.text or ""
@@ -158,7 +340,7 @@ class Node:
         summary_last_built = datetime.fromisoformat(summary_node.attrib["last_built"])
         tags = [tag.text for tag in root.findall(".//tag")]
 
-        return cls(
+        node = cls(
             id=node_id,
             timestamp=timestamp,
             contents=contents,
@@ -170,15 +352,186 @@ class Node:
             data_dir=data_dir,
             relpath=relpath,
         )
+        node.source = source
+        node.blobs = blobs
+        return node
+
+def iterparse_headers(f, chunk_size=HEADER_CHUNK):
+    """
+    content のCDATAを読み飛ばして ET.iterparse(..., events=("start", "end")) と同様にイベントを返す
+    CDATAの中身はパーサーに渡さず、終端 (]]>) を探すだけなので、長いテキストも解析しない
+    （飛ばした content 要素の text は None になる）
+    f: XMLファイル（バイナリモード）
+    chunk_size バイトずつ読み込み、呼び出し側が途中で打ち切ればそれ以降は読み込まない
+    """
+    parser = ET.XMLPullParser(events=("start", "end"))
+    buf = b""
+    skipping = False  # content のCDATAを読み飛ばしている途中
+    while chunk := f.read(chunk_size):
+        buf += chunk
+        while True:
+            if skipping:
+                if (end := buf.find(b"]]>")) < 0:
+                    # 終端がチャンクの境界で分かれていても見つかるよう末尾を残す
+                    buf = buf[-2:]
+                    break
+                buf = buf[end + 3:]
+                skipping = False
+            if (start := buf.find(b"<![CDATA[")) < 0:
+                # 最後のタグの開始より前だけを渡す（CDATAの直前のタグを判定できるように残す）
+                # 末尾がCDATAの開始の途中なら、その前のタグから残す
+                tag = buf.rfind(b"<")
+                if tag >= 0 and b"<![CDATA[".startswith(buf[tag:]):
+                    tag = buf.rfind(b"<", 0, tag)
+                if tag > 0:
+                    parser.feed(buf[:tag])
+                    buf = buf[tag:]
+                break
+            # CDATAの直前が content の開始タグなら読み飛ばす
+            tag = buf.rfind(b"<", 0, start)
+            if tag >= 0 and buf.startswith((b"<content ", b"<content>"), tag) and buf[start - 1] == ord(">"):
+                parser.feed(buf[:start])
+                buf = buf[start + 9:]
+                skipping = True
+            elif (end := buf.find(b"]]>", start)) >= 0:
+                parser.feed(buf[:end + 3])
+                buf = buf[end + 3:]
+            else:
+                break
+            yield from parser.read_events()
+        yield from parser.read_events()
+    if not skipping:
+        parser.feed(buf)
+    parser.close()
+    yield from parser.read_events()
+
+class LazyContent(dict):
+    """
+    text を初回アクセス時にファイルから読み込む content の辞書
+    text 以外の項目（role, count, duration, rate）は最初から持つ
+    """
+    def __init__(self, node, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.node = node
+
+    def __missing__(self, key):
+        if key != "text":
+            raise KeyError(key)
+        self.node.load_texts()
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __contains__(self, key):
+        return key == "text" or dict.__contains__(self, key)
+
+class LazyNode(Node):
+    """
+    ヘッダーだけを読み込み、content のテキストは初回アクセス時に読み込む Node
+    """
+    def texts_loaded(self):
+        return all(dict.__contains__(content, "text") for content in self.contents)
+
+    def load_texts(self):
+        """
+        content のテキストをファイルから読み込む（設定済みのものは上書きしない）
+        """
+        # 参照しているテキストは格納庫から読み込み、残りがあればファイルを読む
+        for content in self.contents:
+            if not dict.__contains__(content, "text") and (ref := dict.get(content, "ref")):
+                dict.__setitem__(content, "text", self.blob_store().get(ref))
+        if self.texts_loaded():
+            return
+        contents = iter(self.contents)
+        with self.open_file() as f:
+            for _, elem in ET.iterparse(f):
+                if elem.tag == "content":
+                    content = next(contents, None)
+                    if content is not None and not dict.__contains__(content, "text"):
+                        text = read_cdata(elem)
+                        if encoding := dict.get(content, "encoding"):
+                            text = decode_text(text, encoding)
+                        dict.__setitem__(content, "text", text)
+                    elem.clear()
+                elif elem.tag == "contents":
+                    break
+        # ファイルにないものは空文字列
+        for content in contents:
+            if not dict.__contains__(content, "text"):
+                dict.__setitem__(content, "text", "")
+
+    @classmethod
+    def load(cls, data_dir, relpath, source=None, blobs=None):
+        """
+        XMLファイルからヘッダー（content のテキスト以外）を読み込む
+        content のテキストは解析せずに読み飛ばし、metadata の終わりで打ち切る
+        """
+        node = cls.__new__(cls)
+        node.data_dir = data_dir
+        node.relpath = relpath
+        node.source = source
+        node.blobs = blobs
+        node.contents = []
+        node.model = None
+        node.summary = ""
+        node.summary_updated = False
+        node.summary_last_built = None
+        node.tags = []
+        with node.open_file() as f:
+            for event, elem in iterparse_headers(f):
+                tag = elem.tag
+                if event == "start":
+                    if tag == "node":
+                        node.id = elem.attrib["id"]
+                        node.timestamp = datetime.fromisoformat(elem.attrib["timestamp"])
+                    elif tag == "content":
+                        node.contents.append(LazyContent(
+                            node,
+                            role=elem.attrib["role"],
+                            count=int(elem.attrib["count"]),
+                            duration=float(elem.attrib["duration"]),
+                            rate=float(elem.attrib["rate"]),
+                        ))
+                        for key in ["ref", "encoding"]:
+                            if value := elem.attrib.get(key):
+                                dict.__setitem__(node.contents[-1], key, value)
+                    elif tag == "summary":
+                        node.summary_updated = elem.attrib["updated"] == "true"
+                        node.summary_last_built = datetime.fromisoformat(elem.attrib["last_built"])
+                elif tag == "model":
+                    node.model = elem.text or ""
+                elif tag == "summary":
+                    node.summary = elem.text or ""
+                elif tag == "tag":
+                    node.tags.append(elem.text)
+                elif tag == "metadata":
+                    break
+        return node
 
 class NodeManager(BaseManager):
-    def __init__(self, base_dir="project"):
+    """
+    compression: 新規作成するノードのテキストの圧縮方式（"zlib", "lzma" またはNoneで圧縮しない）
+    compress_threshold: 圧縮するテキストの最小の文字数
+    dedup: 新規作成するノードのテキストを project/blobs に格納して参照する（同じテキストは共有）
+    dedup_threshold: 共有するテキストの最小の文字数
+    """
+    def __init__(self, base_dir="project", compression=None, compress_threshold=COMPRESS_THRESHOLD,
+                 dedup=False, dedup_threshold=DEDUP_THRESHOLD, **kwargs):
+        if compression is not None and compression not in ENCODINGS:
+            raise ValueError(f"不明な圧縮方式です: {compression}")
         self.base_dir = base_dir
-        self.cache = {}
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self.dedup = dedup
+        self.dedup_threshold = dedup_threshold
+        self.blobs = BlobStore(os.path.join(base_dir, "blobs"))
         super().__init__(
             data_dir=os.path.join(base_dir, "nodes"),
             ext="xml",
+            **kwargs,
         )
+        self.packs = PackStore(self.data_dir)
 
     def get_uuid_and_timestamp_from_file(self, path):
         """
@@ -197,70 +550,267 @@ class NodeManager(BaseManager):
             pass
         return str(uuid.UUID(int=0)), datetime.now().astimezone()
 
-    def get_node(self, node_id):
+    def sizeof(self, node):
+        """
+        Nodeのおおよそのバイト数（読み込み済みのテキストを含む）
+        """
+        size = NODE_SIZE
+        for content in node.contents:
+            size += CONTENT_SIZE + sys.getsizeof(dict.get(content, "text", ""))
+        return size + sys.getsizeof(node.summary or "")
+
+    def has_node(self, node_id):
+        """
+        UUIDのノードがファイルかパックにあるか（パックは他のプロセスの追記も確認）
+        """
+        return node_id in self.uuid_map or node_id in self.packs or \
+            (self.packs.refresh() and node_id in self.packs)
+
+    def node_ids(self):
+        """
+        すべてのノードのUUID（ファイルのノード、パックのノードの順）
+        """
+        self.packs.refresh()
+        ids = dict.fromkeys(node_id for node_id, _ in self.tsv_entries.values())
+        ids.update(dict.fromkeys(self.packs.entries))
+        return list(ids)
+
+    def get_orphans(self, flow_manager):
+        """
+        どのフローにも含まれないノードのUUIDのリスト（不要なノードの削除の候補）
+        """
+        return flow_manager.orphan_nodes(self.node_ids())
+
+    def load_node(self, node_id, lazy=True):
+        """
+        UUIDのノードをファイルまたはパックから読み込む（キャッシュは使わない）
+        """
+        return self.read_node(*self.locate_node(node_id), lazy)
+
+    def locate_node(self, node_id):
+        """
+        UUIDのノードの (relpath, パックの内容を返す関数（ファイルならNone）)
+        SQLiteの接続は作成したスレッドでしか使えないため、インデックスは呼び出し元のスレッドで引く
+        """
+        if node_id in self.uuid_map:
+            return self.uuid_map[node_id][0], None
+        segment, offset, length = self.packs.location(node_id)
+        return f"packs/{segment}#{offset}", partial(self.packs.read, segment, offset, length)
+
+    def read_node(self, relpath, source=None, lazy=True):
+        """
+        locate_node の戻り値からノードを読み込む（インデックスを使わないため別スレッドで呼べる）
+        """
+        cls = LazyNode if lazy else Node
+        return cls.load(self.data_dir, relpath, source, self.blobs)
+
+    def get_node(self, node_id, lazy=True):
         """
         UUIDからNodeインスタンスを取得
+        lazy=True ならヘッダーだけを読み込み、content のテキストは初回アクセス時に読み込む
         """
         if node := self.cache.get(node_id):
             # キャッシュにある場合はキャッシュから取得
             return node
-        if node_id in self.uuid_map:
+        if self.has_node(node_id):
             # キャッシュにない場合はファイルから読み込む
-            relpath = self.uuid_map[node_id][0]
-            node = Node.load(self.data_dir, relpath)
+            node = self.load_node(node_id, lazy)
             self.cache[node_id] = node
             return node
         raise FileNotFoundError(f"Node with ID {node_id} not found.")
 
+    def get_nodes(self, node_ids, lazy=True):
+        """
+        複数のUUIDからNodeインスタンスのリストを取得（順序は入力どおり）
+        キャッシュにないものはスレッドプールで並列に読み込む
+        """
+        nodes = {}
+        missing = {}  # 読み込むUUID（順序を保つため辞書を使う）
+        for node_id in node_ids:
+            if node_id in nodes or node_id in missing:
+                continue
+            if node := self.cache.get(node_id):
+                nodes[node_id] = node
+            elif self.has_node(node_id):
+                missing[node_id] = None
+            else:
+                raise FileNotFoundError(f"Node with ID {node_id} not found.")
+        # テキストが必要なら、キャッシュにあるLazyNodeのテキストもまとめて読み込む
+        tasks = [partial(self.read_node, *self.locate_node(node_id), lazy) for node_id in missing]
+        if not lazy:
+            for node in nodes.values():
+                if isinstance(node, LazyNode) and not node.texts_loaded():
+                    tasks.append(node.load_texts)
+        if len(tasks) < PREFETCH_THRESHOLD or self.scan_workers == 1:
+            loaded = [task() for task in tasks]
+        else:
+            with ThreadPoolExecutor(self.scan_workers) as pool:
+                loaded = list(pool.map(lambda task: task(), tasks))
+        for node_id, node in zip(missing, loaded):
+            self.cache[node_id] = node
+            nodes[node_id] = node
+        return [nodes[node_id] for node_id in node_ids]
+
+    def generate_uuid(self):
+        """
+        パックしたノードとも重複しないUUIDを生成
+        """
+        while (node_id := super().generate_uuid()) in self.packs:
+            pass
+        return node_id
+
+    def pack(self, before):
+        """
+        タイムスタンプが before より古いノードのファイルを新しいセグメントにまとめて削除
+        UUIDが衝突しているノードは古いファイルが残って優先されないよう、すべてのファイルをまとめる
+        戻り値: (まとめたノード数, セグメント名)
+        """
+        with self.locked():
+            limit = to_micros(before)
+            old = {
+                relpath: (node_id, timestamp)
+                for relpath, (node_id, timestamp) in self.tsv_entries.items()
+                if to_micros(timestamp) < limit
+            }
+            # パックでは同じタイムスタンプなら後の行を優先するため、優先されるファイルを後に書き込む
+            targets = []
+            for node_id in dict.fromkeys(node_id for node_id, _ in old.values()):
+                targets += [(relpath, node_id, old[relpath][1])
+                            for relpath in reversed(self.uuid_map[node_id]) if relpath in old]
+            if not targets:
+                return 0, None
+            items = []
+            for relpath, node_id, timestamp in targets:
+                with open(os.path.join(self.data_dir, relpath), "rb") as f:
+                    items.append((node_id, timestamp, f.read()))
+            # セグメントとインデックスを書き込んでから元のファイルを削除
+            segment = self.packs.append(items)
+            for relpath, node_id, _ in targets:
+                os.remove(os.path.join(self.data_dir, relpath))
+                self.remove_entry(relpath)
+                self.cache.pop(node_id)
+            self.save_index()
+            if self.slots.dirty:
+                self.slots.save(self.slots_path)
+            return len(targets), segment
+
     def create_node(self, prompt, response, g):
-        relpath = self.get_next_relpath_and_folder()
-
-        # 新規作成
-        node_id = self.generate_uuid()
-        timestamp = datetime.now().astimezone()
-        node = Node(
-            id = node_id,
-            timestamp = timestamp,
-            contents = [
-                {
-                    "role": "user",
-                    "count": g.prompt_count,
-                    "duration": g.prompt_duration,
-                    "text": prompt,
-                },
-                {
-                    "role": "assistant",
-                    "count": g.eval_count,
-                    "duration": g.eval_duration,
-                    "text": response,
-                },
-            ],
-            model = g.model,
-            summary = "",
-            summary_updated = False,
-            summary_last_built = timestamp,
-            tags = [],
-            data_dir = self.data_dir,
-            relpath = relpath,
-        )
-        node.save()
+        # 他のプロセスと同じrelpathを使わないよう、作成からTSV追記までをロック
+        with self.locked():
+            relpath = self.get_next_relpath_and_folder()
+
+            # 新規作成
+            node_id = self.generate_uuid()
+            timestamp = datetime.now().astimezone()
+            node = Node(
+                id = node_id,
+                timestamp = timestamp,
+                contents = [
+                    {
+                        "role": "user",
+                        "count": g.prompt_count,
+                        "duration": g.prompt_duration,
+                        "text": prompt,
+                    },
+                    {
+                        "role": "assistant",
+                        "count": g.eval_count,
+                        "duration": g.eval_duration,
+                        "text": response,
+                    },
+                ],
+                model = g.model,
+                summary = "",
+                summary_updated = False,
+                summary_last_built = timestamp,
+                tags = [],
+                data_dir = self.data_dir,
+                relpath = relpath,
+            )
+            node.blobs = self.blobs
+            if self.dedup:
+                self.set_refs(node, self.dedup_threshold)
+            self.set_encodings(node, self.compression, self.compress_threshold)
+            node.save()
 
-        # キャッシュ・TSV追記
-        self.cache[node_id] = node
-        self.add_entry(relpath, node_id, timestamp)
-        self.append_index(relpath, node_id, timestamp)
+            # キャッシュ・TSV追記
+            self.cache[node_id] = node
+            self.add_entry(relpath, node_id, timestamp)
+            self.append_index(relpath, node_id, timestamp)
 
-        return node
+            return node
+
+    def set_encodings(self, node, compression, threshold):
+        """
+        threshold 文字以上のテキストの圧縮方式を compression にし、それ以外は圧縮しない
+        戻り値: 変更があったかどうか
+        """
+        changed = False
+        for content in node.contents:
+            if "ref" in content:
+                # 格納庫のテキストは圧縮しない
+                continue
+            encoding = compression if compression and len(content["text"]) >= threshold else None
+            if content.get("encoding") != encoding:
+                if encoding:
+                    content["encoding"] = encoding
+                else:
+                    del content["encoding"]
+                changed = True
+        return changed
+
+    def set_refs(self, node, threshold):
+        """
+        threshold 文字以上のテキストを格納庫に入れて参照にする
+        戻り値: 変更があったかどうか
+        """
+        changed = False
+        for content in node.contents:
+            if "ref" not in content and len(content["text"]) >= threshold:
+                content["ref"] = self.blobs.put(content["text"])
+                content.pop("encoding", None)
+                changed = True
+        return changed
+
+    def rewrite_nodes(self, update, progress=None):
+        """
+        ファイルとして保存されているノードを読み込み、update(node) が真を返したものを保存し直す
+        UUIDが衝突していれば、優先されないファイルも保存し直す
+        パックしたノードはインデックスにないため対象外
+        progress: ノードを1件処理するごとに呼び出す関数 (処理済み数, 総数)
+        戻り値: (保存し直したファイル数, 総数)
+        """
+        with self.locked():
+            relpaths = list(self.tsv_entries)
+            changed = 0
+            for i, relpath in enumerate(relpaths, 1):
+                node = Node.load(self.data_dir, relpath, blobs=self.blobs)
+                if update(node):
+                    node.save()
+                    self.cache.pop(node.id)
+                    changed += 1
+                if progress:
+                    progress(i, len(relpaths))
+            return changed, len(relpaths)
+
+    def recompress(self, compression, threshold=COMPRESS_THRESHOLD, progress=None):
+        """
+        ノードのテキストを指定した圧縮方式で保存し直す（rewrite_nodes参照）
+        """
+        return self.rewrite_nodes(lambda node: self.set_encodings(node, compression, threshold), progress)
+
+    def deduplicate(self, threshold=DEDUP_THRESHOLD, progress=None):
+        """
+        ノードのテキストを格納庫に移して参照で保存し直す（rewrite_nodes参照）
+        """
+        return self.rewrite_nodes(lambda node: self.set_refs(node, threshold), progress)
 
     def get_contents(self, node_ids):
         """
         複数のNodeインスタンスの内容を取得
         """
         contents = []
-        for node_id in node_ids:
-            if node := self.get_node(node_id):
-                for content in node.contents:
-                    contents.append((content["role"], content["text"]))
-            else:
-                raise FileNotFoundError(f"Node with ID {node_id} not found.")
+        for node in self.get_nodes(node_ids, lazy=False):
+            for content in node.contents:
+                contents.append((content["role"], content["text"]))
         return contents
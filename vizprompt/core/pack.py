@@ -0,0 +1,117 @@
+import os, mmap, threading
+from datetime import datetime
+from vizprompt.core.journal import recover_torn_line
+from vizprompt.core.index import to_micros
+
+class PackStore:
+    """
+    古いノードのファイルをまとめて格納するセグメントファイル群
+
+    packs/NNNNNN.seg: ノードのファイルの内容を連結した追記専用のファイル（パックするたびに新規作成）
+    packs/index.tsv: uuid, timestamp, segment, offset, length の行（追記専用）
+    同じUUIDが複数あればタイムスタンプの新しいものを優先する。
+    セグメントは mmap で開き、ノードごとにスライスして読み込む。
+    """
+    def __init__(self, data_dir):
+        self.dir = os.path.join(data_dir, "packs")
+        self.index_path = os.path.join(self.dir, "index.tsv")
+        self.entries = {}  # uuid -> (timestamp, segment, offset, length)
+        self.maps = {}     # segment -> mmap
+        self.maps_lock = threading.Lock()
+        self.size = 0      # 読み込んだ index.tsv の大きさ
+        self.load()
+
+    def load(self):
+        """
+        index.tsv を読み込む（追記された分だけ）
+        """
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, "rb") as f:
+            f.seek(self.size)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        self.size += end
+        for line in data[:end].decode("utf-8").splitlines():
+            parts = line.split("\t")
+            if len(parts) != 5 or parts[0] == "uuid":
+                continue
+            uuid, timestamp, segment, offset, length = parts
+            timestamp = datetime.fromisoformat(timestamp)
+            if (old := self.entries.get(uuid)) and to_micros(old[0]) > to_micros(timestamp):
+                continue
+            self.entries[uuid] = (timestamp, segment, int(offset), int(length))
+
+    def refresh(self):
+        """
+        他のプロセスが追記していれば読み込む
+        戻り値: 読み込んだかどうか
+        """
+        try:
+            size = os.path.getsize(self.index_path)
+        except FileNotFoundError:
+            return False
+        if size == self.size:
+            return False
+        self.load()
+        return True
+
+    def __contains__(self, uuid):
+        return uuid in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def location(self, uuid):
+        """
+        ノードの位置 (segment, offset, length)
+        """
+        _, segment, offset, length = self.entries[uuid]
+        return segment, offset, length
+
+    def read(self, segment, offset, length):
+        """
+        セグメントの一部を読み込む
+        """
+        if (m := self.maps.get(segment)) is None:
+            with self.maps_lock:
+                if (m := self.maps.get(segment)) is None:
+                    with open(os.path.join(self.dir, segment), "rb") as f:
+                        m = self.maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return m[offset:offset + length]
+
+    def next_segment(self):
+        numbers = [int(name[:-4]) for name in os.listdir(self.dir)
+                   if name.endswith(".seg") and name[:-4].isdigit()]
+        return f"{max(numbers, default=0) + 1:06}.seg"
+
+    def append(self, items):
+        """
+        新しいセグメントにノードを書き込み、index.tsv に追記する
+        items: (uuid, timestamp, データ) のリスト
+        セグメントとインデックスをディスクに書き込んでから戻る（元のファイルはその後で削除する）
+        """
+        os.makedirs(self.dir, exist_ok=True)
+        segment = self.next_segment()
+        lines = []
+        with open(os.path.join(self.dir, segment), "xb") as f:
+            for uuid, timestamp, data in items:
+                lines.append(f"{uuid}\t{timestamp.isoformat()}\t{segment}\t{f.tell()}\t{len(data)}\n")
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        recover_torn_line(self.index_path)
+        header = not os.path.exists(self.index_path)
+        with open(self.index_path, "a", encoding="utf-8") as f:
+            if header:
+                f.write("uuid\ttimestamp\tsegment\toffset\tlength\n")
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        self.load()
+        return segment
+
+    def close(self):
+        for m in self.maps.values():
+            m.close()
+        self.maps.clear()
@@ -0,0 +1,172 @@
+import heapq, os, re
+
+class SlotAllocator:
+    """
+    空きスロット（フォルダ番号・ファイル番号）を管理するクラス
+
+    割り当て順は従来の探索順と同じで、フォルダあたりの上限 (100, 200, ..., 900) の段階ごとに
+    フォルダ番号順・ファイル番号順に並ぶ。スロットは (段階, フォルダ番号, ファイル番号) のキーで表す。
+    未使用領域の先頭（cursor）と、それより前の空き（holes）を保持するため、割り当ては定数時間で行える。
+    """
+    STEP = 100
+    LIMIT = 900
+
+    def __init__(self, ext):
+        self.ext = ext
+        self.regex = re.compile(r"([0-9]{3})/([0-9]{3})\." + re.escape(ext))
+        self.reset()
+
+    def reset(self):
+        self.cursor = (0, 0, 0)  # 未使用領域の先頭（満杯ならNone）
+        self.holes = []          # cursorより前の空きキーのヒープ（削除は遅延）
+        self.hole_set = set()
+        self.dirty = False
+
+    def key(self, relpath):
+        """
+        relpathをキーに変換（割り当て対象外ならNone）
+        """
+        if m := self.regex.fullmatch(relpath):
+            f, i = int(m.group(1)), int(m.group(2))
+            if f < self.LIMIT and i < self.LIMIT:
+                return max(f, i) // self.STEP, f, i
+        return None
+
+    def relpath(self, key):
+        _, f, i = key
+        return f"{f:03}/{i:03}.{self.ext}"
+
+    def ordinal(self, key):
+        """
+        キーの割り当て順の通し番号（それより前のスロット数）
+        """
+        if key is None:
+            return self.LIMIT * self.LIMIT
+        t, f, i = key
+        p = t * self.STEP
+        m = p + self.STEP
+        if f < p:
+            return p * p + f * self.STEP + (i - p)
+        return p * p + p * self.STEP + (f - p) * m + i
+
+    def successor(self, key):
+        """
+        割り当て順で次のキー（最後ならNone）
+        """
+        t, f, i = key
+        p = t * self.STEP
+        m = p + self.STEP
+        i += 1
+        if i >= m:
+            f += 1
+            if f >= m:
+                t, f = t + 1, 0
+                if (t + 1) * self.STEP > self.LIMIT:
+                    return None
+                p = t * self.STEP
+            # 前の段階で使用済みの範囲は飛ばす
+            i = p if f < p else 0
+        return t, f, i
+
+    def below_cursor(self, key):
+        return self.cursor is None or key < self.cursor
+
+    def mark_used(self, relpath):
+        """
+        スロットを使用済みにする
+        """
+        if (key := self.key(relpath)) is None:
+            return
+        if self.below_cursor(key):
+            if key in self.hole_set:
+                self.hole_set.remove(key)
+                self.dirty = True
+            return
+        # cursorを越えた場合は間のスロットを空きとして登録
+        k = self.cursor
+        while k != key:
+            self.hole_set.add(k)
+            heapq.heappush(self.holes, k)
+            k = self.successor(k)
+        self.cursor = self.successor(key)
+        self.dirty = True
+
+    def mark_free(self, relpath):
+        """
+        スロットを空きにする
+        """
+        if (key := self.key(relpath)) is None:
+            return
+        if self.below_cursor(key) and key not in self.hole_set:
+            self.hole_set.add(key)
+            heapq.heappush(self.holes, key)
+            self.dirty = True
+
+    def peek(self):
+        """
+        割り当て順で最初の空きスロットのrelpathを返す（満杯ならNone）
+        使用済みにするのは mark_used で行う
+        """
+        while self.holes and self.holes[0] not in self.hole_set:
+            heapq.heappop(self.holes)
+        if self.holes:
+            return self.relpath(self.holes[0])
+        if self.cursor is None:
+            return None
+        return self.relpath(self.cursor)
+
+    def is_consistent(self, used_below):
+        """
+        空き情報が使用済みスロット数と矛盾しないか確認
+        cursorより前のスロットは、使用済みか空きのどちらか一方に必ず属する
+        used_below: cursorより前にある使用済みスロット数
+        """
+        return used_below + len(self.hole_set) == self.ordinal(self.cursor)
+
+    def rebuild(self, relpaths):
+        """
+        使用済みのrelpath集合から空き情報を再構築
+        """
+        used = {key for relpath in relpaths if (key := self.key(relpath)) is not None}
+        self.cursor = (0, 0, 0)
+        self.holes = []
+        self.hole_set = set()
+        if used:
+            last = max(used)
+            k = self.cursor
+            while k != last:
+                if k not in used:
+                    self.hole_set.add(k)
+                k = self.successor(k)
+            self.holes = sorted(self.hole_set)
+            self.cursor = self.successor(last)
+        self.dirty = True
+
+    def load(self, path):
+        """
+        保存した空き情報を読み込む
+        """
+        if not os.path.exists(path):
+            return
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                parts = line.rstrip("\n").split("\t")
+                if len(parts) != 2:
+                    continue
+                kind, relpath = parts
+                if kind == "next":
+                    self.cursor = self.key(relpath) if relpath else None
+                elif kind == "hole" and (key := self.key(relpath)) is not None:
+                    self.hole_set.add(key)
+        self.holes = sorted(self.hole_set)
+
+    def save(self, path):
+        """
+        空き情報を保存
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("kind\trelpath\n")
+            print("next", self.relpath(self.cursor) if self.cursor else "", sep="\t", file=f)
+            for key in sorted(self.hole_set):
+                print("hole", self.relpath(key), sep="\t", file=f)
+        self.dirty = False
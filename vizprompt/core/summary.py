@@ -0,0 +1,230 @@
+import os, re
+from datetime import datetime
+from vizprompt.core.lock import FileLock
+from vizprompt.core.journal import recover_torn_line
+
+# 読み込んだ行数が要素の数の2倍とこの数の和を超えたら書き直す
+COMPACT_MARGIN = 64
+
+class DerivedTsv:
+    """
+    フローから作り直せる、Flow.save のたびに追記するTSV
+
+    追記された分だけを読み込み、他のプロセスが書き直していれば最初から読み込む。
+    読み込んだ行数が要素の数に比べて多くなれば、要素ごとに1行に書き直す。
+    サブクラスでは HEADER, COLUMNS と clear, apply, rows, __len__ を定義する。
+    """
+    HEADER = ""
+    COLUMNS = 0
+
+    def __init__(self, data_dir, name):
+        self.path = os.path.join(data_dir, name + ".tsv")
+        self.lock = FileLock(os.path.join(data_dir, name + ".lock"))
+        self.lines = 0     # 読み込んだ行数
+        self.size = 0      # 読み込んだファイルの大きさ
+        self.ino = None    # 読み込んだファイルの inode（書き直しの検出に使う）
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def append(self, lines):
+        """
+        行を追記
+        """
+        with self.lock:
+            recover_torn_line(self.path)
+            header = not os.path.exists(self.path)
+            with open(self.path, "a", encoding="utf-8") as f:
+                if header:
+                    f.write(self.HEADER)
+                f.writelines(lines)
+
+    def refresh(self):
+        """
+        追記された行を読み込み、必要なら書き直す
+        """
+        self.load()
+        if self.lines > 2 * len(self) + COMPACT_MARGIN:
+            self.compact()
+
+    def load(self):
+        """
+        追記された行を読み込む（他のプロセスが書き直していれば最初から）
+        """
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            st = os.fstat(f.fileno())
+            if st.st_ino != self.ino or st.st_size < self.size:
+                self.clear()
+                self.lines = 0
+                self.size = 0
+                self.ino = st.st_ino
+            if st.st_size == self.size:
+                return
+            f.seek(self.size)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        self.size += end
+        header = self.HEADER.split("\t", 1)[0]
+        for line in data[:end].decode("utf-8").splitlines():
+            parts = line.split("\t")
+            if len(parts) != self.COLUMNS or parts[0] == header:
+                continue
+            self.apply(parts)
+            self.lines += 1
+
+    def compact(self):
+        """
+        要素ごとに1行に書き直す
+        """
+        with self.lock:
+            self.load()
+            self.rewrite(self.rows())
+
+    def rewrite(self, lines):
+        """
+        ファイルを書き直して読み込み直す（一時ファイルから置き換える）
+        """
+        with self.lock:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(self.HEADER)
+                f.writelines(lines)
+            os.replace(tmp_path, self.path)
+            self.ino = None
+            self.load()
+
+class FlowSummaries(DerivedTsv):
+    """
+    フローを読み込まずに一覧を表示するための要約
+
+    flows/summary.tsv: id, updated, created, nodes, edges, head, name の行
+    同じIDが複数あれば後の行を優先する。
+    """
+    HEADER = "id\tupdated\tcreated\tnodes\tedges\thead\tname\n"
+    COLUMNS = 7
+
+    def __init__(self, data_dir):
+        super().__init__(data_dir, "summary")
+        self.entries = {}  # id -> 要約の辞書
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+
+    @staticmethod
+    def summary(flow):
+        """
+        フローの要約
+        """
+        return {
+            "id": flow.id,
+            "updated": flow.updated,
+            "created": flow.created,
+            "nodes": flow.node_count,
+            "edges": flow.edge_count,
+            "head": flow.last_node or "",
+            # 名前に含まれるタブや改行は1行に収まるよう空白に置き換える
+            "name": re.sub(r"[\t\r\n]", " ", flow.name),
+        }
+
+    @staticmethod
+    def format(s):
+        fields = [s["id"], s["updated"].isoformat(), s["created"].isoformat(),
+                  str(s["nodes"]), str(s["edges"]), s["head"], s["name"]]
+        return "\t".join(fields) + "\n"
+
+    def put(self, flow):
+        """
+        フローの要約を追記
+        """
+        self.append([self.format(self.summary(flow))])
+
+    def apply(self, parts):
+        id, updated, created, nodes, edges, head, name = parts
+        self.entries[id] = {
+            "id": id,
+            "updated": datetime.fromisoformat(updated),
+            "created": datetime.fromisoformat(created),
+            "nodes": int(nodes),
+            "edges": int(edges),
+            "head": head,
+            "name": name,
+        }
+
+    def rows(self):
+        return map(self.format, self.entries.values())
+
+    def get(self, id):
+        return self.entries.get(id)
+
+class NodeRefs(DerivedTsv):
+    """
+    ノードからそのノードを含むフローを引く逆引きインデックス
+
+    flows/refs.tsv: node, flow, op の行（op は + ならフローに追加、- なら削除）
+    Flow.save のたびに、前回の保存から追加・削除したノードを追記する。
+    導入前のフローを取りこぼさないよう、ファイルは rebuild でのみ作成する。
+    """
+    HEADER = "node\tflow\top\n"
+    COLUMNS = 3
+
+    def __init__(self, data_dir):
+        super().__init__(data_dir, "refs")
+        self.refs = {}  # ノードID -> {フローID: None}（追加順）
+        self.count = 0  # 参照の数
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.refs.clear()
+        self.count = 0
+
+    def put(self, flow_id, changes):
+        """
+        フローに追加・削除したノードを追記
+        changes: ノードID -> 追加したか（Falseなら削除）
+        ファイルがなければ追記しない（最初に参照するときにすべてのフローから作成する）
+        """
+        if not changes:
+            return
+        with self.lock:
+            if self.exists():
+                self.append(f"{node_id}\t{flow_id}\t{'+' if added else '-'}\n"
+                            for node_id, added in changes.items())
+
+    def apply(self, parts):
+        node_id, flow_id, op = parts
+        if op == "+":
+            flows = self.refs.setdefault(node_id, {})
+            if flow_id not in flows:
+                flows[flow_id] = None
+                self.count += 1
+        elif flow_id in (flows := self.refs.get(node_id, ())):
+            del flows[flow_id]
+            self.count -= 1
+            if not flows:
+                del self.refs[node_id]
+
+    def rows(self):
+        for node_id, flows in self.refs.items():
+            for flow_id in flows:
+                yield f"{node_id}\t{flow_id}\t+\n"
+
+    def rebuild(self, flows):
+        """
+        フローの (ID, ノードIDのリスト) から作り直す
+        """
+        self.rewrite(f"{node_id}\t{flow_id}\t+\n" for flow_id, nodes in flows for node_id in nodes)
+
+    def get(self, node_id):
+        """
+        ノードを含むフローのIDのリスト
+        """
+        return list(self.refs.get(node_id, ()))